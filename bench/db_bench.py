@@ -0,0 +1,275 @@
+# bench/db_bench.py
+"""
+Микробенчмарки функций db.py на синтетической БД реального масштаба.
+
+Каждая функция вызывается --iterations раз для выборки пользователей (самые активные
+и случайные); время вызова пишется в JSON вместе с параметрами прогона, чтобы прогоны
+можно было сравнивать (--compare). Все SQL, выполненные функцией, перехватываются
+trace-callback'ом соединений, и для каждого шаблона запроса сохраняется EXPLAIN QUERY PLAN.
+Если какой-то запрос читает таблицу полным сканированием, прогон завершается с кодом 1.
+
+Запуск из корня проекта:
+    python -m bench.db_bench --rows 10000000 --users 20000
+    python -m bench.db_bench --compare bench_db_results_prev.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import config
+import db
+import report_cache
+from bench.stats import percentiles
+from bench.synthetic import generate_database, heaviest_users
+
+# Полное сканирование таблицы: "SCAN transactions" без индекса (SCAN ... USING INDEX - это обход индекса)
+FULL_SCAN_RE = re.compile(r'^SCAN (?!CONSTANT ROW)(\w+)(?!\w| USING)')
+# Обход материализованного подзапроса (MATERIALIZE g ... SCAN g) - это уже сгруппированные строки, не таблица
+MATERIALIZE_RE = re.compile(r'^MATERIALIZE (\w+)')
+# Служебные команды, для которых план не нужен
+_SKIP_SQL_RE = re.compile(r'^\s*(--|PRAGMA|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|EXPLAIN)', re.IGNORECASE)
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+@dataclass
+class Benchmark:
+    name: str
+    call: Callable[[int], Awaitable[object]] # Вызов функции db для пользователя (замеряется)
+    setup: Optional[Callable[[int], Awaitable[None]]] = None # Подготовка перед каждым вызовом (не замеряется)
+    iterations: Optional[int] = None
+    warmup: Optional[Callable[[List[int]], Awaitable[None]]] = None # Один раз перед замерами для всей выборки (не замеряется)
+    # Счетчики кэша, который должен отвечать на замеряемые вызовы: прогон без попаданий - ошибка
+    cache_stats: Optional[Callable[[], Dict[str, object]]] = None
+
+class QueryLog:
+    """Trace-callback: запоминает по одному примеру каждого шаблона SQL для текущего бенчмарка."""
+
+    def __init__(self):
+        self.current: Optional[str] = None
+        self.examples: Dict[str, Dict[str, str]] = defaultdict(dict)
+
+    def __call__(self, sql: str):
+        if self.current is None or _SKIP_SQL_RE.match(sql): return
+        template = _LITERAL_RE.sub('?', ' '.join(sql.split()))
+        self.examples[self.current].setdefault(template, sql)
+
+async def _attach_trace(log: QueryLog):
+    for conn in db.all_connections():
+        await conn.set_trace_callback(log)
+
+async def _query_plans(log: QueryLog) -> Dict[str, List[Dict[str, object]]]:
+    plans: Dict[str, List[Dict[str, object]]] = {}
+    for name, examples in log.examples.items():
+        plans[name] = []
+        for template, sql in examples.items():
+            try:
+                rows = await db.db_conn.execute_fetchall(f"EXPLAIN QUERY PLAN {sql}")
+                detail = [row['detail'] for row in rows]
+            except Exception as e:
+                detail = [f"EXPLAIN failed: {e}"]
+            materialized = {match.group(1) for match in map(MATERIALIZE_RE.match, detail) if match}
+            full_scans = [line for line in detail if (match := FULL_SCAN_RE.match(line)) and match.group(1) not in materialized]
+            plans[name].append({"sql": template, "plan": detail, "full_scan": bool(full_scans)})
+    return plans
+
+async def _sample_users(path: str, count: int, users: int, rnd: random.Random) -> List[int]:
+    heavy = heaviest_users(path, max(1, count // 2))
+    sample = heavy + rnd.sample(range(1, users + 1), min(users, count - len(heavy)))
+    return list(dict.fromkeys(sample))
+
+async def _middle_ids(user_ids: List[int]) -> Dict[int, int]:
+    """id из середины истории каждого пользователя - курсор для "глубокой" страницы /recent."""
+    result = {}
+    for user_id in user_ids:
+        rows = await db.db_conn.execute_fetchall("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (user_id,))
+        rows = await db.db_conn.execute_fetchall("SELECT id FROM transactions WHERE user_id = ? ORDER BY id LIMIT 1 OFFSET ?", (user_id, rows[0][0] // 2))
+        if rows: result[user_id] = rows[0][0]
+    return result
+
+def _build_benchmarks(args, rnd: random.Random, middle_ids: Dict[int, int]) -> List[Benchmark]:
+    now = datetime.now(timezone.utc)
+    month_start = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
+    deletable: Dict[int, int] = {}
+    category_names: Dict[int, List[str]] = defaultdict(list)
+
+    def random_period():
+        start = now - timedelta(days=rnd.randint(60, 600), hours=rnd.randint(0, 23))
+        return start, start + timedelta(days=rnd.randint(20, 120))
+    periods: Dict[int, tuple] = defaultdict(random_period)
+
+    async def cold_reports(user_id: int): report_cache.clear()
+    async def warm_reports(user_ids: List[int]):
+        for user_id in user_ids: await db.get_period_summary_with_details(user_id, *periods[user_id])
+    async def cold_categories(user_id: int): db._category_cache.clear()
+
+    async def add_expense(user_id: int):
+        return await db.add_transaction(user_id, 'expense', rnd.randint(100, 500_000), rnd.choice(db.get_standard_categories(user_id, 'expense')))
+
+    async def prepare_delete(user_id: int):
+        await add_expense(user_id)
+        deletable[user_id] = (await db.get_last_transaction_id_details(user_id))['id']
+
+    async def add_category(user_id: int):
+        name = f"Бенч{rnd.randint(1, 10**9)}"
+        category_names[user_id].append(name)
+        return await db.add_user_category(user_id, 'expense', name)
+
+    async def delete_category(user_id: int):
+        names = category_names[user_id]
+        if not names: return None
+        name = names.pop()
+        category = next((cat for cat in await db.get_user_categories(user_id, 'expense') if cat.name == name), None)
+        return await db.delete_user_category(user_id, 'expense', category.id) if category else None
+
+    async def export_user(user_id: int):
+        rows = 0
+        async for page in db.iter_transaction_pages(user_id): rows += len(page)
+        return rows
+
+    async def import_batch(user_id: int):
+        categories = await db.get_user_categories(user_id, 'expense') or db.get_standard_categories(user_id, 'expense')
+        rows = []
+        for _ in range(args.import_batch):
+            created_at = (now - timedelta(seconds=rnd.randrange(3600 * 24 * 365))).strftime('%Y-%m-%d %H:%M:%S')
+            rows.append((user_id, 'expense', rnd.randint(100, 500_000), rnd.choice(categories).id, created_at))
+        return await db.import_transactions(rows)
+
+    async def save_fsm(user_id: int):
+        upserts = [(f"bench:{user_id}:{i}", "TransactionStates:waiting_for_amount", '{"transaction_type":"expense"}', time.time()) for i in range(20)]
+        return await db.save_fsm_records(upserts, [])
+
+    return [
+        Benchmark("add_transaction", add_expense),
+        Benchmark("get_period_summary_with_details[month]", lambda u: db.get_period_summary_with_details(u, month_start, db._next_month(month_start)), setup=cold_reports),
+        Benchmark("get_period_summary_with_details[custom]", lambda u: db.get_period_summary_with_details(u, *periods[u]), setup=cold_reports),
+        # [custom] чистит кэш перед каждым вызовом: без прогрева [cached] мерил бы промахи
+        Benchmark("get_period_summary_with_details[cached]", lambda u: db.get_period_summary_with_details(u, *periods[u]), warmup=warm_reports, cache_stats=report_cache.stats),
+        Benchmark("get_monthly_trend[24]", lambda u: db.get_monthly_trend(u, db._month_floor(now - timedelta(days=730)), db._next_month(month_start))),
+        Benchmark("get_daily_expenses[month]", lambda u: db.get_daily_expenses(u, month_start, db._next_month(month_start))),
+        Benchmark("get_daily_expenses[custom]", lambda u: db.get_daily_expenses(u, *periods[u])),
+        Benchmark("get_transactions_page[first]", lambda u: db.get_transactions_page(u, 11)),
+        Benchmark("get_transactions_page[deep]", lambda u: db.get_transactions_page(u, 11, before_id=middle_ids.get(u, 1))),
+        Benchmark("get_transactions_page[newer]", lambda u: db.get_transactions_page(u, 11, after_id=middle_ids.get(u, 1))),
+        Benchmark("get_last_transaction_id_details", db.get_last_transaction_id_details),
+        Benchmark("delete_transaction_by_id", lambda u: db.delete_transaction_by_id(deletable[u], u), setup=prepare_delete),
+        Benchmark("get_user_categories[cold]", lambda u: db.get_user_categories(u, 'expense'), setup=cold_categories),
+        Benchmark("get_user_categories[cached]", lambda u: db.get_user_categories(u, 'expense')),
+        Benchmark("add_user_category", add_category),
+        Benchmark("delete_user_category", delete_category),
+        Benchmark("iter_transaction_pages", export_user, iterations=args.export_iterations),
+        Benchmark("import_transactions", import_batch, iterations=args.export_iterations),
+        Benchmark("load_fsm_record", lambda u: db.load_fsm_record(f"bench:{u}:0")),
+        Benchmark("save_fsm_records", save_fsm),
+    ]
+
+async def _run_benchmark(bench: Benchmark, users: List[int], iterations: int, log: QueryLog) -> Dict[str, float]:
+    samples: List[float] = []
+    if bench.warmup:
+        log.current = None
+        await bench.warmup(users)
+    hits_before = bench.cache_stats()["hits"] if bench.cache_stats else 0
+    for i in range(iterations):
+        user_id = users[i % len(users)]
+        if bench.setup:
+            log.current = None
+            await bench.setup(user_id)
+        log.current = bench.name
+        started = time.perf_counter()
+        await bench.call(user_id)
+        samples.append((time.perf_counter() - started) * 1000)
+        log.current = None
+    extra: Dict[str, float] = {}
+    if bench.cache_stats:
+        extra["cache_hits"] = bench.cache_stats()["hits"] - hits_before
+        if not extra["cache_hits"]: raise RuntimeError(f"{bench.name}: no cache hits, the benchmark would measure misses")
+    total = sum(samples)
+    return {**extra, "iterations": len(samples), "mean_ms": total / len(samples), "ops_per_sec": len(samples) / (total / 1000) if total else 0.0, **{f"{k}_ms": v for k, v in percentiles(samples).items()}}
+
+def _git_revision() -> Optional[str]:
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception: return None
+
+def _print_comparison(results: Dict[str, Dict[str, float]], previous_path: str):
+    with open(previous_path, encoding='utf-8') as f: previous = json.load(f)["results"]
+    print(f"\nCompared with {previous_path} (p50, lower is better):")
+    for name, current in results.items():
+        before = previous.get(name)
+        if not before: print(f"  {name:<44} new"); continue
+        ratio = current["p50_ms"] / before["p50_ms"] if before["p50_ms"] else float('inf')
+        print(f"  {name:<44} {before['p50_ms']:>9.3f} -> {current['p50_ms']:>9.3f} ms  x{ratio:.2f}")
+
+async def run(args) -> int:
+    config.SQLITE_DB_FILE = args.db
+    config.SQLITE_SHARDS = 1 # Планы и время запросов меряются на одном файле
+    if not await db.connect_db(): raise SystemExit(f"Cannot open {args.db}")
+    rnd = random.Random(args.seed)
+    log = QueryLog()
+    try:
+        rows = (await db.db_conn.execute_fetchall("SELECT COUNT(*) FROM transactions"))[0][0]
+        users = await _sample_users(args.db, args.users_sampled, args.users, rnd)
+        middle_ids = await _middle_ids(users)
+        await _attach_trace(log)
+        results: Dict[str, Dict[str, float]] = {}
+        for bench in _build_benchmarks(args, rnd, middle_ids):
+            results[bench.name] = await _run_benchmark(bench, users, bench.iterations or args.iterations, log)
+            print(f"{bench.name:<44} p50 {results[bench.name]['p50_ms']:>9.3f} ms  p95 {results[bench.name]['p95_ms']:>9.3f} ms  p99 {results[bench.name]['p99_ms']:>9.3f} ms")
+        plans = await _query_plans(log)
+    finally:
+        await db.close_db()
+
+    full_scans = [(name, entry) for name, entries in plans.items() for entry in entries if entry["full_scan"]]
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            "git_revision": _git_revision(),
+            "database": args.db, "rows": rows, "users": args.users, "users_sampled": len(users),
+            "iterations": args.iterations, "sqlite_version": sqlite3.sqlite_version, "python": sys.version.split()[0],
+            "wal_mode": config.SQLITE_WAL_MODE, "write_behind": config.DB_WRITE_BEHIND,
+        },
+        "results": results,
+        "query_plans": plans,
+        "full_scans": [{"benchmark": name, **entry} for name, entry in full_scans],
+    }
+    with open(args.out, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nResults written to {args.out}")
+    if args.compare: _print_comparison(results, args.compare)
+    if full_scans:
+        print("\nFULL TABLE SCAN detected:")
+        for name, entry in full_scans: print(f"  [{name}] {entry['sql']}\n      {'; '.join(entry['plan'])}")
+        return 1
+    print("Query plans: no full table scans.")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark every db.py function on a synthetic database.")
+    parser.add_argument('--db', default='bench_db.db', help="SQLite file (generated if missing)")
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--users-sampled', type=int, default=50, help="Users to call functions for: half heaviest, half random")
+    parser.add_argument('--iterations', type=int, default=200, help="Calls per benchmark")
+    parser.add_argument('--export-iterations', type=int, default=10, help="Calls for full-history export and bulk import")
+    parser.add_argument('--import-batch', type=int, default=1000, help="Rows per import_transactions call")
+    parser.add_argument('--out', default='bench_db_results.json', help="JSON file with results and query plans")
+    parser.add_argument('--compare', help="Previous results JSON to compare p50 against")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    if not os.path.exists(args.db):
+        print(f"Generating {args.rows} rows for {args.users} users into {args.db}...")
+        generate_database(args.db, users=args.users, rows=args.rows, months=args.months, seed=args.seed)
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+# bench/loadtest.py
+"""
+Нагрузочный тест без сети: тот же диспетчер, что в main.main(), получает синтетические
+апдейты через dp.feed_update, а Bot работает поверх StubSession, которая только
+записывает вызовы API и возвращает правдоподобные ответы.
+
+Каждый виртуальный пользователь проходит случайные сценарии по заданной смеси:
+запись расхода/дохода, отчеты, листание /recent, управление категориями, удаление.
+Шаги одного пользователя идут по очереди, пользователи - параллельно.
+
+Запуск из корня проекта:
+    python -m bench.loadtest --users 2000 --scenarios 5 --mix expense=40,income=10,report=20,recent=15,categories=5,delete=10
+    python -m bench.loadtest --db bench_loadtest.db --db-rows 1000000   # с предзаполненной историей
+    python -m bench.loadtest --db bench_loadtest.db --db-rows 1000000 --shards 4   # то же по 4 файлам
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.enums import ParseMode
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, InlineKeyboardMarkup, Message, Update
+
+import config
+import db
+import outbox
+from bench.stats import percentiles
+from bench.synthetic import generate_database
+from tools import reshard
+
+DEFAULT_MIX = "expense=40,income=10,report=20,recent=15,categories=5,delete=10"
+
+class StubSession(BaseSession):
+    """Сессия без сети: считает вызовы методов API и отвечает фиктивными объектами."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls: Counter = Counter()
+        # Последняя inline-клавиатура в чате: по ней сценарии нажимают кнопки, как живой пользователь
+        self.last_markup: Dict[int, InlineKeyboardMarkup] = {}
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        name = type(method).__name__
+        self.calls[name] += 1
+        chat_id = getattr(method, 'chat_id', None)
+        markup = getattr(method, 'reply_markup', None)
+        if isinstance(chat_id, int) and isinstance(markup, InlineKeyboardMarkup):
+            self.last_markup[chat_id] = markup
+        if method.__returning__ is bool or chat_id is None:
+            return True
+        # Message (или Message | bool) - отвечаем сообщением в тот же чат
+        return Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=chat_id, type='private'),
+            text=getattr(method, 'text', None) if isinstance(getattr(method, 'text', None), str) else None,
+        ).as_(bot)
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30, chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+    def callbacks(self, chat_id: int, prefix: str) -> List[Tuple[str, str]]:
+        """(текст, callback_data) кнопок последней клавиатуры чата, у которых callback_data начинается с prefix."""
+        markup = self.last_markup.get(chat_id)
+        if markup is None: return []
+        return [(button.text, button.callback_data) for row in markup.inline_keyboard for button in row
+                if button.callback_data and button.callback_data.startswith(prefix)]
+
+    def find_callback(self, chat_id: int, prefix: str, text: Optional[str] = None) -> Optional[str]:
+        """callback_data первой кнопки последней клавиатуры чата, начинающейся с prefix (и с текстом text, если задан)."""
+        return next((data for button_text, data in self.callbacks(chat_id, prefix) if text is None or button_text == text), None)
+
+class LoadTest:
+    def __init__(self, dp, bot: Bot, session: StubSession, rnd: random.Random):
+        self.dp, self.bot, self.session, self.rnd = dp, bot, session, rnd
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.unhandled: Counter = Counter()
+        self.errors = 0
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> Dict[str, Any]:
+        return {
+            "message_id": next(self._message_ids), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text,
+        }
+
+    async def _feed(self, step: str, payload: Dict[str, Any]):
+        update = Update.model_validate({"update_id": next(self._update_ids), **payload}, context={"bot": self.bot})
+        started = time.perf_counter()
+        try:
+            result = await self.dp.feed_update(self.bot, update)
+            if result is UNHANDLED: self.unhandled[step] += 1
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Step {step} failed: {e}")
+        self.latencies[step].append((time.perf_counter() - started) * 1000)
+
+    async def text(self, user_id: int, step: str, text: str):
+        await self._feed(step, {"message": self._message(user_id, text)})
+
+    async def click(self, user_id: int, step: str, data: str):
+        callback = {
+            "id": str(next(self._update_ids)), "from": self._user(user_id), "chat_instance": str(user_id),
+            "message": self._message(user_id, "..."), "data": data,
+        }
+        await self._feed(step, {"callback_query": callback})
+
+    # --- Сценарии ---
+
+    async def scenario_expense(self, user_id: int):
+        await self.text(user_id, "expense:start", "📊 Записать Расход")
+        await self.text(user_id, "expense:amount", f"{self.rnd.randint(1, 5000)}.{self.rnd.randint(0, 99):02d}")
+        # В кнопках категорий - id, поэтому нажимаем кнопку из присланной ботом клавиатуры
+        choices = self.session.callbacks(user_id, "exp_cat:")
+        if choices: await self.click(user_id, "expense:category", self.rnd.choice(choices)[1])
+
+    async def scenario_income(self, user_id: int):
+        await self.text(user_id, "income:start", "💰 Записать Доход")
+        await self.text(user_id, "income:amount", str(self.rnd.randint(1000, 200000)))
+        choices = self.session.callbacks(user_id, "inc_cat:")
+        if choices: await self.click(user_id, "income:category", self.rnd.choice(choices)[1])
+
+    async def scenario_report(self, user_id: int):
+        await self.text(user_id, "report", self.rnd.choice(["📈 Отчет за месяц", "/report", "/prevmonthreport"]))
+
+    async def scenario_recent(self, user_id: int):
+        await self.text(user_id, "recent", "/recent")
+        for _ in range(self.rnd.randint(0, 3)):
+            data = self.session.find_callback(user_id, "recent:o:")
+            if data is None: break
+            await self.click(user_id, "recent:page", data)
+
+    async def scenario_categories(self, user_id: int):
+        name = f"Тест{self.rnd.randint(1, 10**6)}"
+        await self.text(user_id, "categories:menu", "/mycategories")
+        await self.click(user_id, "categories:action", "cat_manage:add")
+        await self.click(user_id, "categories:type", "cat_add_type:expense")
+        await self.text(user_id, "categories:add", name)
+        await self.text(user_id, "categories:menu", "/mycategories")
+        await self.click(user_id, "categories:action", "cat_manage:delete")
+        await self.click(user_id, "categories:type", "cat_del_type:expense")
+        data = self.session.find_callback(user_id, "cat_delete_confirm:", text=f"❌ {name}")
+        if data is None: return
+        await self.click(user_id, "categories:delete", data)
+        # После удаления бот снова показывает меню категорий - выходим из него, как живой пользователь
+        await self.click(user_id, "categories:back", "cat_manage:back")
+
+    async def scenario_delete(self, user_id: int):
+        await self.text(user_id, "delete:ask", "/deletelast")
+        data = self.session.find_callback(user_id, "delete_confirm:")
+        if data: await self.click(user_id, "delete:confirm", data)
+
+    async def run_user(self, user_id: int, scenarios: List[str]):
+        for name in scenarios:
+            await getattr(self, f"scenario_{name}")(user_id)
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if not hasattr(LoadTest, f"scenario_{name}"): raise SystemExit(f"Unknown scenario '{name}'")
+        mix[name] = float(weight or 1)
+    return mix
+
+async def run(args):
+    from main import create_dispatcher # main настраивает логирование при импорте
+    logging.getLogger().setLevel(logging.WARNING)
+    config.SQLITE_DB_FILE = args.db
+    config.SQLITE_SHARDS = args.shards
+    if not args.telegram_limits:
+        # Сессия-заглушка не ограничивает частоту: лимиты outbox только растянули бы отправку
+        config.OUTBOX_GLOBAL_RATE = config.OUTBOX_CHAT_RATE = 0
+    if not await db.connect_db(): raise SystemExit(f"Cannot open {args.db}")
+    session = StubSession()
+    bot = Bot(token="42:LOADTEST", session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    outbox.install(bot)
+    dp = create_dispatcher()
+    rnd = random.Random(args.seed)
+    test = LoadTest(dp, bot, session, rnd)
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    plans = {user_id: rnd.choices(names, weights=weights, k=args.scenarios) for user_id in range(1, args.users + 1)}
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def one_user(user_id: int):
+        async with limit: await test.run_user(user_id, plans[user_id])
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(one_user(user_id) for user_id in plans))
+        elapsed = time.perf_counter() - started
+    finally:
+        await outbox.drain()
+        await db.drain_write_queue()
+        await dp.storage.close()
+        await db.close_db()
+
+    all_samples = [value for samples in test.latencies.values() for value in samples]
+    total = percentiles(all_samples)
+    print(f"Database: {args.db} ({args.shards} shard(s)), users: {args.users}, scenarios per user: {args.scenarios}, concurrency: {args.concurrency}")
+    print(f"Mix: {args.mix}")
+    print(f"Updates: {len(all_samples)} in {elapsed:.2f} s -> {len(all_samples) / elapsed:.0f} updates/s")
+    print(f"Latency ms: p50 {total['p50']:.2f}, p95 {total['p95']:.2f}, p99 {total['p99']:.2f}, max {total['max']:.2f}")
+    print(f"Unhandled updates: {sum(test.unhandled.values())} {dict(test.unhandled)}, errors: {test.errors}")
+    print(f"\n{'step':<22}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for step in sorted(test.latencies):
+        stats = percentiles(test.latencies[step])
+        print(f"{step:<22}{len(test.latencies[step]):>8}{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['p99']:>10.2f}")
+    print(f"\nAPI calls: {dict(session.calls.most_common())}")
+    print(f"Write-behind: {db.get_write_behind_stats()}")
+    print(f"Outbox: {outbox.get_stats()}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the bot's Dispatcher with synthetic updates and a stubbed Bot session.")
+    parser.add_argument('--db', default='bench_loadtest.db', help="SQLite file (generated with --db-rows if missing)")
+    parser.add_argument('--db-rows', type=int, default=0, help="Pre-populate history for the simulated users")
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--users', type=int, default=1000, help="Simulated users (ids 1..N, same as synthetic history)")
+    parser.add_argument('--scenarios', type=int, default=5, help="Scenarios per user")
+    parser.add_argument('--concurrency', type=int, default=500, help="Users active at the same time")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Scenario weights: name=weight,...")
+    parser.add_argument('--telegram-limits', action='store_true', help="Keep outbox rate limits (handlers awaiting replies wait for tokens too)")
+    parser.add_argument('--shards', type=int, default=1, help="Split --db into this many shard files (tools.reshard) and run on them")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.db_rows and not os.path.exists(args.db):
+        print(f"Generating {args.db_rows} rows for {args.users} users into {args.db}...")
+        generate_database(args.db, users=args.users, rows=args.db_rows, months=args.months, seed=args.seed)
+    if args.shards > 1 and os.path.exists(args.db) and not os.path.exists(db.shard_path(0, args.shards, args.db)):
+        print(f"Splitting {args.db} into {args.shards} shards...")
+        if asyncio.run(reshard.run(args.db, args.shards)) != 0: raise SystemExit("Resharding failed")
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# bench/period_summary.py
+"""
+Бенчмарк отчета за период по сырым строкам: прежние два запроса через idx_user_month
+против одного прохода по покрывающему idx_user_period_cover.
+
+Запуск из корня проекта:
+    python -m bench.period_summary --rows 2000000 --users 2000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict
+
+import config
+import db
+from bench.synthetic import generate_database, heaviest_users
+
+# Прежняя реализация: итоги по типам и разбивка расходов отдельными запросами по idx_user_month
+LEGACY_SQL_SUMMARY = "SELECT transaction_type, SUM(amount) as total_amount FROM transactions INDEXED BY idx_user_month WHERE user_id = ? AND created_at >= ? AND created_at < ? GROUP BY transaction_type"
+LEGACY_SQL_DETAILS = db._with_category_names("SELECT category_id, SUM(amount) as category_total FROM transactions INDEXED BY idx_user_month WHERE user_id = ? AND transaction_type = 'expense' AND created_at >= ? AND created_at < ? GROUP BY category_id") + " ORDER BY g.category_total DESC"
+
+async def legacy_period(user_id: int, start_str: str, end_str: str):
+    totals: Dict[str, int] = {}
+    details: Dict[str, int] = {}
+    async with db.db_conn.execute(LEGACY_SQL_SUMMARY, (user_id, start_str, end_str)) as cursor:
+        for row in await cursor.fetchall(): totals[row['transaction_type']] = int(row['total_amount'] or 0)
+    async with db.db_conn.execute(LEGACY_SQL_DETAILS, (user_id, start_str, end_str)) as cursor:
+        for row in await cursor.fetchall(): details[row['category']] = int(row['category_total'] or 0)
+    return totals.get('income', 0), totals.get('expense', 0), details
+
+async def single_pass_period(user_id: int, start_str: str, end_str: str):
+    totals: Dict[str, int] = {}
+    details: Dict[str, int] = {}
+    await db._add_raw_period(db.db_conn, user_id, start_str, end_str, totals, details)
+    return totals.get('income', 0), totals.get('expense', 0), details
+
+async def query_plan(sql: str, params: tuple) -> str:
+    async with db.db_conn.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+        return "; ".join(row['detail'] for row in await cursor.fetchall())
+
+async def timed(fn, cases, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for case in cases: await fn(*case)
+        samples.append((time.perf_counter() - started) / len(cases) * 1000)
+    return statistics.median(samples)
+
+async def run(args):
+    config.SQLITE_DB_FILE = args.db
+    config.SQLITE_SHARDS = 1
+    if not await db.connect_db(): raise SystemExit(f"Cannot open {args.db}")
+    try:
+        rnd = random.Random(args.seed)
+        users = heaviest_users(args.db, args.users_sampled)
+        now = datetime.now(timezone.utc)
+        cases = []
+        for user_id in users:
+            # Периоды, не совпадающие с границами месяцев - именно они читают сырые строки
+            start = now - timedelta(days=rnd.randint(60, 600))
+            end = start + timedelta(days=rnd.randint(20, 90))
+            cases.append((user_id, start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')))
+
+        # Результаты обоих вариантов должны совпадать
+        for case in cases:
+            old_income, old_expense, old_details = await legacy_period(*case)
+            new_income, new_expense, new_details = await single_pass_period(*case)
+            assert (old_income, old_expense, old_details) == (new_income, new_expense, new_details), case
+
+        # Прогрев кэша страниц
+        await timed(legacy_period, cases, 1); await timed(single_pass_period, cases, 1)
+        legacy_ms = await timed(legacy_period, cases, args.repeat)
+        single_ms = await timed(single_pass_period, cases, args.repeat)
+
+        sample = cases[0]
+        print(f"Database: {args.db}")
+        print(f"Sampled users: {len(users)}, periods per run: {len(cases)}, repeats: {args.repeat}")
+        print(f"Legacy plan (summary): {await query_plan(LEGACY_SQL_SUMMARY, sample)}")
+        print(f"Legacy plan (details): {await query_plan(LEGACY_SQL_DETAILS, sample)}")
+        print(f"Single-pass plan:      {await query_plan('SELECT transaction_type, category_id, SUM(amount) FROM transactions WHERE user_id = ? AND created_at >= ? AND created_at < ? GROUP BY transaction_type, category_id', sample)}")
+        print(f"Legacy two-query:      {legacy_ms:.3f} ms per report")
+        print(f"Single-pass covering:  {single_ms:.3f} ms per report")
+        print(f"Speedup:               {legacy_ms / single_ms:.2f}x")
+    finally:
+        await db.close_db()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark period summary queries on a synthetic table.")
+    parser.add_argument('--db', default='bench_period_summary.db', help="SQLite file (generated if missing)")
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--users-sampled', type=int, default=20, help="How many of the heaviest users to query")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    if not os.path.exists(args.db):
+        print(f"Generating {args.rows} rows for {args.users} users into {args.db}...")
+        generate_database(args.db, users=args.users, rows=args.rows, months=args.months, seed=args.seed)
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# bench/stats.py
+"""Общие расчеты для бенчмарков."""
+import statistics
+from typing import Dict, List
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """p50/p95/p99/max по выборке задержек (мс)."""
+    if len(samples) < 2: value = samples[0] if samples else 0.0; return {"p50": value, "p95": value, "p99": value, "max": value}
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98], "max": max(samples)}
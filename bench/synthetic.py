@@ -0,0 +1,95 @@
+# bench/synthetic.py
+"""
+Генератор синтетической БД для бенчмарков.
+
+Схема создается самим db.init_db, поэтому совпадает с рабочей. Данные заливаются
+пачками через sqlite3 с отключенными триггерами transactions, после чего триггеры
+восстанавливаются, а monthly_rollup пересчитывается одним запросом.
+"""
+import asyncio
+import logging
+import random
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Tuple
+
+import config
+import db
+
+# Пользовательские категории расходов: встречаются в синтетической истории и заводятся в categories
+CUSTOM_EXPENSE_CATEGORIES = ["Кафе", "Подписки", "Подарки", "Путешествия"]
+
+def _user_weights(users: int, skew: float) -> List[float]:
+    # Распределение активности, близкое к реальному: немного очень активных пользователей и длинный хвост
+    return [1.0 / (rank ** skew) for rank in range(1, users + 1)]
+
+def iter_rows(users: int, rows: int, months: int, seed: int, skew: float = 1.1) -> Iterator[Tuple[int, str, int, str, str]]:
+    """Генерирует строки (user_id, transaction_type, amount, category, created_at); amount - в копейках."""
+    rnd = random.Random(seed)
+    weights = _user_weights(users, skew)
+    user_ids = list(range(1, users + 1))
+    end = datetime.now(timezone.utc).replace(microsecond=0)
+    span_seconds = int(timedelta(days=30 * months).total_seconds())
+    expense_cats = config.EXPENSE_CATEGORIES + CUSTOM_EXPENSE_CATEGORIES
+    produced = 0
+    while produced < rows:
+        chunk = min(10_000, rows - produced)
+        for user_id in rnd.choices(user_ids, weights=weights, k=chunk):
+            created_at = end - timedelta(seconds=rnd.randrange(span_seconds))
+            if rnd.random() < 0.85:
+                yield (user_id, 'expense', int(rnd.lognormvariate(6, 1.2) * 100) + 1, rnd.choice(expense_cats), created_at.strftime('%Y-%m-%d %H:%M:%S'))
+            else:
+                yield (user_id, 'income', int(rnd.lognormvariate(9, 0.8) * 100) + 1, rnd.choice(config.INCOME_CATEGORIES), created_at.strftime('%Y-%m-%d %H:%M:%S'))
+        produced += chunk
+
+def generate_database(path: str, users: int = 1000, rows: int = 1_000_000, months: int = 24, seed: int = 42, batch: int = 50_000):
+    """Создает (или дополняет) файл БД по пути path синтетическими транзакциями."""
+    config.SQLITE_DB_FILE = path
+    config.SQLITE_SHARDS = 1 # Синтетика пишется в один файл; по шардам ее раскладывает tools.reshard
+    async def _init_schema():
+        if not await db.connect_db(): raise RuntimeError(f"Cannot open {path}")
+        await db.close_db()
+    asyncio.run(_init_schema())
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA synchronous = OFF")
+        triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'transactions'").fetchall()
+        for name, _ in triggers: conn.execute(f"DROP TRIGGER {name}")
+        conn.executemany(
+            "INSERT OR IGNORE INTO categories (user_id, category_type, name) VALUES (?, 'expense', ?)",
+            ((user_id, name) for user_id in range(1, users + 1) for name in CUSTOM_EXPENSE_CATEGORIES)
+        )
+        # (user_id, тип, имя) -> id; стандартные категории - с user_id = 0
+        category_ids = {(user_id, category_type, name): category_id for category_id, user_id, category_type, name in conn.execute("SELECT id, user_id, category_type, name FROM categories")}
+        def with_category_id(row: Tuple[int, str, int, str, str]) -> Tuple[int, str, int, int, str]:
+            user_id, transaction_type, amount, category, created_at = row
+            category_id = category_ids.get((0, transaction_type, category)) or category_ids[(user_id, transaction_type, category)]
+            return user_id, transaction_type, amount, category_id, created_at
+        pending = []
+        inserted = 0
+        for row in iter_rows(users, rows, months, seed):
+            pending.append(with_category_id(row))
+            if len(pending) >= batch:
+                conn.executemany(db.SQL_INSERT_TRANSACTION, pending)
+                conn.commit()
+                inserted += len(pending); pending.clear()
+                logging.info(f"Synthetic rows inserted: {inserted}/{rows}")
+        if pending:
+            conn.executemany(db.SQL_INSERT_TRANSACTION, pending)
+            conn.commit()
+        for _, sql in triggers: conn.execute(sql)
+        conn.execute("DELETE FROM monthly_rollup")
+        conn.execute(f"INSERT INTO monthly_rollup (user_id, month, transaction_type, category_id, total_amount, tx_count) {db.SQL_ROLLUP_FROM_TRANSACTIONS}")
+        conn.commit()
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+def heaviest_users(path: str, limit: int = 10) -> List[int]:
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT user_id FROM transactions GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT ?", (limit,))]
+    finally:
+        conn.close()
@@ -0,0 +1,76 @@
+# budgets.py
+"""
+Месячные лимиты расходов по категориям и траты с начала месяца в памяти процесса.
+
+Лимиты пользователя читаются из таблицы budgets один раз и лежат в LRU вместе с
+тратами текущего месяца по категориям. Траты засеваются одним агрегатным запросом
+при первой проверке (см. db.get_budget_usage), дальше add_transaction и
+delete_transaction_by_id правят их на месте, поэтому проверка бюджета после записи
+расхода обходится без запросов. Смена месяца - новый засев; засев, во время которого
+у пользователя менялись данные, не сохраняется (версия пользователя).
+"""
+from typing import Dict, Optional
+
+import config
+from cache import LRUCache, VersionMap
+
+class _UserBudgets:
+    __slots__ = ('limits', 'month', 'spent')
+
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = limits # категория -> лимит в копейках
+        self.month: Optional[str] = None # 'YYYY-MM', за который засеяны траты
+        self.spent: Dict[str, int] = {}
+
+_cache = LRUCache(config.BUDGET_CACHE_SIZE, name="budgets")
+# Меняется при каждом изменении трат пользователя; помнит только недавно менявшихся (см. cache.VersionMap)
+_versions = VersionMap(config.BUDGET_CACHE_SIZE, name="budget_versions")
+
+def version(user_id: int) -> int:
+    return _versions.get(user_id)
+
+def get_limits(user_id: int) -> Optional[Dict[str, int]]:
+    """Лимиты пользователя или None, если они еще не загружены (пустой словарь - лимитов нет)."""
+    entry = _cache.get(user_id)
+    return entry.limits if entry is not None else None
+
+def put_limits(user_id: int, limits: Dict[str, int]):
+    entry = _cache.peek(user_id)
+    if entry is None: _cache.put(user_id, _UserBudgets(dict(limits)))
+    else: entry.limits = dict(limits)
+
+def forget_limits(user_id: int):
+    """Сбрасывает пользователя целиком: после изменения таблицы budgets лимиты перечитываются."""
+    _cache.pop(user_id)
+
+def get_spent(user_id: int, month: str) -> Optional[Dict[str, int]]:
+    """Траты по категориям за month или None, если они не засеяны."""
+    entry = _cache.peek(user_id)
+    if entry is None or entry.month != month: return None
+    return entry.spent
+
+def seed(user_id: int, month: str, spent: Dict[str, int], data_version: int):
+    if version(user_id) != data_version: return
+    entry = _cache.peek(user_id)
+    if entry is None: return
+    entry.month, entry.spent = month, dict(spent)
+
+def record(user_id: int, transaction_type: str, category: str, amount: int, created_at: str):
+    """
+    Учитывает добавленный (amount > 0) или удаленный (amount < 0) расход с временем created_at
+    ('YYYY-MM-DD HH:MM:SS'). Вызывается после commit.
+    """
+    if transaction_type != 'expense': return
+    _versions.bump(user_id)
+    entry = _cache.peek(user_id)
+    if entry is None or entry.month != created_at[:7]: return
+    entry.spent[category] = entry.spent.get(category, 0) + amount
+
+def invalidate_spent(user_id: int):
+    """Массовые изменения (импорт): траты будут засеяны заново при следующей проверке."""
+    _versions.bump(user_id)
+    entry = _cache.peek(user_id)
+    if entry is not None: entry.month, entry.spent = None, {}
+
+def stats() -> Dict[str, object]:
+    return _cache.stats()
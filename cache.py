@@ -0,0 +1,94 @@
+# cache.py
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+class LRUCache:
+    """
+    Ограниченный по числу записей LRU-кэш в памяти процесса.
+    Считает попадания, промахи и вытеснения для метрик.
+    on_evict(key, value) вызывается для записей, вытесненных по размеру.
+    """
+
+    def __init__(self, maxsize: int, name: str = "cache", on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        self.maxsize = max(0, maxsize)
+        self.name = name
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self._data.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Значение без учета в счетчиках и без изменения порядка вытеснения."""
+        return self._data.get(key, default)
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize == 0: return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            evicted_key, evicted_value = self._data.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict: self.on_evict(evicted_key, evicted_value)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class VersionMap:
+    """
+    Версии данных по ключу для проверки "не изменилось ли во время вычисления", в ограниченной памяти.
+    Изменение ключа дает ему следующее значение общего счетчика; помнятся версии только maxsize ключей,
+    менявшихся последними. Версия остальных ключей - наибольшая из вытесненных: она не меньше любой версии,
+    запомненной до изменения, поэтому изменение во время вычисления видно всегда. Вытеснение может
+    лишь помешать сохранить в кэш свежий результат, но не дает сохранить устаревший.
+    """
+
+    def __init__(self, maxsize: int, name: str = "versions"):
+        self._stamps = LRUCache(max(1, maxsize), name=name, on_evict=self._evicted)
+        self._counter = 0
+        self._floor = 0
+
+    def _evicted(self, key: Hashable, stamp: int):
+        self._floor = max(self._floor, stamp)
+
+    def get(self, key: Hashable) -> int:
+        return self._stamps.peek(key, self._floor)
+
+    def bump(self, key: Hashable):
+        self._counter += 1
+        self._stamps.put(key, self._counter)
+
+    def __len__(self) -> int:
+        return len(self._stamps)
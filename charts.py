@@ -0,0 +1,142 @@
+# charts.py
+"""
+Графики к отчетам: расходы по категориям и расходы по дням за период.
+
+Рисует matplotlib (необязательная зависимость) в отдельных процессах ProcessPoolExecutor,
+чтобы отрисовка не останавливала цикл событий. Готовый PNG кэшируется по хэшу данных графика,
+а file_id, который Telegram вернул при первой отправке, - по тому же хэшу: повторный запрос
+того же графика уходит ссылкой на уже загруженный файл, без повторной загрузки байтов.
+
+Модуль импортируется и в процессах отрисовки, поэтому не тянет за собой aiogram и db.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import io
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import config
+from cache import LRUCache
+
+AVAILABLE = importlib.util.find_spec("matplotlib") is not None
+OTHER_LABEL = "Прочее" # Мелкие категории сверх CHART_MAX_CATEGORIES
+
+_executor: Optional[ProcessPoolExecutor] = None
+_png_cache = LRUCache(config.CHART_CACHE_SIZE, name="chart_png")
+_file_id_cache = LRUCache(config.CHART_FILE_ID_CACHE_SIZE, name="chart_file_ids")
+# Графики, которые сейчас рисуются: одинаковые запросы ждут одну отрисовку
+_rendering: Dict[str, asyncio.Future] = {}
+
+def enabled() -> bool:
+    return config.REPORT_CHARTS and AVAILABLE
+
+def _payload(title: str, details: Dict[str, int], daily: List[Tuple[str, int]], start_date: datetime, end_date: datetime) -> Dict[str, Any]:
+    """Данные графика: категории (крупнейшие + "Прочее") и расходы за каждый день периода, в копейках."""
+    top = sorted(details.items(), key=lambda item: item[1], reverse=True)
+    if len(top) > config.CHART_MAX_CATEGORIES:
+        rest = sum(amount for _, amount in top[config.CHART_MAX_CATEGORIES - 1:])
+        top = top[:config.CHART_MAX_CATEGORIES - 1] + [(OTHER_LABEL, rest)]
+    # Дни без расходов тоже на графике; будущие дни текущего месяца не показываем
+    by_day = dict(daily)
+    first = start_date.date()
+    last = min((end_date - timedelta(seconds=1)).date(), datetime.now(end_date.tzinfo).date())
+    days = []
+    day = first
+    while day <= last:
+        key = day.isoformat()
+        days.append((key, by_day.get(key, 0)))
+        day += timedelta(days=1)
+    return {"title": title, "categories": top, "days": days}
+
+def chart_key(payload: Dict[str, Any]) -> str:
+    raw = json.dumps(payload, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def render_png(payload: Dict[str, Any]) -> bytes:
+    """Рисует график (выполняется в процессе пула)."""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+
+    labels = [name for name, _ in payload["categories"]]
+    values = [amount / 100 for _, amount in payload["categories"]]
+    days = [date.fromisoformat(day) for day, _ in payload["days"]]
+    daily = [amount / 100 for _, amount in payload["days"]]
+
+    fig, (ax_categories, ax_daily) = plt.subplots(1, 2, figsize=(11, 4.8), gridspec_kw={"width_ratios": [1, 1.4]})
+    try:
+        fig.suptitle(f"Расходы: {payload['title']}")
+        if len(labels) <= 5:
+            ax_categories.pie(values, labels=labels, autopct="%1.0f%%", startangle=90, counterclock=False)
+            ax_categories.axis("equal")
+        else:
+            # Много категорий: горизонтальные столбцы читаются лучше круговой диаграммы
+            ax_categories.barh(labels[::-1], values[::-1])
+            ax_categories.set_xlabel("₽")
+        ax_categories.set_title("По категориям")
+        if days:
+            ax_daily.plot(days, daily, marker="o" if len(days) <= 31 else None, linewidth=1.5)
+            ax_daily.fill_between(days, daily, alpha=0.15)
+            fig.autofmt_xdate()
+        ax_daily.set_title("По дням")
+        ax_daily.set_ylabel("₽")
+        ax_daily.grid(alpha=0.3)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=100, bbox_inches="tight")
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn: дочерний процесс не наследует потоки aiosqlite и состояние цикла событий
+        _executor = ProcessPoolExecutor(max_workers=max(1, config.CHART_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+async def get_chart(title: str, details: Dict[str, int], daily: List[Tuple[str, int]], start_date: datetime, end_date: datetime) -> Tuple[str, Union[str, bytes]]:
+    """
+    Возвращает (ключ графика, file_id или PNG). file_id - если такой график уже отправлялся,
+    PNG - из кэша или после отрисовки в пуле процессов.
+    """
+    payload = _payload(title, details, daily, start_date, end_date)
+    key = chart_key(payload)
+    file_id = _file_id_cache.get(key)
+    if file_id is not None: return key, file_id
+    png = _png_cache.get(key)
+    if png is not None: return key, png
+    future = _rendering.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = _rendering[key] = loop.run_in_executor(_get_executor(), render_png, payload)
+        try:
+            png = await future
+            _png_cache.put(key, png)
+        finally:
+            _rendering.pop(key, None)
+        return key, png
+    return key, await asyncio.shield(future)
+
+def remember_sent(key: str, sent: Any):
+    """Запоминает file_id отправленного графика (sent - Message); None (отправка не удалась) - забывает прежний."""
+    photo = getattr(sent, 'photo', None)
+    if photo: _file_id_cache.put(key, photo[-1].file_id)
+    else: _file_id_cache.pop(key)
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def stats() -> Dict[str, Any]:
+    png, file_ids = _png_cache.stats(), _file_id_cache.stats()
+    return {
+        "png_cached": png["size"], "png_hits": png["hits"], "png_misses": png["misses"],
+        "file_ids_cached": file_ids["size"], "file_id_hits": file_ids["hits"],
+        "rendering": len(_rendering),
+    }
@@ -7,10 +7,120 @@ load_dotenv() # Загружает переменные из .env файла
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
+# --- Режим получения апдейтов ---
+# 'polling' - long polling (по умолчанию), 'webhook' - aiohttp-сервер с вебхуком
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0') # Адрес, на котором слушает сервер
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Публичный URL вебхука (https://example.com/webhook). Пусто - set_webhook не вызывается (локальная отладка)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '') # Сверяется с X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '100')) # Макс. одновременно обрабатываемых апдейтов
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30')) # Сек. на дообработку апдейтов при остановке
+
 # --- Настройки SQLite ---
 # Получаем имя файла из .env или используем значение по умолчанию
 SQLITE_DB_FILE = os.getenv('SQLITE_DB_FILE', 'finance_bot.db')
 logging.info(f"Using SQLite database file: {SQLITE_DB_FILE}")
+# Шардирование: пользователи распределяются по SQLITE_SHARDS файлам по хэшу user_id (db.shard_index),
+# у каждого файла своя блокировка записи. Файлы - finance_bot.shard0of4.db и т.д.; разложить готовую БД: python -m tools.reshard
+SQLITE_SHARDS = int(os.getenv('SQLITE_SHARDS', '1')) # 1 - один файл SQLITE_DB_FILE
+
+# --- Write-behind очередь для add_transaction (групповой commit) ---
+# При включении вставки копятся в очереди и сбрасываются одним executemany/commit
+DB_WRITE_BEHIND = os.getenv('DB_WRITE_BEHIND', '0').lower() in ('1', 'true', 'yes')
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '100')) # Макс. строк в одном commit
+DB_WRITE_FLUSH_MS = float(os.getenv('DB_WRITE_FLUSH_MS', '5')) # Макс. ожидание добора пачки, мс
+
+# Размер порции для длинных миграций данных (строк на одну транзакцию)
+DB_MIGRATION_CHUNK_ROWS = int(os.getenv('DB_MIGRATION_CHUNK_ROWS', '50000'))
+# Фоновые дозаполнения после старта: пользователей на порцию и пауза между порциями
+DB_BACKFILL_USERS_PER_CHUNK = int(os.getenv('DB_BACKFILL_USERS_PER_CHUNK', '500'))
+DB_BACKFILL_PAUSE_MS = float(os.getenv('DB_BACKFILL_PAUSE_MS', '20'))
+
+# --- Режим WAL и пул соединений только для чтения ---
+# В режиме WAL отчеты читают через отдельные соединения и не блокируют запись
+SQLITE_WAL_MODE = os.getenv('SQLITE_WAL_MODE', '0').lower() in ('1', 'true', 'yes')
+SQLITE_READ_POOL_SIZE = int(os.getenv('SQLITE_READ_POOL_SIZE', '4')) # Кол-во read-only соединений (0 - без пула)
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL') # NORMAL безопасен для WAL и не делает fsync на каждый commit
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', '-16000')) # Отрицательное значение - размер в КиБ
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(128 * 1024 * 1024))) # Байт, 0 - отключить mmap
+
+# --- Параллельная обработка апдейтов ---
+# Апдейты разных пользователей обрабатываются параллельно, одного пользователя - строго по очереди
+USER_SERIAL_UPDATES = os.getenv('USER_SERIAL_UPDATES', '1').lower() in ('1', 'true', 'yes')
+USER_QUEUE_WARN_DEPTH = int(os.getenv('USER_QUEUE_WARN_DEPTH', '5')) # Предупреждать, если у пользователя столько апдейтов в очереди
+
+# --- Хранилище состояний FSM ---
+# 'sqlite' - состояния переживают перезапуск (таблица fsm_storage), 'memory' - стандартный MemoryStorage
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite').lower()
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000')) # Макс. чатов в памяти
+FSM_CACHE_TTL = int(os.getenv('FSM_CACHE_TTL', '1800')) # Сек. простоя, после которых запись выгружается из памяти
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', str(7 * 24 * 3600))) # Сек. простоя, после которых брошенный сценарий удаляется (0 - никогда)
+FSM_FLUSH_MS = float(os.getenv('FSM_FLUSH_MS', '50')) # Окно накопления изменений перед записью пачкой, мс
+FSM_SWEEP_INTERVAL = int(os.getenv('FSM_SWEEP_INTERVAL', '300')) # Период очистки по TTL, сек
+
+# --- История записей (/recent) ---
+RECENT_PAGE_SIZE = int(os.getenv('RECENT_PAGE_SIZE', '10')) # Записей на одной странице
+
+# --- Динамика по месяцам (/trend) ---
+TREND_DEFAULT_MONTHS = int(os.getenv('TREND_DEFAULT_MONTHS', '6')) # Месяцев, если в команде не указано
+TREND_MAX_MONTHS = int(os.getenv('TREND_MAX_MONTHS', '24'))
+TREND_TOP_CATEGORIES = int(os.getenv('TREND_TOP_CATEGORIES', '3')) # Крупнейших категорий расходов в строке месяца
+
+# --- Бюджеты по категориям (/budgets) ---
+BUDGET_WARN_PERCENT = int(os.getenv('BUDGET_WARN_PERCENT', '80')) # Предупреждать, когда израсходовано столько % лимита
+
+# --- Регулярные записи (/recurring, scheduler.py) ---
+RECURRING_MAX_PER_USER = int(os.getenv('RECURRING_MAX_PER_USER', '50'))
+RECURRING_BATCH_SIZE = int(os.getenv('RECURRING_BATCH_SIZE', '1000')) # Транзакций в одном commit
+RECURRING_MAX_CATCHUP = int(os.getenv('RECURRING_MAX_CATCHUP', '400')) # Пропущенных за простой сроков одного правила, которые досоздаются (последние; более старые пропускаются)
+RECURRING_RETRY_SECONDS = float(os.getenv('RECURRING_RETRY_SECONDS', '60')) # Пауза перед повтором после ошибки записи
+RECURRING_MAX_SLEEP = float(os.getenv('RECURRING_MAX_SLEEP', '300')) # Дольше не спим даже без сроков (перевод часов)
+
+# --- Импорт истории из CSV (/import) ---
+IMPORT_MAX_FILE_MB = int(os.getenv('IMPORT_MAX_FILE_MB', '20')) # Bot API не отдает файлы больше 20 МБ
+IMPORT_SPOOL_MB = int(os.getenv('IMPORT_SPOOL_MB', '2')) # Файл держится в памяти до этого размера, дальше - во временном файле
+IMPORT_BATCH_ROWS = int(os.getenv('IMPORT_BATCH_ROWS', '20000')) # Строк в одной транзакции вставки
+IMPORT_YIELD_ROWS = int(os.getenv('IMPORT_YIELD_ROWS', '1000')) # Через столько разобранных строк отдаем управление циклу событий
+
+# --- Экспорт истории в CSV (/export) ---
+EXPORT_PAGE_ROWS = int(os.getenv('EXPORT_PAGE_ROWS', '2000')) # Строк на одну страницу keyset-выборки
+EXPORT_SPOOL_MB = int(os.getenv('EXPORT_SPOOL_MB', '2')) # Файл держится в памяти до этого размера, дальше - во временном файле
+EXPORT_MAX_FILE_MB = int(os.getenv('EXPORT_MAX_FILE_MB', '50')) # Bot API не принимает документы больше 50 МБ
+
+# --- Графики к отчетам (charts.py, нужен matplotlib) ---
+REPORT_CHARTS = os.getenv('REPORT_CHARTS', '0').lower() in ('1', 'true', 'yes') # Прикладывать к отчетам график расходов
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2')) # Процессов отрисовки
+CHART_MAX_CATEGORIES = int(os.getenv('CHART_MAX_CATEGORIES', '8')) # Категорий на графике, остальные - в "Прочее"
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', '200')) # Готовых PNG в памяти (десятки КБ каждый)
+CHART_FILE_ID_CACHE_SIZE = int(os.getenv('CHART_FILE_ID_CACHE_SIZE', '10000')) # file_id уже загруженных в Telegram графиков
+
+# --- Кэши в памяти процесса ---
+CATEGORY_CACHE_SIZE = int(os.getenv('CATEGORY_CACHE_SIZE', '10000')) # Записей (пользователь, тип); 0 - без кэша
+REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', '5000')) # Отчетов (пользователь, период) с готовым текстом; 0 - без кэша
+BUDGET_CACHE_SIZE = int(os.getenv('BUDGET_CACHE_SIZE', '10000')) # Пользователей с лимитами и тратами месяца в памяти
+CATEGORY_KB_CACHE_SIZE = int(os.getenv('CATEGORY_KB_CACHE_SIZE', '5000')) # Готовых клавиатур с польз. категориями
+
+# --- Очередь исходящих сообщений (outbox.py) ---
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '30')) # Запросов в секунду на всего бота (лимит Telegram ~30/с; 0 - без лимита)
+OUTBOX_GLOBAL_BURST = float(os.getenv('OUTBOX_GLOBAL_BURST', '30'))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1')) # Запросов в секунду в один чат (Telegram рекомендует не больше 1/с)
+OUTBOX_CHAT_BURST = float(os.getenv('OUTBOX_CHAT_BURST', '3')) # Короткий всплеск: правка клавиатуры + ответ уходят сразу
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', '5')) # Повторов при RetryAfter и сетевых ошибках
+OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', '0.5')) # Первая пауза при сетевой ошибке, сек (дальше удваивается)
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', '30'))
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv('OUTBOX_DRAIN_TIMEOUT', '10')) # Сек. на отправку очереди при остановке
+OUTBOX_CLEARED_CACHE_SIZE = int(os.getenv('OUTBOX_CLEARED_CACHE_SIZE', '10000')) # Сообщений, у которых помним снятую клавиатуру
+
+# --- Метрики (формат Prometheus, см. metrics.py) ---
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1') # По умолчанию эндпоинт доступен только локально
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9101')) # 0 - без HTTP-эндпоинта
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+METRICS_DUMP_FILE = os.getenv('METRICS_DUMP_FILE', 'metrics.prom') # Снимок метрик по SIGUSR1
+METRICS_LOOP_LAG_INTERVAL = float(os.getenv('METRICS_LOOP_LAG_INTERVAL', '0.5')) # Период замера задержки цикла событий, сек (0 - не замерять)
 
 # --- Категории (остаются без изменений) ---
 EXPENSE_CATEGORIES = ["Еда", "Транспорт", "Жилье", "Связь", "Развлечения", "Одежда", "Здоровье", "Другое"]
@@ -0,0 +1,48 @@
+# csv_format.py
+"""
+Формат CSV для импорта и экспорта истории: date,type,amount,category.
+Дата - 'YYYY-MM-DD HH:MM:SS' в UTC (как created_at в БД), сумма - '1234.56'.
+При импорте дополнительно принимаются даты 'ДД.ММ.ГГГГ[ ЧЧ:ММ[:СС]]' и типы по-русски.
+"""
+from datetime import datetime, timezone
+from typing import List, Optional
+from money import format_amount
+
+CSV_COLUMNS = ("date", "type", "amount", "category")
+DB_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S" # Формат created_at (CURRENT_TIMESTAMP)
+
+# Допустимые написания типа операции -> значение transaction_type
+TYPE_ALIASES = {
+    "expense": "expense", "расход": "expense",
+    "income": "income", "доход": "income",
+}
+
+_RU_DATE_FORMATS = ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y")
+
+def parse_datetime(text: str) -> Optional[str]:
+    """Приводит дату из CSV к формату created_at; None, если дату не удалось разобрать."""
+    text = (text or "").strip()
+    if not text: return None
+    try:
+        # Быстрый путь для ISO-дат (в т.ч. файлов, выгруженных самим ботом)
+        dt = datetime.fromisoformat(text)
+    except ValueError:
+        for fmt in _RU_DATE_FORMATS:
+            try: dt = datetime.strptime(text, fmt); break
+            except ValueError: continue
+        else:
+            return None
+    if dt.tzinfo is not None: dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.strftime(DB_DATETIME_FORMAT)
+
+def parse_type(text: str) -> Optional[str]:
+    """'expense'/'income' по написанию из CSV или None."""
+    return TYPE_ALIASES.get((text or "").strip().lower())
+
+def is_header(row) -> bool:
+    """Первая строка с названиями колонок (date,type,... или дата,тип,...)."""
+    return bool(row) and row[0].strip().lower().lstrip('﻿') in ("date", "дата")
+
+def format_row(created_at: str, transaction_type: str, amount: int, category: str) -> List[str]:
+    """Строка CSV для экспорта; читается обратно импортом без изменений."""
+    return [created_at, transaction_type, format_amount(amount), category]
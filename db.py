@@ -1,223 +1,1063 @@
 # db.py
 import aiosqlite
+import asyncio
 import logging
+import time
+import zlib
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Union, List, Tuple, Dict # Используем typing для совместимости
+from typing import AsyncIterator, Callable, Iterable, Optional, Set, TypeVar, Union, List, Tuple, Dict # Используем typing для совместимости
+import budgets
 import config
+import metrics
+import migrations
+import report_cache
+from cache import LRUCache, VersionMap
 
-# Глобальная переменная для соединения с БД SQLite
+T = TypeVar('T')
+
+# Счетчики для наблюдения за групповым commit (по всем шардам)
+write_behind_stats: Dict[str, float] = {
+    "batches": 0,
+    "rows": 0,
+    "errors": 0,
+    "last_batch_size": 0,
+    "max_batch_size": 0,
+    "flush_time_total_ms": 0.0,
+    "last_flush_time_ms": 0.0,
+    "max_flush_time_ms": 0.0,
+}
+
+@dataclass(frozen=True)
+class Category:
+    """Строка таблицы categories: в callback_data кнопок идет id, пользователю показывается name."""
+    id: int
+    category_type: str
+    name: str
+
+# Кэш пользовательских категорий: (user_id, category_type) -> кортеж Category (только включенные)
+_category_cache = LRUCache(config.CATEGORY_CACHE_SIZE, name="user_categories")
+# Версия списка категорий (user_id, category_type); меняется при каждом добавлении/удалении
+_category_versions = VersionMap(config.CATEGORY_CACHE_SIZE, name="user_category_versions")
+
+# created_at задается явно: точное время записи нужно для сброса кэша отчетов за период
+SQL_INSERT_TRANSACTION = "INSERT INTO transactions (user_id, transaction_type, amount, category_id, created_at) VALUES (?, ?, ?, ?, ?)"
+
+# --- Шарды: файлы БД, между которыми пользователи распределены по хэшу user_id ---
+
+class _Shard:
+    """Один файл БД: пишущее соединение, пул чтения и очередь write-behind. У каждого шарда своя блокировка записи."""
+    __slots__ = ('index', 'path', 'conn', 'write_lock', 'read_pool', 'read_conns', 'write_queue', 'write_task', 'standard_categories', 'standard_by_id')
+
+    def __init__(self, index: int, path: str):
+        self.index = index
+        self.path = path
+        self.conn: Optional[aiosqlite.Connection] = None
+        # Транзакция на conn одна на всех писателей: от первого execute до commit/rollback ее держит один писатель (см. _writer)
+        self.write_lock = asyncio.Lock()
+        # Пул read-only соединений (только в режиме WAL, см. config.SQLITE_WAL_MODE)
+        self.read_pool: Optional[asyncio.Queue] = None
+        self.read_conns: List[aiosqlite.Connection] = []
+        # Write-behind: элемент очереди - (параметры INSERT, future с результатом) или None как сигнал остановки
+        self.write_queue: Optional[asyncio.Queue] = None
+        self.write_task: Optional[asyncio.Task] = None
+        # Стандартные категории файла (id у каждого файла свои): по типу в порядке config и по id
+        self.standard_categories: Dict[str, Tuple[Category, ...]] = {}
+        self.standard_by_id: Dict[int, Category] = {}
+
+# Открытые шарды; при config.SQLITE_SHARDS = 1 - один шард с файлом config.SQLITE_DB_FILE
+_shards: List[_Shard] = []
+# Соединение шарда 0. На нем же хранилище FSM: его ключи строит aiogram, и пишется оно пачками, а не по пользователю
 db_conn: Optional[aiosqlite.Connection] = None
 
+def shard_index(user_id: int, shards: Optional[int] = None) -> int:
+    """
+    Номер шарда пользователя. crc32 от десятичной записи user_id не зависит от процесса и версии Python,
+    поэтому и бот, и tools/reshard.py всегда относят пользователя к одному файлу.
+    """
+    shards = shards or config.SQLITE_SHARDS
+    if shards <= 1: return 0
+    return zlib.crc32(str(user_id).encode('ascii')) % shards
+
+def shard_path(index: int, shards: Optional[int] = None, base: Optional[str] = None) -> str:
+    """
+    Файл шарда: finance_bot.db -> finance_bot.shard0of4.db. Число шардов в имени не дает открыть
+    файлы, разложенные под другое SQLITE_SHARDS, как будто в них лежат все пользователи.
+    """
+    shards = shards or config.SQLITE_SHARDS
+    base = base or config.SQLITE_DB_FILE
+    if shards <= 1 or base == ':memory:': return base
+    path = Path(base)
+    return str(path.with_name(f"{path.stem}.shard{index}of{shards}{path.suffix}"))
+
+def _shard_for(user_id: int) -> Optional[_Shard]:
+    """Шард пользователя или None, если БД не подключена."""
+    if not _shards: return None
+    return _shards[shard_index(user_id, len(_shards))]
+
+def _group_by_shard(items: Iterable[T], user_id_of: Callable[[T], int]) -> Dict[int, List[T]]:
+    """Раскладывает элементы по номерам шардов их пользователей, сохраняя порядок."""
+    groups: Dict[int, List[T]] = {}
+    for item in items:
+        groups.setdefault(shard_index(user_id_of(item), len(_shards)), []).append(item)
+    return groups
+
 async def connect_db():
     global db_conn
+    count = max(1, config.SQLITE_SHARDS)
     try:
-        db_conn = await aiosqlite.connect(config.SQLITE_DB_FILE)
-        db_conn.row_factory = aiosqlite.Row
-        # Включаем поддержку внешних ключей (понадобится для каскадного удаления, если решим добавить)
-        await db_conn.execute("PRAGMA foreign_keys = ON")
-        logging.info(f"Successfully connected to SQLite database: {config.SQLITE_DB_FILE}")
-        await init_db()
+        for index in range(count):
+            shard = _Shard(index, shard_path(index, count))
+            _shards.append(shard)
+            await _connect_shard(shard)
+        db_conn = _shards[0].conn
+        if count > 1:
+            logging.info(f"SQLite sharded mode: {count} database files")
+            if config.SQLITE_DB_FILE != ':memory:' and Path(config.SQLITE_DB_FILE).exists():
+                logging.warning(f"{config.SQLITE_DB_FILE} exists, but SQLITE_SHARDS={count}: its data is not used. Split it with 'python -m tools.reshard'.")
+        if config.DB_WRITE_BEHIND:
+            start_write_behind()
         return True
     except Exception as e:
         logging.error(f"Error connecting to SQLite database: {e}")
-        db_conn = None
+        await close_db()
         return False
 
+async def _connect_shard(shard: _Shard):
+    shard.conn = await aiosqlite.connect(shard.path)
+    shard.conn.row_factory = aiosqlite.Row
+    # Включаем поддержку внешних ключей (понадобится для каскадного удаления, если решим добавить)
+    await shard.conn.execute("PRAGMA foreign_keys = ON")
+    if config.SQLITE_WAL_MODE:
+        await _apply_wal_pragmas(shard.conn)
+    logging.info(f"Successfully connected to SQLite database: {shard.path}")
+    if not await init_db(shard):
+        raise RuntimeError(f"schema migration failed for {shard.path}")
+    await _load_standard_categories(shard)
+    if config.SQLITE_WAL_MODE:
+        await _open_read_pool(shard)
+
 async def close_db():
     global db_conn
-    if db_conn:
+    # Сначала дописываем все, что осталось в очередях, и останавливаем фоновые миграции
+    await drain_write_queue()
+    await migrations.stop_backfills()
+    for shard in _shards:
+        await _close_read_pool(shard)
+        if shard.conn:
+            try:
+                await shard.conn.close()
+                logging.info(f"SQLite database connection closed: {shard.path}")
+            except Exception as e:
+                logging.error(f"Error closing SQLite database connection {shard.path}: {e}")
+            shard.conn = None
+    _shards.clear()
+    db_conn = None
+
+async def _apply_tuning_pragmas(conn: aiosqlite.Connection):
+    await conn.execute(f"PRAGMA cache_size = {int(config.SQLITE_CACHE_SIZE)}")
+    await conn.execute(f"PRAGMA mmap_size = {int(config.SQLITE_MMAP_SIZE)}")
+
+async def _apply_wal_pragmas(conn: aiosqlite.Connection):
+    """Переводит БД в режим WAL и настраивает пишущее соединение."""
+    async with conn.execute("PRAGMA journal_mode = WAL") as cursor:
+        row = await cursor.fetchone()
+    if row and str(row[0]).lower() != 'wal':
+        logging.warning(f"SQLite refused WAL mode, journal_mode is '{row[0]}'")
+    synchronous = config.SQLITE_SYNCHRONOUS.upper()
+    if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        logging.warning(f"Unknown SQLITE_SYNCHRONOUS value '{config.SQLITE_SYNCHRONOUS}', using NORMAL")
+        synchronous = 'NORMAL'
+    await conn.execute(f"PRAGMA synchronous = {synchronous}")
+    await _apply_tuning_pragmas(conn)
+    logging.info(f"SQLite WAL mode enabled (synchronous={synchronous}, cache_size={config.SQLITE_CACHE_SIZE}, mmap_size={config.SQLITE_MMAP_SIZE})")
+
+async def _open_read_pool(shard: _Shard):
+    """Открывает пул read-only соединений шарда. Работает только для файловой БД в режиме WAL."""
+    size = config.SQLITE_READ_POOL_SIZE
+    if size <= 0 or shard.path == ':memory:': return
+    uri = Path(shard.path).resolve().as_uri() + "?mode=ro"
+    pool: asyncio.Queue = asyncio.Queue()
+    conns: List[aiosqlite.Connection] = []
+    try:
+        for _ in range(size):
+            conn = await aiosqlite.connect(uri, uri=True)
+            conn.row_factory = aiosqlite.Row
+            await _apply_tuning_pragmas(conn)
+            conns.append(conn)
+            pool.put_nowait(conn)
+    except Exception as e:
+        logging.error(f"Error opening SQLite read pool for {shard.path}, reads will use the main connection: {e}")
+        for conn in conns: await conn.close()
+        return
+    shard.read_pool, shard.read_conns = pool, conns
+    logging.info(f"SQLite read pool opened: {size} read-only connections to {shard.path}.")
+
+async def _close_read_pool(shard: _Shard):
+    conns = shard.read_conns
+    shard.read_pool, shard.read_conns = None, []
+    for conn in conns:
+        try: await conn.close()
+        except Exception as e: logging.error(f"Error closing SQLite read connection: {e}")
+
+@asynccontextmanager
+async def _reader(shard: _Shard):
+    """
+    Выдает соединение шарда для чтения: из пула, если он открыт, иначе основное.
+    Читать через execute_fetchall: на общем соединении SELECT, оставшийся открытым между
+    execute и fetch, приводит к "cannot commit transaction - SQL statements in progress" у параллельной записи.
+    """
+    if shard.read_pool is None:
+        yield shard.conn
+        return
+    conn = await shard.read_pool.get()
+    try:
+        yield conn
+    finally:
+        shard.read_pool.put_nowait(conn)
+
+@asynccontextmanager
+async def _writer(shard: _Shard):
+    """
+    Выдает пишущее соединение шарда под его блокировкой записи; commit делается внутри блока.
+    Без блокировки commit или rollback одного писателя захватил бы чужие, еще не законченные изменения
+    на том же соединении. При исключении изменения блока откатываются, пока блокировка еще у нас.
+    """
+    async with shard.write_lock:
         try:
-            await db_conn.close()
-            logging.info("SQLite database connection closed.")
-            db_conn = None
-        except Exception as e:
-            logging.error(f"Error closing SQLite database connection: {e}")
+            yield shard.conn
+        except BaseException:
+            try: await shard.conn.rollback()
+            except Exception: pass
+            raise
 
-async def init_db():
-    """Проверяет/создает таблицы transactions и user_categories."""
-    global db_conn
-    if not db_conn:
+def all_connections() -> List[aiosqlite.Connection]:
+    """Все открытые соединения (пишущие и пулов чтения) всех шардов - для трассировки в bench."""
+    return [conn for shard in _shards for conn in (shard.conn, *shard.read_conns) if conn]
+
+async def init_db(shard: _Shard) -> bool:
+    """Приводит схему файла шарда к актуальной версии (см. migrations.py)."""
+    if not shard.conn:
         logging.error("Cannot initialize DB: No active connection.")
-        return
+        return False
+    try:
+        await migrations.migrate(shard.conn, shard.index, shard.write_lock)
+        return True
+    except Exception as e:
+        logging.error(f"Error during SQLite schema migration of {shard.path}: {e}")
+        return False
+
+async def _load_standard_categories(shard: _Shard):
+    """Сверяет стандартные категории файла с config и держит их в памяти: выбор стандартной категории не читает БД."""
+    async with _writer(shard) as conn:
+        await migrations.sync_standard_categories(conn)
+        await conn.commit()
+    rows = await shard.conn.execute_fetchall("SELECT id, category_type, name FROM categories WHERE user_id = 0 AND is_active = 1")
+    by_name = {(row['category_type'], row['name']): Category(row['id'], row['category_type'], row['name']) for row in rows}
+    shard.standard_categories = {
+        category_type: tuple(by_name[(category_type, name)] for name in names if (category_type, name) in by_name)
+        for category_type, names in (('expense', config.EXPENSE_CATEGORIES), ('income', config.INCOME_CATEGORIES))
+    }
+    shard.standard_by_id = {category.id: category for category in by_name.values()}
+
+# --- Write-behind: групповой commit вставок транзакций (своя очередь у каждого шарда) ---
+
+def start_write_behind():
+    """Запускает для каждого шарда фоновую задачу, которая пачками сбрасывает вставки из очереди."""
+    for shard in _shards:
+        if shard.write_task and not shard.write_task.done(): continue
+        shard.write_queue = asyncio.Queue()
+        # Очередь передается задаче сразу: drain_write_queue может обнулить shard.write_queue раньше, чем задача запустится
+        shard.write_task = asyncio.create_task(_write_behind_worker(shard, shard.write_queue))
+    logging.info(f"Write-behind queue started (batch size {config.DB_WRITE_BATCH_SIZE}, flush {config.DB_WRITE_FLUSH_MS} ms, {len(_shards)} shard(s)).")
+
+async def drain_write_queue():
+    """Останавливает прием в очереди и ждет, пока все накопленные вставки будут записаны."""
+    tasks = []
+    for shard in _shards:
+        if not shard.write_task: continue
+        queue, task = shard.write_queue, shard.write_task
+        # Новые вызовы add_transaction с этого момента пишут напрямую
+        shard.write_queue, shard.write_task = None, None
+        await queue.put(None)
+        tasks.append(task)
+    if not tasks: return
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception): logging.error(f"Error draining write-behind queue: {result}")
+    logging.info("Write-behind queue drained.")
+
+async def _write_behind_worker(shard: _Shard, queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await queue.get()
+        if item is None: break
+        batch = [item]
+        # Добираем пачку: пока не достигнут лимит размера или не истекло окно ожидания
+        deadline = loop.time() + config.DB_WRITE_FLUSH_MS / 1000
+        while len(batch) < config.DB_WRITE_BATCH_SIZE:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0: break
+                try: item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError: break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        await _flush_write_batch(shard, batch)
+
+@metrics.timed_query
+async def _flush_write_batch(shard: _Shard, batch: List[Tuple[tuple, asyncio.Future]]):
+    """
+    Записывает пачку вставок одной транзакцией шарда и разрешает futures вызывающих.
+    Если пачка не записалась, строки пишутся по одной: ошибка в одной строке не отменяет остальные.
+    """
+    started = time.perf_counter()
+    try:
+        async with _writer(shard) as conn:
+            await conn.executemany(SQL_INSERT_TRANSACTION, [params for params, _ in batch])
+            await conn.commit()
+        results = [True] * len(batch)
+    except Exception as e:
+        logging.error(f"Error flushing write-behind batch of {len(batch)} transactions to {shard.path}, retrying row by row: {e}")
+        write_behind_stats["errors"] += 1
+        results = [await _insert_transaction_row(shard, params) for params, _ in batch]
+    # Только после своего commit (или отката): пачку не может закоммитить или откатить другой писатель
+    for (_, future), success in zip(batch, results):
+        if not future.done(): future.set_result(success)
+    size = sum(results)
+    if not size: return
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    write_behind_stats["batches"] += 1
+    write_behind_stats["rows"] += size
+    write_behind_stats["last_batch_size"] = size
+    write_behind_stats["max_batch_size"] = max(write_behind_stats["max_batch_size"], size)
+    write_behind_stats["flush_time_total_ms"] += elapsed_ms
+    write_behind_stats["last_flush_time_ms"] = elapsed_ms
+    write_behind_stats["max_flush_time_ms"] = max(write_behind_stats["max_flush_time_ms"], elapsed_ms)
+    logging.info(f"SQLite write-behind batch committed: {size} transactions in {elapsed_ms:.1f} ms (shard {shard.index})")
+
+async def _insert_transaction_row(shard: _Shard, params: tuple) -> bool:
+    try:
+        async with _writer(shard) as conn:
+            await conn.execute(SQL_INSERT_TRANSACTION, params)
+            await conn.commit()
+        return True
+    except Exception as e:
+        logging.error(f"Error adding transaction to SQLite for user {params[0]}: {e}")
+        return False
 
-    create_transactions_table = """
-    CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        transaction_type TEXT NOT NULL CHECK(transaction_type IN ('expense', 'income')),
-        amount REAL NOT NULL,
-        category TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """
-    create_transactions_index = """
-    CREATE INDEX IF NOT EXISTS idx_user_month ON transactions (user_id, created_at);
-    """
-    # --- НОВОЕ: Таблица для пользовательских категорий ---
-    create_user_categories_table = """
-    CREATE TABLE IF NOT EXISTS user_categories (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        category_type TEXT NOT NULL CHECK(category_type IN ('expense', 'income')),
-        category_name TEXT NOT NULL,
-        -- Уникальность имени категории для пользователя и типа
-        UNIQUE(user_id, category_type, category_name)
-    );
-    """
-    # --- КОНЕЦ НОВОГО ---
-
-    try:
-        async with db_conn.cursor() as cursor:
-            await cursor.execute(create_transactions_table)
-            logging.info("Table 'transactions' checked/created.")
-            await cursor.execute(create_transactions_index)
-            logging.info("Index 'idx_user_month' checked/created.")
-            # --- НОВОЕ: Создаем таблицу категорий ---
-            await cursor.execute(create_user_categories_table)
-            logging.info("Table 'user_categories' checked/created.")
-            # --- КОНЕЦ НОВОГО ---
-
-        await db_conn.commit()
-        logging.info("SQLite schema initialization committed.")
-    except Exception as e:
-        logging.error(f"Error during SQLite schema initialization: {e}")
-
-# --- Функции для транзакций (add_transaction, get_last_transaction..., delete_transaction..., get_period_summary..., get_recent...) ---
+def get_write_behind_stats() -> Dict[str, float]:
+    """Возвращает копию счетчиков write-behind со средними значениями."""
+    stats = dict(write_behind_stats)
+    batches = stats["batches"]
+    stats["avg_batch_size"] = stats["rows"] / batches if batches else 0.0
+    stats["avg_flush_time_ms"] = stats["flush_time_total_ms"] / batches if batches else 0.0
+    stats["queue_depth"] = sum(shard.write_queue.qsize() for shard in _shards if shard.write_queue)
+    return stats
+
+# --- Функции для транзакций (add_transaction, get_last_transaction..., delete_transaction..., get_period_summary..., get_transactions_page) ---
 # --- Оставляем их без изменений (код из предыдущего ответа) ---
-async def add_transaction(user_id: int, transaction_type: str, amount: float, category: str) -> bool:
-    global db_conn
-    if not db_conn: return False
-    sql = "INSERT INTO transactions (user_id, transaction_type, amount, category) VALUES (?, ?, ?, ?)"
+@metrics.timed_query
+async def add_transaction(user_id: int, transaction_type: str, amount: int, category: Category) -> bool:
+    """Добавляет транзакцию; amount - в копейках, category - из get_category/get_standard_categories."""
+    shard = _shard_for(user_id)
+    if shard is None: return False
+    created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    params = (user_id, transaction_type, amount, category.id, created_at)
+    if shard.write_queue is not None:
+        # Write-behind: ждем, пока фоновая задача запишет пачку с нашей строкой
+        future = asyncio.get_running_loop().create_future()
+        await shard.write_queue.put((params, future))
+        success = await future
+        if success:
+            report_cache.invalidate(user_id, created_at)
+            budgets.record(user_id, transaction_type, category.name, amount, created_at)
+        return success
     try:
-        await db_conn.execute(sql, (user_id, transaction_type, amount, category))
-        await db_conn.commit()
-        logging.info(f"SQLite Transaction added: User {user_id}, Type {transaction_type}, Amount {amount}, Cat {category}")
+        async with _writer(shard) as conn:
+            await conn.execute(SQL_INSERT_TRANSACTION, params)
+            await conn.commit()
+        # Сбрасываем после commit: отчет, посчитанный до него, либо удаляется здесь, либо не попадет в кэш по версии
+        report_cache.invalidate(user_id, created_at)
+        budgets.record(user_id, transaction_type, category.name, amount, created_at)
+        logging.info(f"SQLite Transaction added: User {user_id}, Type {transaction_type}, Amount {amount}, Cat {category.name}")
         return True
     except Exception as e:
         logging.error(f"Error adding transaction to SQLite for user {user_id}: {e}")
         return False
 
+@metrics.timed_query
+async def import_transactions(rows: List[Tuple[int, str, int, str, str]]) -> bool:
+    """
+    Вставляет пачку исторических записей (user_id, type, amount, category_id, created_at)
+    одним executemany и одним commit на шард. Записи одного пользователя (импорт всегда
+    от одного пользователя) либо записываются целиком, либо не записываются.
+    """
+    if not _shards: return False
+    if not rows: return True
+    success = True
+    for index, shard_rows in _group_by_shard(rows, lambda row: row[0]).items():
+        try:
+            async with _writer(_shards[index]) as conn:
+                await conn.executemany(SQL_INSERT_TRANSACTION, shard_rows)
+                await conn.commit()
+        except Exception as e:
+            logging.error(f"Error importing {len(shard_rows)} transactions into shard {index}: {e}")
+            success = False
+            continue
+        for user_id in {row[0] for row in shard_rows}:
+            report_cache.invalidate(user_id)
+            budgets.invalidate_spent(user_id)
+    return success
+
+@metrics.timed_query
 async def get_last_transaction_id_details(user_id: int) -> Optional[aiosqlite.Row]:
-    global db_conn
-    if not db_conn: return None
-    sql = "SELECT * FROM transactions WHERE user_id = ? ORDER BY id DESC LIMIT 1"
+    shard = _shard_for(user_id)
+    if shard is None: return None
+    sql = "SELECT t.*, c.name AS category FROM transactions t JOIN categories c ON c.id = t.category_id WHERE t.user_id = ? ORDER BY t.id DESC LIMIT 1"
     try:
-        async with db_conn.execute(sql, (user_id,)) as cursor:
-            return await cursor.fetchone()
+        async with _reader(shard) as conn:
+            rows = await conn.execute_fetchall(sql, (user_id,))
+        return rows[0] if rows else None
     except Exception as e:
         logging.error(f"Error getting last transaction for user {user_id}: {e}")
         return None
 
+@metrics.timed_query
 async def delete_transaction_by_id(transaction_id: int, user_id: int) -> bool:
-    global db_conn
-    if not db_conn: return False
-    sql = "DELETE FROM transactions WHERE id = ? AND user_id = ?"
+    shard = _shard_for(user_id)
+    if shard is None: return False
+    # RETURNING отдает удаленную запись: по времени сбрасываются только затронутые отчеты, сумма вычитается из трат бюджета
+    sql = "DELETE FROM transactions WHERE id = ? AND user_id = ? RETURNING created_at, transaction_type, amount, (SELECT name FROM categories WHERE id = category_id) AS category"
     try:
-        async with db_conn.execute(sql, (transaction_id, user_id)) as cursor:
-             if cursor.rowcount == 0:
-                  logging.warning(f"Transaction ID {transaction_id} not found or does not belong to user {user_id}.")
-                  return False
-        await db_conn.commit()
+        async with _writer(shard) as conn:
+            rows = await conn.execute_fetchall(sql, (transaction_id, user_id))
+            # commit и без удаленной строки: иначе транзакция DELETE осталась бы открытой на общем соединении
+            await conn.commit()
+        if not rows:
+             logging.warning(f"Transaction ID {transaction_id} not found or does not belong to user {user_id}.")
+             return False
+        row = rows[0]
+        report_cache.invalidate(user_id, row['created_at'])
+        budgets.record(user_id, row['transaction_type'], row['category'], -row['amount'], row['created_at'])
         logging.info(f"Transaction ID {transaction_id} deleted for user {user_id}.")
         return True
     except Exception as e:
         logging.error(f"Error deleting transaction ID {transaction_id} for user {user_id}: {e}")
         return False
 
-async def get_period_summary_with_details(user_id: int, start_date: datetime, end_date: datetime) -> Tuple[float, float, Dict[str, float]]:
-    global db_conn
-    if not db_conn: return 0.0, 0.0, {}
+def _with_category_names(grouped_sql: str) -> str:
+    """
+    Подставляет имена категорий в результат группировки по category_id: группировка идет по целым,
+    а имена присоединяются уже к сгруппированным строкам, по одному поиску по ключу categories на строку.
+    """
+    return f"SELECT g.*, c.name AS category FROM ({grouped_sql}) g JOIN categories c ON c.id = g.category_id"
+
+def _month_floor(dt: datetime) -> datetime:
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def _next_month(dt: datetime) -> datetime:
+    month_start = _month_floor(dt)
+    if month_start.month == 12: return month_start.replace(year=month_start.year + 1, month=1)
+    return month_start.replace(month=month_start.month + 1)
+
+async def _add_raw_period(conn: aiosqlite.Connection, user_id: int, start_str: str, end_str: str, totals: Dict[str, int], expense_details: Dict[str, int]):
+    """
+    Добавляет суммы по сырым строкам transactions за [start_str, end_str).
+    Один проход: итоги по типам и разбивка расходов считаются из группировки (тип, category_id),
+    а idx_user_period_cover покрывает запрос целиком, без обращений к самой таблице.
+    """
+    sql = _with_category_names("SELECT transaction_type, category_id, SUM(amount) as total FROM transactions WHERE user_id = ? AND created_at >= ? AND created_at < ? GROUP BY transaction_type, category_id")
+    for row in await conn.execute_fetchall(sql, (user_id, start_str, end_str)):
+        amount = int(row['total'] or 0)
+        totals[row['transaction_type']] = totals.get(row['transaction_type'], 0) + amount
+        if row['transaction_type'] == 'expense':
+            expense_details[row['category']] = expense_details.get(row['category'], 0) + amount
+
+async def _add_rollup_months(conn: aiosqlite.Connection, user_id: int, first_month: str, end_month: str, totals: Dict[str, int], expense_details: Dict[str, int]):
+    """Добавляет суммы из monthly_rollup за месяцы [first_month, end_month) в формате 'YYYY-MM'."""
+    sql = _with_category_names("SELECT transaction_type, category_id, SUM(total_amount) as total FROM monthly_rollup WHERE user_id = ? AND month >= ? AND month < ? GROUP BY transaction_type, category_id")
+    for row in await conn.execute_fetchall(sql, (user_id, first_month, end_month)):
+        amount = int(row['total'] or 0)
+        totals[row['transaction_type']] = totals.get(row['transaction_type'], 0) + amount
+        if row['transaction_type'] == 'expense':
+            expense_details[row['category']] = expense_details.get(row['category'], 0) + amount
+
+@metrics.timed_query
+async def get_period_summary_with_details(user_id: int, start_date: datetime, end_date: datetime) -> Tuple[int, int, Dict[str, int]]:
+    """
+    Суммы доходов/расходов и расходы по категориям за [start_date, end_date), в копейках.
+    Целые месяцы внутри периода берутся из monthly_rollup, неполные месяцы по краям - из transactions.
+    """
+    shard = _shard_for(user_id)
+    if shard is None: return 0, 0, {}
+    cached = report_cache.get_summary(user_id, start_date, end_date)
+    if cached is not None: return cached
+    data_version = report_cache.version(user_id)
     start_str = start_date.strftime('%Y-%m-%d %H:%M:%S')
     end_str = end_date.strftime('%Y-%m-%d %H:%M:%S')
-    sql_summary = "SELECT transaction_type, SUM(amount) as total_amount FROM transactions WHERE user_id = ? AND created_at >= ? AND created_at < ? GROUP BY transaction_type"
-    sql_expense_details = "SELECT category, SUM(amount) as category_total FROM transactions WHERE user_id = ? AND transaction_type = 'expense' AND created_at >= ? AND created_at < ? GROUP BY category ORDER BY category_total DESC"
-    total_income = 0.0
-    total_expense = 0.0
-    expense_details: Dict[str, float] = {}
-    try:
-        async with db_conn.execute(sql_summary, (user_id, start_str, end_str)) as cursor:
-            results = await cursor.fetchall()
-            for row in results:
-                if row['transaction_type'] == 'income': total_income = float(row['total_amount'] or 0.0)
-                elif row['transaction_type'] == 'expense': total_expense = float(row['total_amount'] or 0.0)
-        async with db_conn.execute(sql_expense_details, (user_id, start_str, end_str)) as cursor:
-            results = await cursor.fetchall()
-            for row in results: expense_details[row['category']] = float(row['category_total'] or 0.0)
+    # Границы целых месяцев внутри периода
+    first_full = start_date if start_date == _month_floor(start_date) else _next_month(start_date)
+    last_full_end = _month_floor(end_date)
+    totals: Dict[str, int] = {}
+    expense_details: Dict[str, int] = {}
+    try:
+        async with _reader(shard) as conn:
+            # Пока история пользователя не перенесена в rollup фоновой миграцией, читаем сырые строки
+            if first_full < last_full_end and migrations.rollup_ready(user_id, shard.index):
+                first_full_str = first_full.strftime('%Y-%m-%d %H:%M:%S')
+                last_full_end_str = last_full_end.strftime('%Y-%m-%d %H:%M:%S')
+                if start_str < first_full_str:
+                    await _add_raw_period(conn, user_id, start_str, first_full_str, totals, expense_details)
+                await _add_rollup_months(conn, user_id, first_full.strftime('%Y-%m'), last_full_end.strftime('%Y-%m'), totals, expense_details)
+                if last_full_end_str < end_str:
+                    await _add_raw_period(conn, user_id, last_full_end_str, end_str, totals, expense_details)
+            else:
+                await _add_raw_period(conn, user_id, start_str, end_str, totals, expense_details)
+        total_income = totals.get('income', 0)
+        total_expense = totals.get('expense', 0)
+        # Сохраняем прежний порядок: категории по убыванию суммы
+        expense_details = {cat: amount for cat, amount in sorted(expense_details.items(), key=lambda item: item[1], reverse=True) if amount}
         logging.info(f"Period summary for user {user_id} ({start_str} to {end_str}): Income={total_income}, Expense={total_expense}, Details fetched={len(expense_details)>0}")
-        return total_income, total_expense, expense_details
+        summary = (total_income, total_expense, expense_details)
+        report_cache.put_summary(user_id, start_date, end_date, summary, data_version)
+        return summary
     except Exception as e:
         logging.error(f"Error getting period summary from SQLite for user {user_id}: {e}")
-        return 0.0, 0.0, {}
+        return 0, 0, {}
 
-async def get_recent_transactions(user_id: int, limit: int = 10) -> List[aiosqlite.Row]:
-    global db_conn
-    if not db_conn: return []
-    sql = "SELECT created_at, transaction_type, amount, category FROM transactions WHERE user_id = ? ORDER BY id DESC LIMIT ?"
+@metrics.timed_query
+async def get_monthly_trend(user_id: int, start_date: datetime, end_date: datetime) -> Dict[str, Tuple[int, int, Dict[str, int]]]:
+    """
+    Помесячные суммы за [start_date, end_date), границы - начала месяцев:
+    {'YYYY-MM': (доходы, расходы, {категория: расход})}, в копейках; месяцы без записей отсутствуют.
+    Один запрос с группировкой по месяцу: по monthly_rollup, а пока история пользователя
+    не перенесена в rollup - по диапазону idx_user_period_cover в transactions.
+    """
+    shard = _shard_for(user_id)
+    if shard is None: return {}
+    if migrations.rollup_ready(user_id, shard.index):
+        sql = _with_category_names("SELECT month, transaction_type, category_id, SUM(total_amount) AS total FROM monthly_rollup WHERE user_id = ? AND month >= ? AND month < ? GROUP BY month, transaction_type, category_id")
+        params = (user_id, start_date.strftime('%Y-%m'), end_date.strftime('%Y-%m'))
+    else:
+        sql = _with_category_names("SELECT strftime('%Y-%m', created_at) AS month, transaction_type, category_id, SUM(amount) AS total FROM transactions WHERE user_id = ? AND created_at >= ? AND created_at < ? GROUP BY month, transaction_type, category_id")
+        params = (user_id, start_date.strftime('%Y-%m-%d %H:%M:%S'), end_date.strftime('%Y-%m-%d %H:%M:%S'))
+    months: Dict[str, Tuple[int, int, Dict[str, int]]] = {}
+    try:
+        async with _reader(shard) as conn:
+            rows = await conn.execute_fetchall(sql, params)
+        for row in rows:
+            income, expense, details = months.get(row['month'], (0, 0, {}))
+            amount = int(row['total'] or 0)
+            if row['transaction_type'] == 'income': income += amount
+            else:
+                expense += amount
+                if amount: details[row['category']] = details.get(row['category'], 0) + amount
+            months[row['month']] = (income, expense, details)
+        return months
+    except Exception as e:
+        logging.error(f"Error getting monthly trend for user {user_id}: {e}")
+        return {}
+
+@metrics.timed_query
+async def get_daily_expenses(user_id: int, start_date: datetime, end_date: datetime) -> List[Tuple[str, int]]:
+    """Расходы по дням за [start_date, end_date): [('YYYY-MM-DD', копейки), ...] по возрастанию даты."""
+    shard = _shard_for(user_id)
+    if shard is None: return []
+    # created_at хранится как 'YYYY-MM-DD HH:MM:SS': день - первые 10 символов; запрос покрывается idx_user_period_cover
+    sql = "SELECT substr(created_at, 1, 10) AS day, SUM(amount) AS total FROM transactions WHERE user_id = ? AND created_at >= ? AND created_at < ? AND transaction_type = 'expense' GROUP BY day ORDER BY day"
+    try:
+        async with _reader(shard) as conn:
+            rows = await conn.execute_fetchall(sql, (user_id, start_date.strftime('%Y-%m-%d %H:%M:%S'), end_date.strftime('%Y-%m-%d %H:%M:%S')))
+        return [(row['day'], int(row['total'] or 0)) for row in rows]
+    except Exception as e:
+        logging.error(f"Error getting daily expenses for user {user_id}: {e}")
+        return []
+
+@metrics.timed_query
+async def get_transactions_page(user_id: int, limit: int = 10, before_id: Optional[int] = None, after_id: Optional[int] = None) -> List[aiosqlite.Row]:
+    """
+    Страница истории от новых к старым: записи старше before_id или, если задан after_id, ближайшие новее него.
+    Курсор по id вместо OFFSET: каждая страница - поиск по idx_user_id и чтение limit строк на любой глубине.
+    """
+    shard = _shard_for(user_id)
+    if shard is None: return []
+    select = "SELECT t.id, t.created_at, t.transaction_type, t.amount, c.name AS category FROM transactions t JOIN categories c ON c.id = t.category_id"
+    if after_id is not None:
+        # Ближайшие более новые записи берем по возрастанию id и разворачиваем
+        sql, params = f"{select} WHERE t.user_id = ? AND t.id > ? ORDER BY t.id LIMIT ?", (user_id, after_id, limit)
+    elif before_id is not None:
+        sql, params = f"{select} WHERE t.user_id = ? AND t.id < ? ORDER BY t.id DESC LIMIT ?", (user_id, before_id, limit)
+    else:
+        sql, params = f"{select} WHERE t.user_id = ? ORDER BY t.id DESC LIMIT ?", (user_id, limit)
     try:
-        async with db_conn.execute(sql, (user_id, limit)) as cursor:
-            return await cursor.fetchall()
+        async with _reader(shard) as conn:
+            rows = await conn.execute_fetchall(sql, params)
+        return rows[::-1] if after_id is not None else rows
     except Exception as e:
-        logging.error(f"Error getting recent transactions for user {user_id}: {e}")
+        logging.error(f"Error getting transactions page for user {user_id} (before {before_id}, after {after_id}): {e}")
         return []
 
+async def iter_transaction_pages(user_id: int, start_date: Optional[datetime] = None, end_date: Optional[datetime] = None, page_size: int = config.EXPORT_PAGE_ROWS) -> AsyncIterator[List[Tuple[str, str, int, str]]]:
+    """
+    Отдает историю пользователя страницами по page_size строк (created_at, transaction_type, amount, category)
+    в порядке id, опционально за [start_date, end_date).
+    Keyset-пагинация: следующая страница начинается после последнего id предыдущей, поэтому
+    каждая страница - короткий проход по idx_user_id без OFFSET, и в памяти держится одна страница.
+    Соединение из пула берется на время одной страницы. Ошибка чтения логируется и пробрасывается,
+    чтобы экспорт не выдал обрезанный файл за полный.
+    """
+    shard = _shard_for(user_id)
+    if shard is None: return
+    # INDEXED BY: при фильтре по датам планировщик иначе выбирает индекс по created_at и сортирует каждую страницу.
+    # Имена категорий подставляются из словаря, а не JOIN: поиск по categories на каждую строку заметно дороже.
+    # Колонки в порядке строки экспорта и доступ по номеру: обращение к sqlite3.Row по имени - поиск на каждое поле
+    sql = "SELECT created_at, transaction_type, amount, category_id, id FROM transactions INDEXED BY idx_user_id WHERE user_id = ? AND id > ?"
+    names_sql = "SELECT id, name FROM categories WHERE user_id IN (0, ?)" # и выключенные: на них ссылается история
+    range_params: List[str] = []
+    if start_date: sql += " AND created_at >= ?"; range_params.append(start_date.strftime('%Y-%m-%d %H:%M:%S'))
+    if end_date: sql += " AND created_at < ?"; range_params.append(end_date.strftime('%Y-%m-%d %H:%M:%S'))
+    sql += " ORDER BY id LIMIT ?"
+    names: Dict[int, str] = {}
+    last_id = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            async with _reader(shard) as conn:
+                page = await conn.execute_fetchall(sql, (user_id, last_id, *range_params, page_size))
+                try: rows = [(row[0], row[1], row[2], names[row[3]]) for row in page]
+                except KeyError:
+                    # Первая страница или категория, заведенная уже во время выгрузки, - перечитываем словарь
+                    names = {row[0]: row[1] for row in await conn.execute_fetchall(names_sql, (user_id,))}
+                    rows = [(row[0], row[1], row[2], names[row[3]]) for row in page]
+        except Exception as e:
+            logging.error(f"Error reading transactions page after id {last_id} for user {user_id}: {e}")
+            raise
+        # Асинхронный генератор декоратором не обернуть: время считаем по каждой странице
+        metrics.observe_query("iter_transaction_pages", time.perf_counter() - started, len(page))
+        if not page: return
+        yield rows
+        if len(page) < page_size: return
+        last_id = page[-1][4]
+
+# --- Обслуживание monthly_rollup ---
+
+SQL_ROLLUP_FROM_TRANSACTIONS = """
+    SELECT user_id, strftime('%Y-%m', created_at) AS month, transaction_type, category_id,
+           SUM(amount) AS total_amount, COUNT(*) AS tx_count
+    FROM transactions
+    GROUP BY user_id, month, transaction_type, category_id
+"""
+
+@metrics.timed_query
+async def rebuild_monthly_rollup() -> bool:
+    """Полностью пересчитывает monthly_rollup из transactions, по одной транзакции на шард."""
+    if not _shards: return False
+    for shard in _shards:
+        try:
+            async with _writer(shard) as conn:
+                await conn.execute("DELETE FROM monthly_rollup")
+                await conn.execute(f"INSERT INTO monthly_rollup (user_id, month, transaction_type, category_id, total_amount, tx_count) {SQL_ROLLUP_FROM_TRANSACTIONS}")
+                await conn.execute("INSERT INTO migration_state (name, value) VALUES ('rollup_backfill', 'done') ON CONFLICT (name) DO UPDATE SET value = excluded.value")
+                await conn.commit()
+            migrations.rollup_backfilled_upto.pop(shard.index, None)
+            logging.info(f"Table 'monthly_rollup' rebuilt from transactions: {shard.path}")
+        except Exception as e:
+            logging.error(f"Error rebuilding monthly_rollup in {shard.path}: {e}")
+            return False
+    return True
+
+@metrics.timed_query
+async def verify_monthly_rollup() -> List[Dict[str, object]]:
+    """
+    Сверяет monthly_rollup с пересчетом по transactions во всех шардах.
+    Возвращает список расхождений (пустой список - все сходится).
+    """
+    if not _shards: return []
+    sql = f"""
+    WITH raw AS ({SQL_ROLLUP_FROM_TRANSACTIONS})
+    SELECT raw.user_id, raw.month, raw.transaction_type, raw.category_id,
+           raw.total_amount AS expected_amount, raw.tx_count AS expected_count,
+           r.total_amount AS rollup_amount, r.tx_count AS rollup_count
+    FROM raw LEFT JOIN monthly_rollup r
+      ON r.user_id = raw.user_id AND r.month = raw.month
+     AND r.transaction_type = raw.transaction_type AND r.category_id = raw.category_id
+    WHERE r.user_id IS NULL OR r.tx_count != raw.tx_count OR r.total_amount != raw.total_amount
+    UNION ALL
+    SELECT r.user_id, r.month, r.transaction_type, r.category_id, NULL, NULL, r.total_amount, r.tx_count
+    FROM monthly_rollup r
+    WHERE NOT EXISTS (
+        SELECT 1 FROM transactions t
+        WHERE t.user_id = r.user_id AND t.transaction_type = r.transaction_type AND t.category_id = r.category_id
+          AND t.created_at >= r.month || '-01' AND t.created_at < date(r.month || '-01', '+1 month')
+    )
+    """
+    mismatches: List[Dict[str, object]] = []
+    for shard in _shards:
+        try:
+            mismatches.extend(dict(row) for row in await shard.conn.execute_fetchall(sql))
+        except Exception as e:
+            logging.error(f"Error verifying monthly_rollup in {shard.path}: {e}")
+            raise
+    return mismatches
+
 # --- НОВЫЕ ФУНКЦИИ для управления категориями ---
 
-async def get_user_categories(user_id: int, category_type: str) -> List[str]:
-    """Получает список пользовательских категорий заданного типа."""
-    global db_conn
-    if not db_conn: return []
-    sql = "SELECT category_name FROM user_categories WHERE user_id = ? AND category_type = ? ORDER BY category_name"
+def get_category_version(user_id: int, category_type: str) -> int:
+    """Текущая версия списка пользовательских категорий (меняется при добавлении/удалении)."""
+    return _category_versions.get((user_id, category_type))
+
+def _invalidate_user_categories(user_id: int, category_type: str):
+    key = (user_id, category_type)
+    _category_versions.bump(key)
+    _category_cache.pop(key)
+
+def get_category_cache_stats() -> Dict[str, object]:
+    """Счетчики попаданий/промахов кэша категорий."""
+    return _category_cache.stats()
+
+def get_budget_cache_stats() -> Dict[str, object]:
+    """Счетчики кэша лимитов и трат с начала месяца."""
+    return budgets.stats()
+
+def get_standard_categories(user_id: int, category_type: str) -> List[Category]:
+    """Стандартные категории (из config) в файле пользователя, в порядке config; без обращения к БД."""
+    shard = _shard_for(user_id)
+    if shard is None: return []
+    return list(shard.standard_categories.get(category_type, ()))
+
+@metrics.timed_query
+async def get_user_categories(user_id: int, category_type: str) -> List[Category]:
+    """Получает список пользовательских категорий заданного типа (через LRU-кэш)."""
+    shard = _shard_for(user_id)
+    if shard is None: return []
+    key = (user_id, category_type)
+    cached = _category_cache.get(key)
+    if cached is not None: return list(cached)
+    # Запоминаем версию до запроса: если список изменится во время чтения, результат не кэшируем
+    version = get_category_version(user_id, category_type)
+    sql = "SELECT id, category_type, name FROM categories WHERE user_id = ? AND category_type = ? AND is_active = 1 ORDER BY name"
     try:
-        async with db_conn.execute(sql, (user_id, category_type)) as cursor:
-            rows = await cursor.fetchall()
-            return [row['category_name'] for row in rows]
+        async with _reader(shard) as conn:
+            rows = await conn.execute_fetchall(sql, (user_id, category_type))
+        categories = [Category(row['id'], row['category_type'], row['name']) for row in rows]
+        if get_category_version(user_id, category_type) == version:
+            _category_cache.put(key, tuple(categories))
+        return categories
     except Exception as e:
         logging.error(f"Error getting user categories for user {user_id}, type {category_type}: {e}")
         return []
 
+@metrics.timed_query
+async def get_category(user_id: int, category_id: int, active_only: bool = False) -> Optional[Category]:
+    """
+    Категория по id из callback_data: стандартная или своя категория пользователя (в т.ч. выключенная,
+    если не задан active_only), иначе None. Стандартные и закэшированные свои находятся без запроса к БД.
+    active_only - для выбора категории кнопкой: старая клавиатура может предложить уже удаленную.
+    """
+    shard = _shard_for(user_id)
+    if shard is None: return None
+    category = shard.standard_by_id.get(category_id)
+    if category is not None: return category
+    for category_type in ('expense', 'income'):
+        category = next((cat for cat in _category_cache.peek((user_id, category_type)) or () if cat.id == category_id), None)
+        if category is not None: return category
+    # В памяти только включенные категории, поэтому проверка is_active нужна лишь здесь
+    sql = "SELECT id, category_type, name FROM categories WHERE id = ? AND user_id IN (0, ?)" + (" AND is_active = 1" if active_only else "")
+    try:
+        async with _reader(shard) as conn:
+            rows = await conn.execute_fetchall(sql, (category_id, user_id))
+        return Category(rows[0]['id'], rows[0]['category_type'], rows[0]['name']) if rows else None
+    except Exception as e:
+        logging.error(f"Error getting category {category_id} for user {user_id}: {e}")
+        return None
+
+@metrics.timed_query
 async def add_user_category(user_id: int, category_type: str, category_name: str) -> bool:
     """Добавляет новую категорию пользователя. Возвращает True при успехе, False при ошибке (в т.ч. дубликат)."""
-    global db_conn
-    if not db_conn: return False
+    shard = _shard_for(user_id)
+    if shard is None: return False
     # Проверка на пустую строку
     if not category_name or category_name.isspace():
         logging.warning(f"Attempt to add empty category name for user {user_id}")
         return False
     # Нормализация имени (убрать лишние пробелы)
     normalized_name = category_name.strip()
+    # Стандартная категория с таким именем у пользователя уже есть
+    if any(category.name == normalized_name for category in shard.standard_categories.get(category_type, ())):
+        logging.warning(f"Duplicate category attempt (standard): User {user_id}, Type {category_type}, Name '{normalized_name}'")
+        return False
 
-    sql = "INSERT INTO user_categories (user_id, category_type, category_name) VALUES (?, ?, ?)"
+    # Удаленная раньше (или встреченная в импорте) категория с тем же именем включается снова, вместе со своей историей
+    sql = """
+    INSERT INTO categories (user_id, category_type, name) VALUES (?, ?, ?)
+    ON CONFLICT (user_id, category_type, name) DO UPDATE SET is_active = 1 WHERE is_active = 0
+    """
     try:
-        await db_conn.execute(sql, (user_id, category_type, normalized_name))
-        await db_conn.commit()
+        async with _writer(shard) as conn:
+            async with conn.execute(sql, (user_id, category_type, normalized_name)) as cursor:
+                changed = cursor.rowcount
+            await conn.commit()
+        if not changed: # Ловим дубликат: категория уже включена
+            logging.warning(f"Duplicate category attempt: User {user_id}, Type {category_type}, Name '{normalized_name}'")
+            return False # Возвращаем False при дубликате
+        _invalidate_user_categories(user_id, category_type)
         logging.info(f"User category added: User {user_id}, Type {category_type}, Name '{normalized_name}'")
         return True
-    except aiosqlite.IntegrityError: # Ловим ошибку уникальности (дубликат)
-        logging.warning(f"Duplicate category attempt: User {user_id}, Type {category_type}, Name '{normalized_name}'")
-        return False # Возвращаем False при дубликате
     except Exception as e:
         logging.error(f"Error adding user category for user {user_id}: {e}")
         return False
 
-async def delete_user_category(user_id: int, category_type: str, category_name: str) -> bool:
-    """Удаляет пользовательскую категорию."""
-    global db_conn
-    if not db_conn: return False
+@metrics.timed_query
+async def delete_user_category(user_id: int, category_type: str, category_id: int) -> bool:
+    """Удаляет пользовательскую категорию из списка. Строка остается выключенной: на нее ссылаются записи."""
+    shard = _shard_for(user_id)
+    if shard is None: return False
+    # Стандартные категории (user_id = 0) так не удалить: условие по user_id
+    sql = "UPDATE categories SET is_active = 0 WHERE id = ? AND user_id = ? AND category_type = ? AND is_active = 1"
+    try:
+        async with _writer(shard) as conn:
+            async with conn.execute(sql, (category_id, user_id, category_type)) as cursor:
+                deleted = cursor.rowcount
+            # commit и без измененной строки: иначе транзакция UPDATE осталась бы открытой на общем соединении
+            await conn.commit()
+        if not deleted:
+            logging.warning(f"Category not found for deletion: User {user_id}, Type {category_type}, ID {category_id}")
+            return False # Категория не найдена
+        _invalidate_user_categories(user_id, category_type)
+        logging.info(f"User category deleted: User {user_id}, Type {category_type}, ID {category_id}")
+        return True
+    except Exception as e:
+        logging.error(f"Error deleting user category for user {user_id}: {e}")
+        return False
+
+# --- Бюджеты по категориям ---
+
+@metrics.timed_query
+async def get_budgets(user_id: int) -> Dict[str, int]:
+    """Месячные лимиты пользователя {категория: копейки} (через кэш budgets.py)."""
+    shard = _shard_for(user_id)
+    if shard is None: return {}
+    cached = budgets.get_limits(user_id)
+    if cached is not None: return dict(cached)
+    sql = "SELECT c.name AS category, b.monthly_limit FROM budgets b JOIN categories c ON c.id = b.category_id WHERE b.user_id = ?"
+    try:
+        async with _reader(shard) as conn:
+            rows = await conn.execute_fetchall(sql, (user_id,))
+        limits = {row['category']: row['monthly_limit'] for row in rows}
+        budgets.put_limits(user_id, limits)
+        return limits
+    except Exception as e:
+        logging.error(f"Error getting budgets for user {user_id}: {e}")
+        return {}
 
-    # Проверка, не пытается ли пользователь удалить стандартную категорию (если мы их тоже показываем)
-    # Эту логику лучше делать на уровне интерфейса, но можно и здесь
-    # if category_type == 'expense' and category_name in config.EXPENSE_CATEGORIES: return False
-    # if category_type == 'income' and category_name in config.INCOME_CATEGORIES: return False
+@metrics.timed_query
+async def get_budget_categories(user_id: int) -> List[Category]:
+    """Категории, для которых задан лимит (для меню удаления лимита), по имени."""
+    shard = _shard_for(user_id)
+    if shard is None: return []
+    sql = "SELECT c.id, c.category_type, c.name FROM budgets b JOIN categories c ON c.id = b.category_id WHERE b.user_id = ? ORDER BY c.name"
+    try:
+        async with _reader(shard) as conn:
+            rows = await conn.execute_fetchall(sql, (user_id,))
+        return [Category(row['id'], row['category_type'], row['name']) for row in rows]
+    except Exception as e:
+        logging.error(f"Error getting budget categories for user {user_id}: {e}")
+        return []
 
-    sql = "DELETE FROM user_categories WHERE user_id = ? AND category_type = ? AND category_name = ?"
+@metrics.timed_query
+async def set_budget(user_id: int, category_id: int, monthly_limit: int) -> bool:
+    """Задает или меняет лимит категории (копейки)."""
+    shard = _shard_for(user_id)
+    if shard is None: return False
+    sql = "INSERT INTO budgets (user_id, category_id, monthly_limit) VALUES (?, ?, ?) ON CONFLICT (user_id, category_id) DO UPDATE SET monthly_limit = excluded.monthly_limit"
     try:
-        async with db_conn.execute(sql, (user_id, category_type, category_name)) as cursor:
-            if cursor.rowcount == 0:
-                logging.warning(f"Category not found for deletion: User {user_id}, Type {category_type}, Name '{category_name}'")
-                return False # Категория не найдена
-        await db_conn.commit()
-        logging.info(f"User category deleted: User {user_id}, Type {category_type}, Name '{category_name}'")
+        async with _writer(shard) as conn:
+            await conn.execute(sql, (user_id, category_id, monthly_limit))
+            await conn.commit()
+        budgets.forget_limits(user_id)
+        logging.info(f"Budget set: User {user_id}, Cat {category_id}, Limit {monthly_limit}")
         return True
     except Exception as e:
-        logging.error(f"Error deleting user category for user {user_id}: {e}")
-        return False
\ No newline at end of file
+        logging.error(f"Error setting budget for user {user_id}, category {category_id}: {e}")
+        return False
+
+@metrics.timed_query
+async def delete_budget(user_id: int, category_id: int) -> bool:
+    shard = _shard_for(user_id)
+    if shard is None: return False
+    try:
+        async with _writer(shard) as conn:
+            async with conn.execute("DELETE FROM budgets WHERE user_id = ? AND category_id = ?", (user_id, category_id)) as cursor:
+                deleted = cursor.rowcount
+            await conn.commit()
+        budgets.forget_limits(user_id)
+        if not deleted: logging.warning(f"Budget not found for deletion: User {user_id}, Cat {category_id}")
+        return deleted > 0
+    except Exception as e:
+        logging.error(f"Error deleting budget for user {user_id}, category {category_id}: {e}")
+        return False
+
+@metrics.timed_query
+async def get_budget_usage(user_id: int) -> Dict[str, Tuple[int, int]]:
+    """
+    {категория: (лимит, потрачено с начала месяца)} для категорий с лимитом, в копейках.
+    Траты месяца засеваются одним агрегатным запросом (целый месяц читается из monthly_rollup)
+    и дальше ведутся в памяти, поэтому повторные проверки запросов не делают.
+    """
+    limits = await get_budgets(user_id)
+    if not limits: return {}
+    month_start = _month_floor(datetime.now(timezone.utc))
+    month = month_start.strftime('%Y-%m')
+    spent = budgets.get_spent(user_id, month)
+    if spent is None:
+        data_version = budgets.version(user_id)
+        _, _, spent = await get_period_summary_with_details(user_id, month_start, _next_month(month_start))
+        budgets.seed(user_id, month, spent, data_version)
+    return {category: (limit, spent.get(category, 0)) for category, limit in limits.items()}
+
+# --- Регулярные записи (правила для scheduler.py) ---
+
+# Правила с именем категории: имя нужно планировщику для учета трат в budgets
+SQL_SELECT_RECURRING = "SELECT r.*, c.name AS category FROM recurring_rules r JOIN categories c ON c.id = r.category_id"
+
+@metrics.timed_query
+async def load_recurring_rules() -> List[aiosqlite.Row]:
+    """Все правила всех шардов - один раз при запуске планировщика."""
+    rules: List[aiosqlite.Row] = []
+    for shard in _shards:
+        try:
+            rules.extend(await shard.conn.execute_fetchall(SQL_SELECT_RECURRING))
+        except Exception as e:
+            logging.error(f"Error loading recurring rules from {shard.path}: {e}")
+    return rules
+
+@metrics.timed_query
+async def get_user_recurring_rules(user_id: int) -> List[aiosqlite.Row]:
+    shard = _shard_for(user_id)
+    if shard is None: return []
+    sql = f"{SQL_SELECT_RECURRING} WHERE r.user_id = ? ORDER BY r.id"
+    try:
+        async with _reader(shard) as conn:
+            return await conn.execute_fetchall(sql, (user_id,))
+    except Exception as e:
+        logging.error(f"Error getting recurring rules for user {user_id}: {e}")
+        return []
+
+@metrics.timed_query
+async def add_recurring_rule(user_id: int, transaction_type: str, amount: int, category_id: int, period: str, anchor_day: Optional[int], next_run_at: str) -> Optional[aiosqlite.Row]:
+    """Создает правило; возвращает его строку с именем категории (для scheduler.schedule) или None."""
+    shard = _shard_for(user_id)
+    if shard is None: return None
+    sql = """
+    INSERT INTO recurring_rules (user_id, transaction_type, amount, category_id, period, anchor_day, next_run_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id
+    """
+    try:
+        async with _writer(shard) as conn:
+            inserted = await conn.execute_fetchall(sql, (user_id, transaction_type, amount, category_id, period, anchor_day, next_run_at))
+            rows = await conn.execute_fetchall(f"{SQL_SELECT_RECURRING} WHERE r.id = ?", (inserted[0]['id'],))
+            await conn.commit()
+        logging.info(f"Recurring rule added: User {user_id}, Type {transaction_type}, Amount {amount}, Cat {category_id}, Period {period}")
+        return rows[0]
+    except Exception as e:
+        logging.error(f"Error adding recurring rule for user {user_id}: {e}")
+        return None
+
+@metrics.timed_query
+async def delete_recurring_rule(user_id: int, rule_id: int) -> bool:
+    shard = _shard_for(user_id)
+    if shard is None: return False
+    try:
+        async with _writer(shard) as conn:
+            async with conn.execute("DELETE FROM recurring_rules WHERE id = ? AND user_id = ?", (rule_id, user_id)) as cursor:
+                deleted = cursor.rowcount
+            await conn.commit()
+        if not deleted: logging.warning(f"Recurring rule {rule_id} not found for user {user_id}.")
+        return deleted > 0
+    except Exception as e:
+        logging.error(f"Error deleting recurring rule {rule_id} for user {user_id}: {e}")
+        return False
+
+@metrics.timed_query
+async def apply_recurring(rows: List[Tuple[int, str, int, int, str, str]], advances: List[Tuple[int, str, int]]) -> Set[int]:
+    """
+    Записывает наступившие регулярные транзакции (user_id, type, amount, category_id, created_at, имя категории)
+    и сдвигает next_run_at правил ((user_id, next_run_at, id)) одним commit на шард: после сбоя
+    сроки не повторятся и не потеряются. Возвращает user_id, чьи записи сохранить не удалось.
+    """
+    failed: Set[int] = set()
+    shard_rows = _group_by_shard(rows, lambda row: row[0])
+    for index, shard_advances in _group_by_shard(advances, lambda advance: advance[0]).items():
+        rows_here = shard_rows.get(index, [])
+        try:
+            async with _writer(_shards[index]) as conn:
+                if rows_here: await conn.executemany(SQL_INSERT_TRANSACTION, [row[:5] for row in rows_here])
+                await conn.executemany("UPDATE recurring_rules SET next_run_at = ? WHERE id = ?", [(next_run_at, rule_id) for _, next_run_at, rule_id in shard_advances])
+                await conn.commit()
+        except Exception as e:
+            logging.error(f"Error applying {len(rows_here)} recurring transactions to shard {index}: {e}")
+            failed.update(user_id for user_id, _, _ in shard_advances)
+            continue
+        for user_id, transaction_type, amount, _, created_at, category in rows_here:
+            report_cache.invalidate(user_id, created_at)
+            budgets.record(user_id, transaction_type, category, amount, created_at)
+    return failed
+
+# --- Хранилище состояний FSM (в шарде 0, см. db_conn) ---
+
+@metrics.timed_query
+async def load_fsm_record(storage_key: str) -> Optional[Tuple[Optional[str], str, float]]:
+    """Возвращает (state, data_json, updated_at) или None, если записи нет."""
+    global db_conn
+    if not db_conn: return None
+    sql = "SELECT state, data, updated_at FROM fsm_storage WHERE storage_key = ?"
+    try:
+        async with _reader(_shards[0]) as conn:
+            rows = await conn.execute_fetchall(sql, (storage_key,))
+        return (rows[0]['state'], rows[0]['data'], rows[0]['updated_at']) if rows else None
+    except Exception as e:
+        logging.error(f"Error loading FSM record {storage_key}: {e}")
+        return None
+
+@metrics.timed_query
+async def save_fsm_records(upserts: List[Tuple[str, Optional[str], str, float]], deletes: List[str]) -> bool:
+    """Записывает пачку изменений FSM одной транзакцией: upserts - (key, state, data_json, updated_at)."""
+    global db_conn
+    if not db_conn: return False
+    sql_upsert = """
+    INSERT INTO fsm_storage (storage_key, state, data, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT (storage_key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+    """
+    try:
+        async with _writer(_shards[0]) as conn:
+            if upserts: await conn.executemany(sql_upsert, upserts)
+            if deletes: await conn.executemany("DELETE FROM fsm_storage WHERE storage_key = ?", [(key,) for key in deletes])
+            await conn.commit()
+        return True
+    except Exception as e:
+        logging.error(f"Error saving {len(upserts) + len(deletes)} FSM records: {e}")
+        return False
+
+@metrics.timed_query
+async def delete_expired_fsm_records(updated_before: float) -> int:
+    """Удаляет состояния FSM, не менявшиеся с момента updated_before (unix time)."""
+    global db_conn
+    if not db_conn: return 0
+    try:
+        async with _writer(_shards[0]) as conn:
+            async with conn.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (updated_before,)) as cursor:
+                deleted = cursor.rowcount
+            await conn.commit()
+        if deleted: logging.info(f"Expired FSM records deleted: {deleted}")
+        return deleted
+    except Exception as e:
+        logging.error(f"Error deleting expired FSM records: {e}")
+        return 0
\ No newline at end of file
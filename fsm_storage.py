@@ -0,0 +1,223 @@
+# fsm_storage.py
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import config
+import db
+
+# --- Сериализация данных FSM ---
+# В data лежат не только JSON-типы: например, custom_report хранит datetime начала периода
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime): return {"__datetime__": value.isoformat()}
+    if isinstance(value, date): return {"__date__": value.isoformat()}
+    if isinstance(value, Decimal): return {"__decimal__": str(value)}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _json_object_hook(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1:
+        if "__datetime__" in obj: return datetime.fromisoformat(obj["__datetime__"])
+        if "__date__" in obj: return date.fromisoformat(obj["__date__"])
+        if "__decimal__" in obj: return Decimal(obj["__decimal__"])
+    return obj
+
+def dump_data(data: Mapping[str, Any]) -> str:
+    return json.dumps(data, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+
+def load_data(raw: Optional[str]) -> Dict[str, Any]:
+    return json.loads(raw, object_hook=_json_object_hook) if raw else {}
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'updated_at', 'touched_at')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None, updated_at: float = 0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.updated_at = updated_at
+        self.touched_at = time.monotonic()
+
+    @property
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в таблице fsm_storage основной SQLite-базы.
+
+    Горячие чаты лежат в ограниченном LRU-кэше в памяти, поэтому чтение состояния
+    не ходит в БД. Запись сквозная: память меняется сразу, а изменения копятся в
+    очереди и сбрасываются фоновой задачей одной транзакцией раз в flush_ms.
+    Несколько изменений одного ключа за окно (set_state + update_data) дают одну
+    строку в пачке. Пустые состояния удаляются из таблицы, простаивающие записи
+    выгружаются из памяти и удаляются из БД по TTL.
+    """
+
+    def __init__(
+        self,
+        key_builder: Optional[KeyBuilder] = None,
+        cache_size: int = config.FSM_CACHE_SIZE,
+        cache_ttl: float = config.FSM_CACHE_TTL,
+        state_ttl: float = config.FSM_STATE_TTL,
+        flush_ms: float = config.FSM_FLUSH_MS,
+        sweep_interval: float = config.FSM_SWEEP_INTERVAL,
+    ) -> None:
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.cache_size = max(1, cache_size)
+        self.cache_ttl = cache_ttl
+        self.state_ttl = state_ttl
+        self.flush_interval = flush_ms / 1000
+        self.sweep_interval = sweep_interval
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+        # Ключи с изменениями, еще не записанными в БД (переживают вытеснение из кэша)
+        self._pending: Dict[str, _Record] = {}
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._sweep_task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.flushes = 0
+        self.rows_flushed = 0
+
+    # --- Внутренние методы ---
+
+    def _ensure_tasks(self):
+        if self._closed: return
+        if self._flush_task is None:
+            self._flush_event = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if self._sweep_task is None and self.sweep_interval > 0:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    def _remember(self, storage_key: str, record: _Record):
+        record.touched_at = time.monotonic()
+        self._cache[storage_key] = record
+        self._cache.move_to_end(storage_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _get_record(self, key: StorageKey) -> _Record:
+        storage_key = self.key_builder.build(key)
+        record = self._cache.get(storage_key)
+        if record is None:
+            record = self._pending.get(storage_key)
+        if record is None:
+            self._ensure_tasks()
+            row = await db.load_fsm_record(storage_key)
+            # Пока шел запрос, запись могли создать параллельно
+            record = self._cache.get(storage_key) or self._pending.get(storage_key)
+            if record is None:
+                # Отсутствие записи тоже кэшируем: иначе каждое сообщение без состояния шло бы в БД
+                record = _Record(row[0], load_data(row[1]), row[2]) if row else _Record()
+        self._remember(storage_key, record)
+        return record
+
+    def _mark_dirty(self, key: StorageKey, record: _Record):
+        record.updated_at = time.time()
+        self._pending[self.key_builder.build(key)] = record
+        self._ensure_tasks()
+        if self._flush_event: self._flush_event.set()
+
+    async def _flush_loop(self):
+        while True:
+            await self._flush_event.wait()
+            # Окно накопления: изменения одного апдейта и соседних апдейтов уходят одной транзакцией
+            await asyncio.sleep(self.flush_interval)
+            self._flush_event.clear()
+            await self.flush()
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try: await self.sweep()
+            except Exception as e: logging.error(f"FSM storage sweep failed: {e}")
+
+    # --- Публичные методы ---
+
+    async def flush(self):
+        """Записывает все накопленные изменения одной транзакцией."""
+        if not self._pending: return
+        batch, self._pending = self._pending, {}
+        upserts, deletes = [], []
+        for storage_key, record in batch.items():
+            if record.is_empty: deletes.append(storage_key)
+            else: upserts.append((storage_key, record.state, dump_data(record.data), record.updated_at))
+        saved = False
+        try:
+            saved = await db.save_fsm_records(upserts, deletes)
+        finally:
+            if saved:
+                self.flushes += 1
+                self.rows_flushed += len(batch)
+            else:
+                # Не удалось записать (или задачу отменили): возвращаем в очередь то, что не успели изменить повторно
+                for storage_key, record in batch.items():
+                    self._pending.setdefault(storage_key, record)
+
+    async def sweep(self):
+        """Выгружает простаивающие записи из памяти и удаляет брошенные сценарии из БД."""
+        now_mono, now = time.monotonic(), time.time()
+        if self.cache_ttl > 0:
+            idle_keys = [k for k, r in self._cache.items() if now_mono - r.touched_at > self.cache_ttl]
+            for storage_key in idle_keys: self._cache.pop(storage_key, None)
+            if idle_keys: logging.info(f"FSM storage: {len(idle_keys)} idle records unloaded from memory")
+        if self.state_ttl > 0:
+            await self.flush()
+            await db.delete_expired_fsm_records(now - self.state_ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cached": len(self._cache),
+            "cache_size": self.cache_size,
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+        }
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get_record(key)).data.copy()
+
+    async def close(self) -> None:
+        self._closed = True
+        for task in (self._flush_task, self._sweep_task):
+            if task: task.cancel()
+        for task in (self._flush_task, self._sweep_task):
+            if task:
+                try: await task
+                except asyncio.CancelledError: pass
+        self._flush_task = self._sweep_task = None
+        await self.flush()
+        logging.info(f"SQLite FSM storage closed: {self.stats()}")
+
+
+def storage_stats(storage: BaseStorage) -> Dict[str, Any]:
+    """Размеры хранилища FSM для метрик: SQLiteStorage считает сам, у MemoryStorage - число записей."""
+    if isinstance(storage, SQLiteStorage): return storage.stats()
+    if isinstance(storage, MemoryStorage): return {"cached": len(storage.storage)}
+    return {}
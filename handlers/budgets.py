@@ -0,0 +1,102 @@
+# handlers/budgets.py
+import logging
+from typing import List, Tuple
+from aiogram import Router, types, F
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.utils.markdown import hbold, hitalic
+import config
+import keyboards as kb
+import db
+from money import parse_amount, format_amount
+from states import BudgetStates
+
+budgets_router = Router() # Роутер для бюджетов по категориям
+
+def format_budget_status(category: str, limit: int, spent: int) -> str:
+    """Строка об остатке бюджета после расхода; с предупреждением от BUDGET_WARN_PERCENT и при превышении."""
+    percent = spent * 100 // limit
+    text = f"💼 Бюджет {hbold(category)}: {format_amount(spent)} из {format_amount(limit)}"
+    if spent > limit: return text + f"\n🚨 Бюджет превышен на {format_amount(spent - limit)}!"
+    text += f", осталось {format_amount(limit - spent)}"
+    if spent == limit: text += "\n🚨 Бюджет исчерпан."
+    elif percent >= config.BUDGET_WARN_PERCENT: text += f"\n⚠️ Израсходовано {percent}% бюджета."
+    return text
+
+async def _budgets_menu(user_id: int) -> Tuple[str, types.InlineKeyboardMarkup]:
+    usage = await db.get_budget_usage(user_id)
+    if usage:
+        lines = [f"- {hitalic(category)}: {format_amount(spent)} из {format_amount(limit)} ({spent * 100 // limit}%)" for category, (limit, spent) in sorted(usage.items())]
+        budgets_text = "\n".join(lines)
+    else: budgets_text = "Лимиты не заданы."
+    text = f"💼 <b>Бюджеты на месяц</b>\n\n{budgets_text}\n\nВыберите действие:"
+    return text, kb.get_budgets_menu_kb(bool(usage))
+
+async def _expense_categories(user_id: int) -> List[db.Category]:
+    return db.get_standard_categories(user_id, 'expense') + await db.get_user_categories(user_id, 'expense')
+
+@budgets_router.message(Command("budgets"), StateFilter(None))
+async def process_budgets(message: types.Message, state: FSMContext):
+    await state.clear(); user_id = message.from_user.id; logging.info(f"Бюджеты от {user_id}")
+    text, reply_markup = await _budgets_menu(user_id)
+    await message.answer(text, reply_markup=reply_markup)
+    await state.set_state(BudgetStates.choosing_action)
+
+@budgets_router.callback_query(StateFilter(BudgetStates.choosing_action), F.data.startswith("bdg_manage:"))
+@budgets_router.callback_query(StateFilter(BudgetStates), F.data == "bdg_manage:menu")
+async def process_budget_action_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    action = callback_query.data.split(":")[1]; user_id = callback_query.from_user.id; message = callback_query.message
+    if action == "set":
+        await state.set_state(BudgetStates.choosing_category_to_set)
+        await message.edit_text("Выберите категорию расходов:", reply_markup=kb.get_budget_categories_kb(await _expense_categories(user_id), "bdg_set:"))
+    elif action == "delete":
+        await state.set_state(BudgetStates.choosing_category_to_delete)
+        categories = await db.get_budget_categories(user_id)
+        await message.edit_text("Выберите категорию, лимит которой удалить:", reply_markup=kb.get_budget_categories_kb(categories, "bdg_del:"))
+    elif action == "back":
+        await state.clear()
+        await message.edit_text("Вы вышли из управления бюджетами.", reply_markup=None)
+        await message.answer("Возврат в главное меню.", reply_markup=kb.main_kb)
+    elif action == "menu":
+        await state.set_state(BudgetStates.choosing_action)
+        text, reply_markup = await _budgets_menu(user_id)
+        await message.edit_text(text, reply_markup=reply_markup)
+    await callback_query.answer()
+
+# --- Установка лимита ---
+
+@budgets_router.callback_query(StateFilter(BudgetStates.choosing_category_to_set), F.data.startswith("bdg_set:"))
+async def process_budget_category_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    try: category = await db.get_category(callback_query.from_user.id, int(callback_query.data.split(":", 1)[1]), active_only=True)
+    except ValueError: category = None
+    if category is None or category.category_type != 'expense': await callback_query.answer("Категория не найдена.", show_alert=True); return
+    await state.update_data(budget_category_id=category.id, budget_category=category.name)
+    await state.set_state(BudgetStates.waiting_for_limit)
+    await callback_query.message.edit_text(f"Введите месячный лимит для категории {hbold(category.name)}:", reply_markup=None)
+    await callback_query.answer()
+
+@budgets_router.message(StateFilter(BudgetStates.waiting_for_limit))
+async def process_budget_limit(message: types.Message, state: FSMContext):
+    try: limit = parse_amount(message.text)
+    except ValueError: await message.answer("Введите корректную сумму (> 0, не более 2 знаков после запятой) или /cancel."); return
+    user_data = await state.get_data(); category_id, category = user_data.get("budget_category_id"), user_data.get("budget_category"); user_id = message.from_user.id
+    if not (category_id and category): await state.clear(); await message.answer("Начните заново: /budgets", reply_markup=kb.main_kb); return
+    if await db.set_budget(user_id, category_id, limit):
+        limit_spent = (await db.get_budget_usage(user_id)).get(category)
+        status = f"\n\n{format_budget_status(category, *limit_spent)}" if limit_spent else ""
+        await message.answer(f"✅ Лимит для {hbold(category)}: {format_amount(limit)} в месяц.{status}", reply_markup=kb.main_kb)
+    else: await message.answer("❌ Не удалось сохранить лимит.", reply_markup=kb.main_kb)
+    await state.clear()
+
+# --- Удаление лимита ---
+
+@budgets_router.callback_query(StateFilter(BudgetStates.choosing_category_to_delete), F.data.startswith("bdg_del:"))
+async def process_budget_delete_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    try: category_id = int(callback_query.data.split(":", 1)[1])
+    except ValueError: await callback_query.answer("Ошибка.", show_alert=True); return
+    user_id = callback_query.from_user.id
+    success = await db.delete_budget(user_id, category_id)
+    await state.set_state(BudgetStates.choosing_action)
+    text, reply_markup = await _budgets_menu(user_id)
+    await callback_query.message.edit_text(text, reply_markup=reply_markup)
+    await callback_query.answer("Лимит удален." if success else "Лимит не найден.", show_alert=not success)
@@ -3,7 +3,6 @@ import logging
 from aiogram import Router, types, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.utils.markdown import hbold
 import keyboards as kb
 import db
 from states import CategoryManagementStates
@@ -21,8 +20,8 @@ async def process_manage_categories(message: types.Message, state: FSMContext):
     expense_cats = await db.get_user_categories(user_id, 'expense')
     income_cats = await db.get_user_categories(user_id, 'income')
 
-    expense_text = "\n".join([f"- {cat}" for cat in expense_cats]) if expense_cats else "Нет"
-    income_text = "\n".join([f"- {cat}" for cat in income_cats]) if income_cats else "Нет"
+    expense_text = "\n".join([f"- {cat.name}" for cat in expense_cats]) if expense_cats else "Нет"
+    income_text = "\n".join([f"- {cat.name}" for cat in income_cats]) if income_cats else "Нет"
 
     reply_text = f"⚙️ <b>Управление категориями</b>\n\n" \
                  f"<u>Ваши категории расходов:</u>\n{expense_text}\n\n" \
@@ -117,13 +116,15 @@ async def process_delete_category_type_callback(callback_query: types.CallbackQu
 @categories_router.callback_query(StateFilter(CategoryManagementStates.choosing_category_to_delete), F.data.startswith("cat_delete_confirm:"))
 async def process_delete_category_confirm_callback(callback_query: types.CallbackQuery, state: FSMContext):
     try:
-        category_name_to_delete = callback_query.data.split(":", 1)[1]
-    except IndexError:
+        category_id = int(callback_query.data.split(":", 1)[1])
+    except (IndexError, ValueError):
         logging.error(f"Invalid delete category callback data: {callback_query.data}")
         await callback_query.answer("Ошибка", show_alert=True); return
 
     user_data = await state.get_data(); category_type = user_data.get("category_type_to_delete"); user_id = callback_query.from_user.id
-    success = await db.delete_user_category(user_id, category_type, category_name_to_delete)
+    category = await db.get_category(user_id, category_id)
+    category_name_to_delete = category.name if category else str(category_id)
+    success = await db.delete_user_category(user_id, category_type, category_id)
 
     if success:
         await callback_query.message.edit_text(f"✅ Категория '{category_name_to_delete}' удалена.", reply_markup=None)
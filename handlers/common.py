@@ -28,8 +28,13 @@ async def send_help(message: types.Message):
         "/mycategories - Управление категориями\n"
         "/report - Отчет за текущий месяц\n"
         "/prevmonthreport - Отчет за прошлый месяц\n"
+        "/trend [N] - Доходы и расходы по месяцам за N мес.\n"
+        "/budgets - Месячные лимиты расходов по категориям\n"
+        "/recurring - Регулярные записи (аренда, зарплата, подписки)\n"
         "/recent - Показать последние записи\n"
         "/deletelast - Удалить последнюю запись\n"
+        "/import - Импорт истории из CSV-файла\n"
+        "/export [ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]] - Выгрузить историю в CSV\n"
         "/cancel - Отменить текущее действие\n"
         "/help - Показать эту справку\n\n"
         "Используй кнопки внизу для быстрого доступа."
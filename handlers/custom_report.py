@@ -1,16 +1,15 @@
 # handlers/custom_report.py
 import logging
 from datetime import datetime, timezone, timedelta # Добавил timedelta
-from aiogram import Router, types, F
+from aiogram import Router, types
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 # --- ДОБАВИТЬ ИМПОРТ ---
 from aiogram.utils.markdown import hbold
 import keyboards as kb
-import db
 from states import CustomReportStates
 # Импортируем форматирование из reports.py (или можно вынести в отдельный utils.py)
-from .reports import format_report_text
+from .reports import build_report_text, send_report_chart
 
 custom_report_router = Router()
 
@@ -57,11 +56,11 @@ async def process_end_date(message: types.Message, state: FSMContext):
 
         user_id = message.from_user.id
         logging.info(f"Отчет за период {start_date.strftime(DATE_FORMAT)} - {end_date_naive.strftime(DATE_FORMAT)} от {user_id}")
-        income, expense, details = await db.get_period_summary_with_details(user_id, start_date, end_date)
         period_name = f"период с {start_date.strftime(DATE_FORMAT)} по {end_date_naive.strftime(DATE_FORMAT)}"
-        report_text = format_report_text(period_name, income, expense, details)
+        report_text = await build_report_text(user_id, period_name, start_date, end_date)
         await message.answer(report_text, reply_markup=kb.main_kb)
         await state.clear()
+        await send_report_chart(message, user_id, period_name, start_date, end_date)
 
     except ValueError:
          # Используем импортированный hbold
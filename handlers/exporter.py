@@ -0,0 +1,81 @@
+# handlers/exporter.py
+import asyncio
+import csv
+import io
+import logging
+from datetime import datetime, timezone, timedelta
+from tempfile import SpooledTemporaryFile
+from typing import AsyncGenerator, BinaryIO, Optional, Tuple
+from aiogram import Router, types, Bot
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.types import InputFile
+from aiogram.utils.markdown import hbold
+import config
+import keyboards as kb
+import db
+from csv_format import CSV_COLUMNS, format_row
+from .custom_report import DATE_FORMAT
+
+exporter_router = Router()
+
+class SpooledInputFile(InputFile):
+    """Документ для отправки прямо из открытого файла (например, SpooledTemporaryFile) кусками по chunk_size."""
+
+    def __init__(self, file: BinaryIO, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        # С начала при каждом чтении: запрос может быть отправлен повторно
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+def _parse_period(args: Optional[str]) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """'' - вся история, 'ДД.ММ.ГГГГ' - с даты, 'ДД.ММ.ГГГГ ДД.ММ.ГГГГ' - период с концом включительно."""
+    parts = (args or "").split()
+    if len(parts) > 2: raise ValueError("too many arguments")
+    dates = [datetime.strptime(part, DATE_FORMAT).replace(tzinfo=timezone.utc) for part in parts]
+    start_date = dates[0] if dates else None
+    end_date = dates[1] + timedelta(days=1) if len(dates) == 2 else None
+    if start_date and end_date and end_date <= start_date: raise ValueError("end before start")
+    return start_date, end_date
+
+async def write_export(user_id: int, target: BinaryIO, start_date: Optional[datetime] = None, end_date: Optional[datetime] = None) -> int:
+    """Пишет историю пользователя в target как CSV постранично; возвращает число строк."""
+    # utf-8-sig: Excel без BOM открывает UTF-8 как cp1251; импорт BOM понимает
+    stream = io.TextIOWrapper(target, encoding="utf-8-sig", newline="")
+    try:
+        writer = csv.writer(stream)
+        writer.writerow(CSV_COLUMNS)
+        rows = 0
+        async for page in db.iter_transaction_pages(user_id, start_date, end_date):
+            writer.writerows(format_row(*row) for row in page)
+            rows += len(page)
+            await asyncio.sleep(0)
+        stream.flush()
+        return rows
+    finally:
+        stream.detach()
+
+@exporter_router.message(Command("export"), StateFilter(None))
+async def cmd_export(message: types.Message, command: CommandObject, bot: Bot):
+    user_id = message.from_user.id
+    try: start_date, end_date = _parse_period(command.args)
+    except ValueError:
+        await message.answer(f"Формат: /export или /export {hbold(DATE_FORMAT)} [{hbold(DATE_FORMAT)}]", reply_markup=kb.main_kb); return
+    # Небольшие выгрузки остаются в памяти, большие SpooledTemporaryFile сам переносит на диск
+    with SpooledTemporaryFile(max_size=config.EXPORT_SPOOL_MB * 1024 * 1024) as spool:
+        try: rows = await write_export(user_id, spool, start_date, end_date)
+        except Exception as e:
+            logging.error(f"CSV export failed for user {user_id}: {e}")
+            await message.answer("Не удалось выгрузить историю. Попробуйте позже.", reply_markup=kb.main_kb); return
+        if rows == 0: await message.answer("Нет записей за выбранный период.", reply_markup=kb.main_kb); return
+        size = spool.tell()
+        if size > config.EXPORT_MAX_FILE_MB * 1024 * 1024:
+            await message.answer(f"Выгрузка больше {config.EXPORT_MAX_FILE_MB} МБ. Укажите период покороче: /export {DATE_FORMAT} {DATE_FORMAT}", reply_markup=kb.main_kb); return
+        suffix = f"_{start_date:%Y%m%d}" if start_date else ""
+        suffix += f"-{end_date - timedelta(days=1):%Y%m%d}" if end_date else ""
+        document = SpooledInputFile(spool, filename=f"transactions{suffix}.csv")
+        logging.info(f"CSV export for user {user_id}: {rows} rows, {size} bytes")
+        await message.answer_document(document, caption=f"Записей: {rows}", reply_markup=kb.main_kb)
@@ -0,0 +1,167 @@
+# handlers/importer.py
+import asyncio
+import csv
+import html
+import io
+import logging
+import time
+from collections import Counter
+from tempfile import SpooledTemporaryFile
+from typing import Dict, List, Optional, TextIO, Tuple
+from aiogram import Router, types, F, Bot
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.utils.markdown import hbold
+import config
+import keyboards as kb
+import db
+from csv_format import CSV_COLUMNS, parse_datetime, parse_type, is_header
+from money import parse_amount
+from states import ImportStates
+
+importer_router = Router()
+
+MAX_SAMPLE_LINES = 5 # Номеров строк на одну причину отказа в отчете
+MAX_REPORTED_CATEGORIES = 5 # Неизвестных категорий в отчете
+
+class ImportReport:
+    """Итоги импорта: счетчики строк и причины отказов с примерами номеров строк."""
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.reasons: Counter = Counter()
+        self.samples: Dict[str, List[int]] = {}
+        self.unknown_categories: Counter = Counter()
+        self.error: Optional[str] = None
+        self.elapsed = 0.0
+
+    @property
+    def rejected(self) -> int:
+        return sum(self.reasons.values())
+
+    def reject(self, line_no: int, reason: str):
+        self.reasons[reason] += 1
+        samples = self.samples.setdefault(reason, [])
+        if len(samples) < MAX_SAMPLE_LINES: samples.append(line_no)
+
+async def _load_categories(user_id: int) -> Dict[str, Dict[str, int]]:
+    """Допустимые категории по типам: имя в нижнем регистре -> id категории."""
+    allowed = {}
+    for category_type in ('expense', 'income'):
+        categories = db.get_standard_categories(user_id, category_type) + await db.get_user_categories(user_id, category_type)
+        allowed[category_type] = {category.name.lower(): category.id for category in categories}
+    return allowed
+
+def _detect_dialect(stream: TextIO):
+    """Разделитель по началу файла: Excel с русской локалью сохраняет CSV через ';'."""
+    sample = stream.read(8192); stream.seek(0)
+    try: return csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error: return csv.excel
+
+def _parse_row(row: List[str], user_id: int, categories: Dict[str, Dict[str, int]], report: ImportReport) -> Tuple[Optional[str], Optional[tuple]]:
+    """Проверяет строку CSV; возвращает (причина отказа, None) или (None, параметры INSERT)."""
+    if len(row) != len(CSV_COLUMNS): return "ожидалось 4 колонки", None
+    created_at = parse_datetime(row[0])
+    if created_at is None: return "неверная дата", None
+    transaction_type = parse_type(row[1])
+    if transaction_type is None: return "неизвестный тип (нужен expense/income)", None
+    try: amount = parse_amount(row[2])
+    except ValueError: return "неверная сумма", None
+    raw_category = row[3].strip()
+    category_id = categories[transaction_type].get(raw_category.lower())
+    if category_id is None:
+        report.unknown_categories[raw_category] += 1
+        return "неизвестная категория", None
+    return None, (user_id, transaction_type, amount, category_id, created_at)
+
+async def import_csv(user_id: int, stream: TextIO) -> ImportReport:
+    """
+    Построчно разбирает CSV и пишет принятые строки пачками по IMPORT_BATCH_ROWS.
+    Файл целиком в память не читается; каждые IMPORT_YIELD_ROWS строк управление
+    возвращается циклу событий, чтобы апдейты других пользователей не ждали импорт.
+    """
+    report = ImportReport()
+    started = time.perf_counter()
+    categories = await _load_categories(user_id)
+    batch: List[Tuple[int, str, int, int, str]] = []
+    try:
+        reader = csv.reader(stream, _detect_dialect(stream))
+        for row in reader:
+            if reader.line_num == 1 and is_header(row): continue
+            if not any(cell.strip() for cell in row): continue
+            report.rows += 1
+            reason, params = _parse_row(row, user_id, categories, report)
+            if reason: report.reject(reader.line_num, reason)
+            else: batch.append(params)
+            if len(batch) >= config.IMPORT_BATCH_ROWS:
+                # executemany выполняется в потоке aiosqlite, цикл событий в это время свободен
+                if not await db.import_transactions(batch): report.error = "ошибка записи в базу"; break
+                report.imported += len(batch); batch = []
+            elif report.rows % config.IMPORT_YIELD_ROWS == 0:
+                await asyncio.sleep(0)
+        else:
+            if batch:
+                if await db.import_transactions(batch): report.imported += len(batch)
+                else: report.error = "ошибка записи в базу"
+    except UnicodeDecodeError:
+        report.error = "файл должен быть в кодировке UTF-8"
+    except csv.Error as e:
+        report.error = f"некорректный CSV ({e})"
+    report.elapsed = time.perf_counter() - started
+    logging.info(f"CSV import for user {user_id}: rows={report.rows}, imported={report.imported}, rejected={report.rejected}, error={report.error}, {report.elapsed:.2f}s")
+    return report
+
+def format_import_report(report: ImportReport) -> str:
+    rate = report.imported / report.elapsed if report.elapsed > 0 else 0
+    lines = [
+        "✅ Импорт завершен" if report.error is None else f"⚠️ Импорт прерван: {html.escape(report.error)}",
+        f"Строк с данными: {report.rows}",
+        f"Записано: {hbold(report.imported)}",
+        f"Отклонено: {report.rejected}",
+        f"Скорость: {rate:.0f} строк/с ({report.elapsed:.2f} с)",
+    ]
+    if report.reasons:
+        lines.append("\n<b>Причины отказа:</b>")
+        for reason, count in report.reasons.most_common():
+            samples = ", ".join(str(n) for n in report.samples[reason])
+            more = "…" if count > len(report.samples[reason]) else ""
+            lines.append(f"• {html.escape(reason)}: {count} (строки {samples}{more})")
+    if report.unknown_categories:
+        top = ", ".join(f"{html.escape(name or '(пусто)')} ({count})" for name, count in report.unknown_categories.most_common(MAX_REPORTED_CATEGORIES))
+        lines.append(f"\nНеизвестные категории: {top}\nДобавьте их в 'Мои Категории' и повторите импорт отклоненных строк.")
+    return "\n".join(lines)
+
+@importer_router.message(Command("import"), StateFilter(None))
+async def cmd_import(message: types.Message, state: FSMContext):
+    await state.set_state(ImportStates.waiting_for_file)
+    await message.answer(
+        f"Отправьте CSV-файл документом. Колонки: {hbold(','.join(CSV_COLUMNS))}\n"
+        f"Дата: 2024-01-31 18:30:00 или 31.01.2024, тип: expense/income (или Расход/Доход), "
+        f"сумма: 1234.56, категория - стандартная или ваша. Кодировка UTF-8, разделитель ',' или ';'.",
+        reply_markup=kb.cancel_kb
+    )
+
+@importer_router.message(StateFilter(ImportStates.waiting_for_file), F.document)
+async def process_import_file(message: types.Message, state: FSMContext, bot: Bot):
+    document = message.document; user_id = message.from_user.id
+    if document.file_size and document.file_size > config.IMPORT_MAX_FILE_MB * 1024 * 1024:
+        await message.answer(f"Файл больше {config.IMPORT_MAX_FILE_MB} МБ. Разбейте его на части.", reply_markup=kb.cancel_kb); return
+    if not (document.file_name or "").lower().endswith((".csv", ".txt")) and document.mime_type not in ("text/csv", "text/plain"):
+        await message.answer("Нужен файл в формате CSV.", reply_markup=kb.cancel_kb); return
+    await state.clear()
+    await message.answer("Файл получен, импортирую...")
+    # Небольшие файлы остаются в памяти, большие SpooledTemporaryFile сам переносит на диск
+    with SpooledTemporaryFile(max_size=config.IMPORT_SPOOL_MB * 1024 * 1024) as spool:
+        try: await bot.download(document, destination=spool)
+        except Exception as e:
+            logging.error(f"Failed to download import file from user {user_id}: {e}")
+            await message.answer("Не удалось загрузить файл. Попробуйте еще раз.", reply_markup=kb.main_kb); return
+        stream = io.TextIOWrapper(spool, encoding="utf-8-sig", newline="")
+        try: report = await import_csv(user_id, stream)
+        finally: stream.detach()
+    await message.answer(format_import_report(report), reply_markup=kb.main_kb)
+
+@importer_router.message(StateFilter(ImportStates.waiting_for_file))
+async def incorrect_import_input(message: types.Message):
+    await message.answer("Отправьте CSV-файл документом или нажмите 'Отмена'.")
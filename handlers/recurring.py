@@ -0,0 +1,129 @@
+# handlers/recurring.py
+import html
+import logging
+from datetime import datetime, timezone
+from typing import Any, Tuple
+from aiogram import Router, types, F
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.utils.markdown import hbold
+import config
+import keyboards as kb
+import db
+import scheduler
+from money import parse_amount, format_amount
+from states import RecurringStates
+
+recurring_router = Router() # Роутер для регулярных записей
+
+PERIOD_LABELS = {'daily': "каждый день", 'weekly': "каждую неделю", 'monthly': "каждый месяц"}
+
+def describe_rule(rule: Any) -> str:
+    sign = "➖" if rule['transaction_type'] == 'expense' else "➕"
+    next_run = scheduler.parse_ts(rule['next_run_at']).strftime('%d.%m.%Y')
+    return f"{sign} {format_amount(rule['amount'])} {rule['category']}, {PERIOD_LABELS[rule['period']]} (след. {next_run})"
+
+async def _recurring_menu(user_id: int) -> Tuple[str, types.InlineKeyboardMarkup]:
+    rules = await db.get_user_recurring_rules(user_id)
+    rules_text = "\n".join(f"- {html.escape(describe_rule(rule), quote=False)}" for rule in rules) if rules else "Правил пока нет."
+    text = f"🔁 <b>Регулярные записи</b>\n\n{rules_text}\n\nВыберите действие:"
+    return text, kb.get_recurring_menu_kb(bool(rules))
+
+@recurring_router.message(Command("recurring"), StateFilter(None))
+async def process_recurring(message: types.Message, state: FSMContext):
+    await state.clear(); user_id = message.from_user.id; logging.info(f"Регулярные записи от {user_id}")
+    text, reply_markup = await _recurring_menu(user_id)
+    await message.answer(text, reply_markup=reply_markup)
+    await state.set_state(RecurringStates.choosing_action)
+
+@recurring_router.callback_query(StateFilter(RecurringStates.choosing_action), F.data.startswith("rec_manage:"))
+@recurring_router.callback_query(StateFilter(RecurringStates), F.data == "rec_manage:menu")
+async def process_recurring_action_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    action = callback_query.data.split(":")[1]; user_id = callback_query.from_user.id; message = callback_query.message
+    if action == "add":
+        if len(await db.get_user_recurring_rules(user_id)) >= config.RECURRING_MAX_PER_USER:
+            await callback_query.answer(f"Не больше {config.RECURRING_MAX_PER_USER} правил.", show_alert=True); return
+        await state.set_state(RecurringStates.choosing_type)
+        await message.edit_text("Что записывать регулярно?", reply_markup=kb.get_recurring_type_kb())
+    elif action == "delete":
+        await state.set_state(RecurringStates.choosing_rule_to_delete)
+        rules = await db.get_user_recurring_rules(user_id)
+        await message.edit_text("Выберите правило для удаления:", reply_markup=kb.get_recurring_delete_kb([(rule['id'], describe_rule(rule)) for rule in rules]))
+    elif action == "back":
+        await state.clear()
+        await message.edit_text("Вы вышли из управления регулярными записями.", reply_markup=None)
+        await message.answer("Возврат в главное меню.", reply_markup=kb.main_kb)
+    elif action == "menu":
+        await state.set_state(RecurringStates.choosing_action)
+        text, reply_markup = await _recurring_menu(user_id)
+        await message.edit_text(text, reply_markup=reply_markup)
+    await callback_query.answer()
+
+# --- Создание правила: тип -> категория -> сумма -> периодичность ---
+
+@recurring_router.callback_query(StateFilter(RecurringStates.choosing_type), F.data.startswith("rec_type:"))
+async def process_recurring_type_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    transaction_type = callback_query.data.split(":")[1]
+    if transaction_type not in ('expense', 'income'): await callback_query.answer("Ошибка.", show_alert=True); return
+    await state.update_data(transaction_type=transaction_type)
+    await state.set_state(RecurringStates.choosing_category)
+    # Та же (кэшированная) клавиатура, что и при обычной записи; ее exp_cat:/inc_cat: здесь ловит этот роутер по состоянию
+    reply_markup = await kb.get_category_choice_kb(callback_query.from_user.id, transaction_type)
+    await callback_query.message.edit_text("Выберите категорию:", reply_markup=reply_markup)
+    await callback_query.answer()
+
+@recurring_router.callback_query(StateFilter(RecurringStates.choosing_category), F.data.startswith('exp_cat:') | F.data.startswith('inc_cat:'))
+async def process_recurring_category_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    user_data = await state.get_data()
+    try: category = await db.get_category(callback_query.from_user.id, int(callback_query.data.split(":", 1)[1]), active_only=True)
+    except ValueError: category = None
+    if category is None or category.category_type != user_data.get('transaction_type'): await callback_query.answer("Категория не найдена.", show_alert=True); return
+    await state.update_data(category_id=category.id, category=category.name)
+    await state.set_state(RecurringStates.waiting_for_amount)
+    await callback_query.message.edit_text(f"Категория {hbold(category.name)}. Введите сумму:", reply_markup=None)
+    await callback_query.answer()
+
+@recurring_router.message(StateFilter(RecurringStates.waiting_for_amount))
+async def process_recurring_amount(message: types.Message, state: FSMContext):
+    try: amount = parse_amount(message.text)
+    except ValueError: await message.answer("Введите корректную сумму (> 0, не более 2 знаков после запятой) или /cancel."); return
+    await state.update_data(amount=amount)
+    await state.set_state(RecurringStates.choosing_period)
+    await message.answer("Как часто записывать?", reply_markup=kb.get_recurring_period_kb())
+
+@recurring_router.callback_query(StateFilter(RecurringStates.choosing_period), F.data.startswith("rec_period:"))
+async def process_recurring_period_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    period = callback_query.data.split(":")[1]
+    if period not in scheduler.PERIODS: await callback_query.answer("Ошибка.", show_alert=True); return
+    user_data = await state.get_data(); user_id = callback_query.from_user.id
+    transaction_type, category_id, category, amount = user_data.get('transaction_type'), user_data.get('category_id'), user_data.get('category'), user_data.get('amount')
+    if not (transaction_type and category_id and category and isinstance(amount, int)):
+        await state.clear(); await callback_query.answer("Начните заново: /recurring", show_alert=True); return
+    # Первая запись - сейчас, дальше с выбранным шагом; ежемесячное правило помнит сегодняшнее число
+    now = datetime.now(timezone.utc)
+    anchor_day = now.day if period == 'monthly' else None
+    rule = await db.add_recurring_rule(user_id, transaction_type, amount, category_id, period, anchor_day, now.strftime(scheduler.TS_FORMAT))
+    await callback_query.message.edit_reply_markup(reply_markup=None)
+    if rule is not None:
+        scheduler.schedule(rule)
+        type_text = "Расход" if transaction_type == 'expense' else "Доход"
+        await callback_query.message.answer(
+            f"🔁 {type_text} {hbold(format_amount(amount))} в категории {hbold(category)} будет записываться {PERIOD_LABELS[period]}. "
+            f"Первая запись - сегодня.", reply_markup=kb.main_kb)
+    else:
+        await callback_query.message.answer("❌ Не удалось сохранить правило.", reply_markup=kb.main_kb)
+    await callback_query.answer(); await state.clear()
+
+# --- Удаление правила ---
+
+@recurring_router.callback_query(StateFilter(RecurringStates.choosing_rule_to_delete), F.data.startswith("rec_del:"))
+async def process_recurring_delete_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    try: rule_id = int(callback_query.data.split(":")[1])
+    except ValueError: await callback_query.answer("Ошибка.", show_alert=True); return
+    user_id = callback_query.from_user.id
+    success = await db.delete_recurring_rule(user_id, rule_id)
+    if success: scheduler.unschedule(user_id, rule_id)
+    await state.set_state(RecurringStates.choosing_action)
+    text, reply_markup = await _recurring_menu(user_id)
+    await callback_query.message.edit_text(text, reply_markup=reply_markup)
+    await callback_query.answer("Правило удалено." if success else "Правило не найдено.", show_alert=not success)
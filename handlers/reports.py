@@ -1,13 +1,22 @@
 # handlers/reports.py
+import asyncio
 import logging
 from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Tuple
 from aiogram import Router, types, F
-from aiogram.filters import Command, StateFilter
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
+from aiogram.types import BufferedInputFile
 # --- ДОБАВИТЬ ИМПОРТ ---
 from aiogram.utils.markdown import hbold, hitalic
+import charts
+import config
 import keyboards as kb
 import db
+import outbox
+import report_cache
+from money import format_amount
 
 reports_router = Router()
 
@@ -16,22 +25,53 @@ MONTH_NAMES_RU = {
     7: "Июль", 8: "Август", 9: "Сентябрь", 10: "Октябрь", 11: "Ноябрь", 12: "Декабрь"
 }
 
-def format_report_text(period_name: str, income: float, expense: float, details: dict[str, float]) -> str:
+def format_report_text(period_name: str, income: int, expense: int, details: dict[str, int]) -> str:
     # Здесь hbold не используется, форматирование уже применено при вызове
+    # Суммы в копейках: считаем целыми числами, в рубли переводим только при выводе
     balance = income - expense
     report_text = f"📊 <b>Отчет за {period_name}:</b>\n\n" \
-                  f"🟢 Доходы: {income:.2f}\n" \
-                  f"🔴 Расходы: {expense:.2f}\n\n" \
-                  f"💰 Баланс: {balance:.2f}\n"
+                  f"🟢 Доходы: {format_amount(income)}\n" \
+                  f"🔴 Расходы: {format_amount(expense)}\n\n" \
+                  f"💰 Баланс: {format_amount(balance)}\n"
     if details:
         report_text += "\n📈 <b>Расходы по категориям:</b>\n"
         sorted_details = sorted(details.items(), key=lambda item: item[1], reverse=True)
         for category, amount in sorted_details:
-            report_text += f" - {category}: {amount:.2f}\n"
+            report_text += f" - {category}: {format_amount(amount)}\n"
     elif expense > 0: report_text += "\n📈 Детализация расходов недоступна."
     else: report_text += "\n📈 Расходов в этом периоде не было."
     return report_text
 
+async def build_report_text(user_id: int, period_name: str, start_date: datetime, end_date: datetime) -> str:
+    """Текст отчета за [start_date, end_date); повторный запрос без изменений в периоде берется из кэша."""
+    cached = report_cache.get_text(user_id, start_date, end_date, period_name)
+    if cached is not None: return cached
+    data_version = report_cache.version(user_id)
+    summary = await db.get_period_summary_with_details(user_id, start_date, end_date)
+    report_text = format_report_text(period_name, *summary)
+    report_cache.put_text(user_id, start_date, end_date, period_name, report_text, summary, data_version)
+    return report_text
+
+def _remember_chart(key: str, future: asyncio.Future):
+    """file_id графика запоминается только по отправленному сообщению; отмена при остановке и ошибка - забывают прежний."""
+    sent = None if future.cancelled() or future.exception() is not None else future.result()
+    charts.remember_sent(key, sent if isinstance(sent, types.Message) else None)
+
+async def send_report_chart(message: types.Message, user_id: int, period_name: str, start_date: datetime, end_date: datetime):
+    """
+    Отправляет график расходов к отчету (config.REPORT_CHARTS). Суммы берутся из кэша отчетов,
+    картинка рисуется в пуле процессов charts.py; одинаковый график уходит по сохраненному file_id.
+    """
+    if not charts.enabled(): return
+    _, _, details = await db.get_period_summary_with_details(user_id, start_date, end_date)
+    if not details: return
+    daily = await db.get_daily_expenses(user_id, start_date, end_date)
+    try: key, photo = await charts.get_chart(period_name, details, daily, start_date, end_date)
+    except Exception as e: logging.error(f"Не уд. построить график {user_id}: {e}"); return
+    if isinstance(photo, bytes): photo = BufferedInputFile(photo, filename="report.png")
+    future = outbox.send(message.answer_photo(photo))
+    future.add_done_callback(lambda f: _remember_chart(key, f))
+
 @reports_router.message(F.text == "📈 Отчет за месяц", StateFilter(None))
 @reports_router.message(Command("report"), StateFilter(None))
 async def process_get_current_month_report(message: types.Message, state: FSMContext):
@@ -41,8 +81,8 @@ async def process_get_current_month_report(message: types.Message, state: FSMCon
     else: end_of_month = datetime(now.year, now.month + 1, 1, tzinfo=timezone.utc)
     month_number = start_of_month.month; month_name_str = MONTH_NAMES_RU.get(month_number, f"{month_number:02d}"); year_str = start_of_month.year
     report_period_name = f"тек. месяц ({month_name_str} {year_str})"
-    income, expense, details = await db.get_period_summary_with_details(user_id, start_of_month, end_of_month)
-    report_text = format_report_text(report_period_name, income, expense, details); await message.answer(report_text, reply_markup=kb.main_kb)
+    report_text = await build_report_text(user_id, report_period_name, start_of_month, end_of_month); await message.answer(report_text, reply_markup=kb.main_kb)
+    await send_report_chart(message, user_id, report_period_name, start_of_month, end_of_month)
 
 @reports_router.message(F.text == "📅 Отчет за прошлый месяц", StateFilter(None))
 @reports_router.message(Command("prevmonthreport"), StateFilter(None))
@@ -52,21 +92,110 @@ async def process_get_previous_month_report(message: types.Message, state: FSMCo
     start_of_previous_month = datetime((end_of_previous_month - timedelta(days=1)).year, (end_of_previous_month - timedelta(days=1)).month, 1, tzinfo=timezone.utc)
     month_number = start_of_previous_month.month; month_name_str = MONTH_NAMES_RU.get(month_number, f"{month_number:02d}"); year_str = start_of_previous_month.year
     report_period_name = f"прошлый месяц ({month_name_str} {year_str})"
-    income, expense, details = await db.get_period_summary_with_details(user_id, start_of_previous_month, end_of_previous_month)
-    report_text = format_report_text(report_period_name, income, expense, details); await message.answer(report_text, reply_markup=kb.main_kb)
+    report_text = await build_report_text(user_id, report_period_name, start_of_previous_month, end_of_previous_month); await message.answer(report_text, reply_markup=kb.main_kb)
+    await send_report_chart(message, user_id, report_period_name, start_of_previous_month, end_of_previous_month)
 
-@reports_router.message(F.text == "🕒 Последние записи", StateFilter(None))
-@reports_router.message(Command("recent"), StateFilter(None))
-async def process_get_recent(message: types.Message, state: FSMContext):
-    await state.clear(); user_id = message.from_user.id; logging.info(f"Последние записи от {user_id}")
-    transactions = await db.get_recent_transactions(user_id, limit=10)
-    if not transactions: await message.answer("Нет записей.", reply_markup=kb.main_kb); return
-    response_lines = ["🕒 <b>Последние 10 записей:</b>\n"]
-    for row in transactions:
+TELEGRAM_TEXT_LIMIT = 4096
+
+def _format_delta(current: int, previous: Optional[int]) -> str:
+    """Изменение к прошлому месяцу в процентах; если сравнивать не с чем (нет месяца или 0) - пусто."""
+    if not previous: return ""
+    change = (current - previous) * 100 / previous
+    return f" ({'▲' if change >= 0 else '▼'}{abs(change):.0f}%)"
+
+def format_trend_blocks(month_starts: List[datetime], data: Dict[str, Tuple[int, int, Dict[str, int]]]) -> List[str]:
+    """Блок текста на каждый месяц (по порядку) и итог; изменения считаются к предыдущему месяцу."""
+    blocks = []
+    previous: Optional[Tuple[int, int]] = None
+    total_income = total_expense = 0
+    for month_start in month_starts:
+        income, expense, details = data.get(month_start.strftime('%Y-%m'), (0, 0, {}))
+        month_name_str = MONTH_NAMES_RU.get(month_start.month, f"{month_start.month:02d}")
+        lines = [hbold(f"{month_name_str} {month_start.year}"),
+                 f"🟢 {format_amount(income)}{_format_delta(income, previous and previous[0])}  🔴 {format_amount(expense)}{_format_delta(expense, previous and previous[1])}",
+                 f"💰 Баланс: {format_amount(income - expense)}"]
+        if details:
+            top = sorted(details.items(), key=lambda item: item[1], reverse=True)[:config.TREND_TOP_CATEGORIES]
+            lines.append("Топ: " + ", ".join(f"{hitalic(category)} {format_amount(amount)}" for category, amount in top))
+        blocks.append("\n".join(lines))
+        previous = (income, expense); total_income += income; total_expense += expense
+    count = len(month_starts)
+    blocks.append(f"<b>Итого за {count} мес.:</b>\n🟢 {format_amount(total_income)}  🔴 {format_amount(total_expense)}\n"
+                  f"💰 Баланс: {format_amount(total_income - total_expense)}\nВ среднем расходы: {format_amount(total_expense // count)} в месяц")
+    return blocks
+
+def _pack_messages(header: str, blocks: List[str]) -> List[str]:
+    """Собирает блоки в сообщения не длиннее лимита Telegram (за 24 месяца текст в одно сообщение не помещается)."""
+    messages, current = [], header
+    for block in blocks:
+        if len(current) + 2 + len(block) > TELEGRAM_TEXT_LIMIT: messages.append(current); current = block
+        else: current = f"{current}\n\n{block}"
+    messages.append(current)
+    return messages
+
+@reports_router.message(Command("trend"), StateFilter(None))
+async def process_trend(message: types.Message, state: FSMContext, command: CommandObject):
+    await state.clear(); user_id = message.from_user.id
+    try: months_count = int(command.args) if command.args else config.TREND_DEFAULT_MONTHS
+    except ValueError: months_count = 0
+    if not 1 <= months_count <= config.TREND_MAX_MONTHS:
+        await message.answer(f"Укажите число месяцев от 1 до {config.TREND_MAX_MONTHS}, например: /trend 12", reply_markup=kb.main_kb); return
+    logging.info(f"Динамика за {months_count} мес. от {user_id}")
+    now = datetime.now(timezone.utc); month_starts = [datetime(now.year, now.month, 1, tzinfo=timezone.utc)]
+    for _ in range(months_count - 1): last_day = month_starts[0] - timedelta(days=1); month_starts.insert(0, datetime(last_day.year, last_day.month, 1, tzinfo=timezone.utc))
+    if now.month == 12: end_of_month = datetime(now.year + 1, 1, 1, tzinfo=timezone.utc)
+    else: end_of_month = datetime(now.year, now.month + 1, 1, tzinfo=timezone.utc)
+    # Один сгруппированный по месяцам запрос вместо отчета за каждый месяц
+    data = await db.get_monthly_trend(user_id, month_starts[0], end_of_month)
+    if not data: await message.answer(f"Нет записей за последние {months_count} мес.", reply_markup=kb.main_kb); return
+    header = f"📊 <b>Динамика за {months_count} мес.</b> (в скобках - изменение к предыдущему месяцу)"
+    for text in _pack_messages(header, format_trend_blocks(month_starts, data)): await message.answer(text, reply_markup=kb.main_kb)
+
+async def _load_recent_page(user_id: int, before_id: Optional[int] = None, after_id: Optional[int] = None) -> Tuple[List, bool, bool]:
+    """Страница истории и признаки (есть новее, есть старше). Одна строка сверх страницы показывает, есть ли продолжение."""
+    size = config.RECENT_PAGE_SIZE
+    if after_id is not None:
+        rows = await db.get_transactions_page(user_id, size + 1, after_id=after_id)
+        if len(rows) > size: return rows[1:], True, True
+        # Новее страницы не набралось (записи удалили) - показываем самую свежую страницу
+        if len(rows) == size: return rows, False, True
+        before_id = None
+    rows = await db.get_transactions_page(user_id, size + 1, before_id=before_id)
+    return rows[:size], before_id is not None, len(rows) > size
+
+def format_recent_text(rows: List, page: int) -> str:
+    response_lines = ["🕒 <b>Последние записи:</b>\n" if page <= 1 else f"🕒 <b>Записи, стр. {page}:</b>\n"]
+    for row in rows:
         try: dt_obj = datetime.fromisoformat(row['created_at']) if isinstance(row['created_at'], str) else row['created_at']; dt_str = dt_obj.strftime("%d.%m.%Y %H:%M")
         except: dt_str = str(row['created_at'])
         symbol = "🟢" if row['transaction_type'] == 'income' else "🔴"
         # Используем импортированный hitalic
-        line = f"{dt_str} {symbol} {row['amount']:.2f} - {hitalic(row['category'])}"
+        line = f"{dt_str} {symbol} {format_amount(row['amount'])} - {hitalic(row['category'])}"
         response_lines.append(line)
-    await message.answer("\n".join(response_lines), reply_markup=kb.main_kb)
\ No newline at end of file
+    return "\n".join(response_lines)
+
+@reports_router.message(F.text == "🕒 Последние записи", StateFilter(None))
+@reports_router.message(Command("recent"), StateFilter(None))
+async def process_get_recent(message: types.Message, state: FSMContext):
+    await state.clear(); user_id = message.from_user.id; logging.info(f"Последние записи от {user_id}")
+    rows, has_newer, has_older = await _load_recent_page(user_id)
+    if not rows: await message.answer("Нет записей.", reply_markup=kb.main_kb); return
+    nav_kb = kb.get_recent_nav_kb(rows[0]['id'], rows[-1]['id'], 1, has_newer, has_older)
+    await message.answer(format_recent_text(rows, 1), reply_markup=nav_kb or kb.main_kb)
+
+@reports_router.callback_query(F.data.startswith("recent:"))
+async def process_recent_page_callback(callback_query: types.CallbackQuery):
+    # Листание правит то же сообщение: без нового sendMessage на каждую страницу
+    try: _, direction, cursor, page = callback_query.data.split(":"); cursor = int(cursor); page = int(page)
+    except ValueError: logging.warning(f"Некорр. cb '{callback_query.data}' от {callback_query.from_user.id}"); await callback_query.answer("Ошибка.", show_alert=True); return
+    user_id = callback_query.from_user.id
+    if direction == 'n': rows, has_newer, has_older = await _load_recent_page(user_id, after_id=cursor)
+    else: rows, has_newer, has_older = await _load_recent_page(user_id, before_id=cursor)
+    if not rows: await callback_query.answer("Больше записей нет.", show_alert=True); return
+    if not has_newer: page = 1
+    nav_kb = kb.get_recent_nav_kb(rows[0]['id'], rows[-1]['id'], max(page, 1), has_newer, has_older)
+    try: await callback_query.message.edit_text(format_recent_text(rows, max(page, 1)), reply_markup=nav_kb)
+    except TelegramBadRequest as e:
+        # Повторное нажатие на ту же кнопку: содержимое не изменилось
+        if "message is not modified" not in str(e): logging.error(f"Не уд. обновить историю {user_id}: {e}")
+    await callback_query.answer()
@@ -1,13 +1,16 @@
 # handlers/transactions.py
 import logging
-from aiogram import Router, types, F, Bot # Добавил Bot
+from aiogram import Router, types, F
 from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 # --- ДОБАВИТЬ ИМПОРТ ---
 from aiogram.utils.markdown import hbold
 import keyboards as kb
 import db
+import outbox
+from money import parse_amount, format_amount
 from states import TransactionStates
+from handlers.budgets import format_budget_status
 
 transactions_router = Router()
 
@@ -23,8 +26,9 @@ async def process_add_income(message: types.Message, state: FSMContext):
     await message.answer("Введите сумму дохода:", reply_markup=kb.cancel_kb)
 @transactions_router.message(StateFilter(TransactionStates.waiting_for_amount))
 async def process_amount(message: types.Message, state: FSMContext):
-    try: amount_str = message.text.replace(',', '.'); amount = float(amount_str); assert amount > 0
-    except (ValueError, AssertionError): await message.answer("Введите корректную сумму (> 0)."); return
+    # Сумма хранится в копейках и разбирается как точная десятичная дробь
+    try: amount = parse_amount(message.text)
+    except ValueError: await message.answer("Введите корректную сумму (> 0, не более 2 знаков после запятой)."); return
     await state.update_data(amount=amount); user_data = await state.get_data(); transaction_type = user_data.get('transaction_type')
     await state.set_state(TransactionStates.waiting_for_category); user_id = message.from_user.id
     try: reply_markup = await kb.get_category_choice_kb(user_id, transaction_type)
@@ -35,23 +39,34 @@ async def process_amount(message: types.Message, state: FSMContext):
 
 
 @transactions_router.callback_query(StateFilter(TransactionStates.waiting_for_category), F.data.startswith('exp_cat:') | F.data.startswith('inc_cat:'))
-async def process_category_callback(callback_query: types.CallbackQuery, state: FSMContext, bot: Bot): # Добавил bot
+async def process_category_callback(callback_query: types.CallbackQuery, state: FSMContext):
     current_state = await state.get_state()
     if current_state != TransactionStates.waiting_for_category.state: await callback_query.answer("Начните заново.", show_alert=True); return
     code = callback_query.data
-    try: prefix, category = code.split(':', 1)
+    # В callback_data - id категории (кнопки старых версий с именем категории сюда не пройдут)
+    try: prefix, category_id = code.split(':', 1); category_id = int(category_id)
     except ValueError: logging.warning(f"Некорр. cb '{code}' от {callback_query.from_user.id}"); await callback_query.answer("Ошибка.", show_alert=True); return
     user_data = await state.get_data(); amount = user_data.get('amount'); transaction_type = user_data.get('transaction_type')
+    # Сумма должна быть в копейках (int); иное значение могло остаться от старой версии бота
+    if not isinstance(amount, int): await callback_query.answer("Начните заново.", show_alert=True); await state.clear(); return
     if (prefix == 'exp_cat' and transaction_type != 'expense') or (prefix == 'inc_cat' and transaction_type != 'income'): await callback_query.answer("Ошибка типа.", show_alert=True); return
-    try: await bot.edit_message_reply_markup(chat_id=callback_query.message.chat.id, message_id=callback_query.message.message_id, reply_markup=None)
-    except Exception as e: logging.error(f"Не уд. убрать клаву: {e}")
+    # Стандартные категории находятся в памяти, без запроса к БД; удаленную категорию (кнопка старой клавиатуры) не принимаем
+    category = await db.get_category(callback_query.from_user.id, category_id, active_only=True)
+    if category is None or category.category_type != transaction_type: await callback_query.answer("Категория не найдена.", show_alert=True); return
+    # Правка и ответ уходят через outbox: обработчик не ждет сеть, ошибки и лимиты Telegram обрабатываются там
+    outbox.send(callback_query.message.edit_reply_markup(reply_markup=None))
     success = await db.add_transaction(user_id=callback_query.from_user.id, transaction_type=transaction_type, amount=amount, category=category)
     if success:
         type_text = "Расход" if transaction_type == 'expense' else "Доход"
         # Используем импортированный hbold
-        await callback_query.message.answer(f"{type_text} на сумму {hbold(f'{amount:.2f}')} в категории {hbold(category)} успешно записан!", reply_markup=kb.main_kb)
+        text = f"{type_text} на сумму {hbold(format_amount(amount))} в категории {hbold(category.name)} успешно записан!"
+        if transaction_type == 'expense':
+            # Траты с начала месяца уже в памяти: проверка бюджета без запросов к БД
+            limit_spent = (await db.get_budget_usage(callback_query.from_user.id)).get(category.name)
+            if limit_spent: text += f"\n\n{format_budget_status(category.name, *limit_spent)}"
+        outbox.send(callback_query.message.answer(text, reply_markup=kb.main_kb))
     else:
-        await callback_query.message.answer("Не удалось сохранить запись.", reply_markup=kb.main_kb)
+        outbox.send(callback_query.message.answer("Не удалось сохранить запись.", reply_markup=kb.main_kb))
     await callback_query.answer(); await state.clear()
 
 @transactions_router.message(StateFilter(TransactionStates.waiting_for_category))
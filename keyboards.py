@@ -1,10 +1,9 @@
 # keyboards.py
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-# Импортируем стандартные категории из config
-from config import EXPENSE_CATEGORIES as STD_EXPENSE_CATS
-from config import INCOME_CATEGORIES as STD_INCOME_CATS
-from typing import List # Импортируем List для тайп-хинтов
+from config import CATEGORY_KB_CACHE_SIZE
+from typing import Dict, Iterable, List, Optional, Tuple # Импортируем List для тайп-хинтов
+from cache import LRUCache
 
 # --- Основная клавиатура (Reply Keyboard) ---
 btn_add_expense = KeyboardButton(text="📊 Записать Расход")
@@ -28,27 +27,20 @@ main_kb = ReplyKeyboardMarkup(keyboard=main_kb_layout, resize_keyboard=True)
 
 
 # --- Inline-клавиатура для ВЫБОРА категории ---
-async def get_category_choice_kb(user_id: int, category_type: str) -> InlineKeyboardMarkup:
-    """
-    Создает динамическую inline-клавиатуру для выбора категории.
-    Объединяет стандартные и пользовательские категории.
+# В callback_data кнопок категорий - id категории (db.Category.id), а не имя: имя на кириллице
+# быстро упирается в лимит Telegram 64 байта на callback_data.
 
-    :param user_id: ID пользователя Telegram.
-    :param category_type: Тип категории ('expense' или 'income').
-    :return: Объект InlineKeyboardMarkup.
-    """
-    # Динамический импорт db, чтобы избежать проблем с циклическим импортом
-    # если keyboards импортируются в db (хотя в нашем случае это не так)
-    import db
-    # Получаем пользовательские категории из БД
-    user_cats = await db.get_user_categories(user_id, category_type)
-    # Получаем стандартные категории из конфига
-    standard_cats = STD_EXPENSE_CATS if category_type == 'expense' else STD_INCOME_CATS
+# Общие клавиатуры только со стандартными категориями (большинство пользователей свои не заводят).
+# Ключ - кортеж стандартных категорий: id у каждого файла шарда свои
+_shared_category_kbs: Dict[tuple, InlineKeyboardMarkup] = {}
+# Клавиатуры пользователей со своими категориями: (user_id, category_type) -> (версия категорий, разметка)
+_category_kb_cache = LRUCache(CATEGORY_KB_CACHE_SIZE, name="category_keyboards")
 
-    # Объединяем списки через множества для удаления дубликатов,
-    # затем преобразуем обратно в список и сортируем.
-    all_cats_set = set(standard_cats) | set(user_cats)
-    all_cats_sorted = sorted(list(all_cats_set))
+def _build_category_kb(category_type: str, categories: Iterable) -> InlineKeyboardMarkup:
+    """Собирает разметку выбора категории из готового списка категорий (db.Category)."""
+    unique_cats = {}
+    for cat in categories: unique_cats.setdefault(cat.name, cat)
+    all_cats_sorted = sorted(unique_cats.values(), key=lambda cat: cat.name)
 
     # Используем InlineKeyboardBuilder для удобного создания
     builder = InlineKeyboardBuilder()
@@ -56,7 +48,7 @@ async def get_category_choice_kb(user_id: int, category_type: str) -> InlineKeyb
 
     # Добавляем кнопки для каждой категории
     for cat in all_cats_sorted:
-        builder.add(InlineKeyboardButton(text=cat, callback_data=f"{callback_prefix}{cat}"))
+        builder.add(InlineKeyboardButton(text=cat.name, callback_data=f"{callback_prefix}{cat.id}"))
 
     # Выстраиваем кнопки в ряды (по 2 в ряд, если их больше 4, иначе в один ряд)
     num_columns = 2 if len(all_cats_sorted) > 4 else 1
@@ -65,6 +57,49 @@ async def get_category_choice_kb(user_id: int, category_type: str) -> InlineKeyb
     # Возвращаем готовую разметку
     return builder.as_markup()
 
+def _get_shared_category_kb(category_type: str, standard_cats: tuple) -> InlineKeyboardMarkup:
+    markup = _shared_category_kbs.get(standard_cats)
+    if markup is None:
+        markup = _shared_category_kbs[standard_cats] = _build_category_kb(category_type, standard_cats)
+    return markup
+
+def get_category_kb_cache_stats() -> Dict[str, object]:
+    """Счетчики кэша готовых клавиатур категорий."""
+    return _category_kb_cache.stats()
+
+async def get_category_choice_kb(user_id: int, category_type: str) -> InlineKeyboardMarkup:
+    """
+    Создает динамическую inline-клавиатуру для выбора категории.
+    Объединяет стандартные и пользовательские категории.
+    Готовая разметка кэшируется и пересобирается только при смене версии категорий пользователя.
+
+    :param user_id: ID пользователя Telegram.
+    :param category_type: Тип категории ('expense' или 'income').
+    :return: Объект InlineKeyboardMarkup.
+    """
+    # Динамический импорт db, чтобы избежать проблем с циклическим импортом
+    # если keyboards импортируются в db (хотя в нашем случае это не так)
+    import db
+    key = (user_id, category_type)
+    version = db.get_category_version(user_id, category_type)
+    cached = _category_kb_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    # Получаем пользовательские категории из БД
+    user_cats = await db.get_user_categories(user_id, category_type)
+    # Стандартные категории файла пользователя (из памяти, см. db.get_standard_categories)
+    standard_cats = tuple(db.get_standard_categories(user_id, category_type))
+
+    if not user_cats:
+        markup = _get_shared_category_kb(category_type, standard_cats)
+    else:
+        markup = _build_category_kb(category_type, standard_cats + tuple(user_cats))
+    # Если категории успели измениться во время запроса, не кэшируем устаревшую разметку
+    if db.get_category_version(user_id, category_type) == version:
+        _category_kb_cache.put(key, (version, markup))
+    return markup
+
 # --- Функции-обертки для совместимости (не обязательно использовать) ---
 async def get_expense_categories_kb(user_id: int) -> InlineKeyboardMarkup:
     """Возвращает клавиатуру выбора категории расходов."""
@@ -114,11 +149,11 @@ def get_category_type_kb(action_prefix: str) -> InlineKeyboardMarkup:
     builder.row(InlineKeyboardButton(text="<< Назад", callback_data="cat_manage_menu")) # Возврат в меню управления
     return builder.as_markup()
 
-def get_categories_for_delete_kb(categories: List[str]) -> InlineKeyboardMarkup:
+def get_categories_for_delete_kb(categories: List) -> InlineKeyboardMarkup:
     """
     Возвращает inline-клавиатуру со списком пользовательских категорий для удаления.
 
-    :param categories: Список имен категорий для отображения.
+    :param categories: Список категорий (db.Category) для отображения.
     :return: Объект InlineKeyboardMarkup.
     """
     builder = InlineKeyboardBuilder()
@@ -126,14 +161,75 @@ def get_categories_for_delete_kb(categories: List[str]) -> InlineKeyboardMarkup:
         # Если список пуст, показываем сообщение
         builder.row(InlineKeyboardButton(text="Нет категорий для удаления", callback_data="no_cats_to_delete"))
     else:
-        # Для каждой категории создаем кнопку с префиксом 'cat_delete_confirm:'
+        # Для каждой категории создаем кнопку с префиксом 'cat_delete_confirm:' и id категории
         for cat in categories:
-            builder.row(InlineKeyboardButton(text=f"❌ {cat}", callback_data=f"cat_delete_confirm:{cat}"))
+            builder.row(InlineKeyboardButton(text=f"❌ {cat.name}", callback_data=f"cat_delete_confirm:{cat.id}"))
     # Кнопка Назад для возврата к выбору типа категории
     builder.row(InlineKeyboardButton(text="<< Назад", callback_data="cat_delete_choose_type"))
     return builder.as_markup()
 
 
+# --- Inline-клавиатуры для бюджетов (/budgets) ---
+
+def get_budgets_menu_kb(has_budgets: bool) -> InlineKeyboardMarkup:
+    """Главное меню бюджетов; кнопка удаления - только если лимиты уже есть."""
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="➕ Установить лимит", callback_data="bdg_manage:set"))
+    if has_budgets: builder.row(InlineKeyboardButton(text="➖ Удалить лимит", callback_data="bdg_manage:delete"))
+    builder.row(InlineKeyboardButton(text="Назад", callback_data="bdg_manage:back"))
+    return builder.as_markup()
+
+def get_budget_categories_kb(categories: List, action_prefix: str) -> InlineKeyboardMarkup:
+    """
+    Список категорий расходов (db.Category) для выбора в меню бюджетов.
+
+    :param action_prefix: Префикс для callback_data ('bdg_set:' или 'bdg_del:'), за ним - id категории.
+    """
+    builder = InlineKeyboardBuilder()
+    for cat in categories:
+        builder.row(InlineKeyboardButton(text=cat.name, callback_data=f"{action_prefix}{cat.id}"))
+    builder.row(InlineKeyboardButton(text="<< Назад", callback_data="bdg_manage:menu"))
+    return builder.as_markup()
+
+
+# --- Inline-клавиатуры для регулярных записей (/recurring) ---
+
+def get_recurring_menu_kb(has_rules: bool) -> InlineKeyboardMarkup:
+    """Главное меню регулярных записей; кнопка удаления - только если правила уже есть."""
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="➕ Добавить", callback_data="rec_manage:add"))
+    if has_rules: builder.row(InlineKeyboardButton(text="➖ Удалить", callback_data="rec_manage:delete"))
+    builder.row(InlineKeyboardButton(text="Назад", callback_data="rec_manage:back"))
+    return builder.as_markup()
+
+def get_recurring_type_kb() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.add(InlineKeyboardButton(text="Расход", callback_data="rec_type:expense"))
+    builder.add(InlineKeyboardButton(text="Доход", callback_data="rec_type:income"))
+    builder.row(InlineKeyboardButton(text="<< Назад", callback_data="rec_manage:menu"))
+    return builder.as_markup()
+
+def get_recurring_period_kb() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.add(InlineKeyboardButton(text="Каждый день", callback_data="rec_period:daily"))
+    builder.add(InlineKeyboardButton(text="Каждую неделю", callback_data="rec_period:weekly"))
+    builder.add(InlineKeyboardButton(text="Каждый месяц", callback_data="rec_period:monthly"))
+    builder.adjust(1)
+    return builder.as_markup()
+
+def get_recurring_delete_kb(rules: List[Tuple[int, str]]) -> InlineKeyboardMarkup:
+    """
+    Список правил для удаления.
+
+    :param rules: Пары (id правила, подпись кнопки).
+    """
+    builder = InlineKeyboardBuilder()
+    for rule_id, label in rules:
+        builder.row(InlineKeyboardButton(text=f"❌ {label}", callback_data=f"rec_del:{rule_id}"))
+    builder.row(InlineKeyboardButton(text="<< Назад", callback_data="rec_manage:menu"))
+    return builder.as_markup()
+
+
 # --- Inline-клавиатура для подтверждения УДАЛЕНИЯ ТРАНЗАКЦИИ ---
 def get_delete_confirmation_kb(transaction_id: int) -> InlineKeyboardMarkup:
     """
@@ -147,4 +243,19 @@ def get_delete_confirmation_kb(transaction_id: int) -> InlineKeyboardMarkup:
     builder.add(InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"delete_confirm:{transaction_id}"))
     builder.add(InlineKeyboardButton(text="🚫 Отмена", callback_data="delete_cancel"))
     # Выстраивать в один ряд не нужно, т.к. builder.add по умолчанию добавляет в текущий ряд
-    return builder.as_markup()
\ No newline at end of file
+    return builder.as_markup()
+
+
+# --- Inline-клавиатура навигации по истории (/recent) ---
+def get_recent_nav_kb(newest_id: int, oldest_id: int, page: int, has_newer: bool, has_older: bool) -> Optional[InlineKeyboardMarkup]:
+    """
+    Кнопки листания истории. В callback_data - курсор (id крайней записи страницы) и номер страницы:
+    'recent:n:<id>:<стр>' - записи новее id, 'recent:o:<id>:<стр>' - старше id.
+
+    :return: Объект InlineKeyboardMarkup или None, если листать некуда.
+    """
+    if not (has_newer or has_older): return None
+    builder = InlineKeyboardBuilder()
+    if has_newer: builder.add(InlineKeyboardButton(text="◀️ Новее", callback_data=f"recent:n:{newest_id}:{page - 1}"))
+    if has_older: builder.add(InlineKeyboardButton(text="Старше ▶️", callback_data=f"recent:o:{oldest_id}:{page + 1}"))
+    return builder.as_markup()
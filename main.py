@@ -1,32 +1,70 @@
 # main.py
 import logging
 import asyncio
+from typing import Optional
 from aiogram import Bot, Dispatcher, types
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.exceptions import TelegramAPIError
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 
 # Импортируем наши модули
+import charts
 import config
 import db
+import metrics
+import outbox
+import report_cache
+import scheduler
+from fsm_storage import SQLiteStorage, storage_stats
+import webhook
+from middlewares import HandlerMetricsMiddleware, UserSerialMiddleware
 # --- ИЗМЕНЕНИЕ: Импортируем новый роутер ---
-from handlers import common, transactions, categories, reports, deletion, custom_report
+from handlers import common, transactions, categories, reports, deletion, custom_report, importer, exporter, budgets, recurring
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Основная функция запуска
-async def main():
-    logging.info("Starting bot...")
+# Команды в меню бота
+BOT_COMMANDS = [
+    types.BotCommand(command="/start", description="Начать работу / Сбросить"),
+    types.BotCommand(command="/mycategories", description="Управление категориями"),
+    types.BotCommand(command="/report", description="Отчет за текущий месяц"),
+    types.BotCommand(command="/prevmonthreport", description="Отчет за прошлый месяц"),
+    types.BotCommand(command="/customreport", description="Отчет за период"), # <-- Добавлена команда
+    types.BotCommand(command="/trend", description="Динамика по месяцам"),
+    types.BotCommand(command="/budgets", description="Бюджеты по категориям"),
+    types.BotCommand(command="/recurring", description="Регулярные записи"),
+    types.BotCommand(command="/recent", description="Показать последние записи"),
+    types.BotCommand(command="/deletelast", description="Удалить последнюю запись"),
+    types.BotCommand(command="/import", description="Импорт истории из CSV"),
+    types.BotCommand(command="/export", description="Выгрузить историю в CSV"),
+    types.BotCommand(command="/cancel", description="Отменить текущее действие"),
+    types.BotCommand(command="/help", description="Помощь"),
+]
 
-    # Инициализация бота, хранилища и диспетчера
-    bot = Bot(
-        token=config.BOT_TOKEN,
-        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-    )
-    storage = MemoryStorage()
+def create_dispatcher(storage: Optional[BaseStorage] = None) -> Dispatcher:
+    """
+    Собирает диспетчер со всеми middleware и роутерами.
+    Используется и при запуске бота, и нагрузочным тестом (bench/loadtest.py).
+    Роутеры - объекты модулей, поэтому в процессе диспетчер собирается один раз.
+    """
+    # Состояния FSM храним в SQLite, чтобы незавершенные сценарии переживали перезапуск
+    if storage is None:
+        storage = SQLiteStorage() if config.FSM_STORAGE == 'sqlite' else MemoryStorage()
     dp = Dispatcher(storage=storage)
+    if config.USER_SERIAL_UPDATES:
+        # Апдейты обрабатываются задачами параллельно; этот middleware сохраняет порядок внутри одного пользователя
+        user_serial = UserSerialMiddleware()
+        dp.update.outer_middleware(user_serial)
+        metrics.register_collector("user_queues", user_serial.stats)
+    if config.METRICS_ENABLED:
+        # Inner-middleware родительского роутера действуют и на обработчики подключенных роутеров
+        handler_metrics = HandlerMetricsMiddleware()
+        dp.message.middleware(handler_metrics)
+        dp.callback_query.middleware(handler_metrics)
+    metrics.register_collector("fsm_storage", lambda: storage_stats(storage))
 
     # --- ИЗМЕНЕНИЕ: Регистрируем новый роутер ---
     dp.include_routers(
@@ -35,23 +73,34 @@ async def main():
         categories.categories_router,
         reports.reports_router,
         deletion.deletion_router,
-        custom_report.custom_report_router # <-- Добавляем роутер
+        custom_report.custom_report_router, # <-- Добавляем роутер
+        importer.importer_router,
+        exporter.exporter_router,
+        budgets.budgets_router,
+        recurring.recurring_router
     )
     logging.info("Routers included.")
+    return dp
+
+# Основная функция запуска
+async def main():
+    logging.info("Starting bot...")
+
+    # Инициализация бота, хранилища и диспетчера
+    bot = Bot(
+        token=config.BOT_TOKEN,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+    outbox.install(bot) # Все ответы в чаты - через очередь outbox с общими лимитами
+    dp = create_dispatcher()
 
     # --- ИЗМЕНЕНИЕ: Добавляем команду /customreport ---
-    await bot.set_my_commands([
-        types.BotCommand(command="/start", description="Начать работу / Сбросить"),
-        types.BotCommand(command="/mycategories", description="Управление категориями"),
-        types.BotCommand(command="/report", description="Отчет за текущий месяц"),
-        types.BotCommand(command="/prevmonthreport", description="Отчет за прошлый месяц"),
-        types.BotCommand(command="/customreport", description="Отчет за период"), # <-- Добавлена команда
-        types.BotCommand(command="/recent", description="Показать последние записи"),
-        types.BotCommand(command="/deletelast", description="Удалить последнюю запись"),
-        types.BotCommand(command="/cancel", description="Отменить текущее действие"),
-        types.BotCommand(command="/help", description="Помощь"),
-    ])
-    logging.info("Bot commands set.")
+    try:
+        await bot.set_my_commands(BOT_COMMANDS)
+        logging.info("Bot commands set.")
+    except Exception as e:
+        # Без доступа к API (например, при локальной проверке вебхука) работаем без списка команд
+        logging.error(f"Failed to set bot commands: {e}")
 
     # Подключаемся к БД
     if not await db.connect_db():
@@ -59,14 +108,28 @@ async def main():
         if bot.session: await bot.session.close()
         return
     logging.info("SQLite Database connected and table initialized.")
+    # Планировщик регулярных записей живет, пока открыто соединение с БД
+    await scheduler.start()
+    metrics.register_collector("write_behind", db.get_write_behind_stats)
+    metrics.register_collector("category_cache", db.get_category_cache_stats)
+    metrics.register_collector("budgets", db.get_budget_cache_stats)
+    metrics.register_collector("report_cache", report_cache.stats)
+    metrics.register_collector("outbox", outbox.get_stats)
+    metrics.register_collector("charts", charts.stats)
+    metrics.register_collector("recurring", scheduler.get_stats)
+    if config.REPORT_CHARTS and not charts.AVAILABLE:
+        logging.warning("REPORT_CHARTS is on, but matplotlib is not installed: reports are sent without charts.")
+    await metrics.start()
 
-    # Удаляем вебхук перед запуском polling
-    await bot.delete_webhook(drop_pending_updates=True)
-
-    # Запускаем polling
-    logging.info("Starting polling...")
     try:
-        await dp.start_polling(bot)
+        if config.BOT_MODE == 'webhook':
+            # Вебхук: сервер работает до сигнала остановки и дообрабатывает принятые апдейты
+            await webhook.run_webhook(dp, bot)
+        else:
+            # Удаляем вебхук перед запуском polling
+            await bot.delete_webhook(drop_pending_updates=True)
+            logging.info("Starting polling...")
+            await dp.start_polling(bot)
     except TelegramAPIError as e:
          if "bot was blocked" in str(e).lower(): logging.warning(f"Bot was blocked by user: {e}")
          else: logging.error(f"Telegram API error during polling: {e}", exc_info=True)
@@ -74,8 +137,18 @@ async def main():
         logging.error(f"Unexpected non-API error during polling: {e}", exc_info=True)
     finally:
         logging.info("Shutting down bot...")
-        await db.close_db()
+        await metrics.stop()
+        # Исходящие сообщения отправляем, пока сессия бота еще открыта
+        await outbox.drain()
+        await scheduler.stop()
+        # Дописываем отложенные вставки до закрытия соединения
+        await db.drain_write_queue()
+        logging.info(f"Write-behind stats: {db.get_write_behind_stats()}")
+        logging.info(f"Report cache stats: {report_cache.stats()}")
+        # Хранилище FSM дописывает накопленные изменения, поэтому закрывается до БД
         await dp.storage.close()
+        await db.close_db()
+        charts.shutdown()
         if bot.session: await bot.session.close()
         logging.info("Bot shut down gracefully.")
 
@@ -0,0 +1,221 @@
+# metrics.py
+"""
+Метрики процесса в текстовом формате Prometheus.
+
+Гистограммы - фиксированные корзины и счетчики в памяти: наблюдение стоит один bisect
+и пару сложений, поэтому метрики можно держать включенными в бою.
+Источники:
+  - HandlerMetricsMiddleware (middlewares.py) - время и ошибки по каждому обработчику;
+  - timed_query - время функций db.py и число возвращенных строк;
+  - фоновая задача - задержка цикла событий;
+  - коллекторы - снимки счетчиков других модулей (FSM, кэши, write-behind) в момент выдачи.
+Отдаются по HTTP (config.METRICS_PORT) и пишутся в файл по SIGUSR1.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import signal
+import sqlite3
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+import config
+
+# Секунды: от быстрых обращений к кэшу до медленного экспорта
+LATENCY_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Последняя корзина - +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        # bisect_left: значение, равное границе, попадает в корзину этой границы (le - "меньше или равно")
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+class HistogramFamily:
+    """Гистограммы одной метрики с одной меткой (или без меток, label=None)."""
+
+    def __init__(self, name: str, help_text: str, label: Optional[str] = None, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.help, self.label, self.buckets = name, help_text, label, buckets
+        self.children: Dict[str, Histogram] = {}
+
+    def labels(self, value: str = "") -> Histogram:
+        child = self.children.get(value)
+        if child is None: child = self.children[value] = Histogram(self.buckets)
+        return child
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} histogram")
+        for label_value, hist in sorted(self.children.items()):
+            labels = f'{self.label}="{_escape(label_value)}",' if self.label else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, hist.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {hist.count}')
+            suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {_number(hist.sum)}")
+            lines.append(f"{self.name}_count{suffix} {hist.count}")
+
+class CounterFamily:
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name, self.help, self.label = name, help_text, label
+        self.values: Dict[str, float] = {}
+
+    def inc(self, label_value: str, amount: float = 1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} counter")
+        for label_value, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {_number(value)}')
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value: float) -> str:
+    if isinstance(value, bool): value = int(value)
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+handler_seconds = HistogramFamily("bot_handler_duration_seconds", "Handler execution time.", "handler")
+handler_errors = CounterFamily("bot_handler_errors_total", "Exceptions raised by handlers.", "handler")
+db_query_seconds = HistogramFamily("bot_db_query_duration_seconds", "db.py call time, by function.", "query")
+db_rows = CounterFamily("bot_db_rows_total", "Rows returned by db.py calls, by function.", "query")
+loop_lag_seconds = HistogramFamily("bot_event_loop_lag_seconds", "Delay of a periodic timer beyond its deadline.")
+_families = [handler_seconds, handler_errors, db_query_seconds, db_rows, loop_lag_seconds]
+
+# Коллекторы: имя -> функция, возвращающая словарь числовых значений (нечисловые пропускаются)
+_collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+_last_loop_lag = 0.0
+
+_lag_task: Optional[asyncio.Task] = None
+_runner: Optional[web.AppRunner] = None
+_signal_installed = False
+
+def register_collector(name: str, collect: Callable[[], Dict[str, Any]]):
+    """Значения collect() отдаются как gauge bot_<name>_<ключ> при каждой выдаче метрик."""
+    _collectors[name] = collect
+
+def observe_query(name: str, seconds: float, rows: int = 0):
+    if not config.METRICS_ENABLED: return
+    db_query_seconds.labels(name).observe(seconds)
+    if rows: db_rows.inc(name, rows)
+
+def timed_query(func):
+    """
+    Декоратор корутин db.py: время вызова и число строк в результате (список - его длина,
+    одна строка БД - 1). При выключенных метриках функция возвращается без обертки.
+    """
+    if not config.METRICS_ENABLED: return func
+    name = func.__name__
+    histogram = db_query_seconds.labels(name)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try: result = await func(*args, **kwargs)
+        finally: histogram.observe(time.perf_counter() - started)
+        if isinstance(result, list):
+            if result: db_rows.inc(name, len(result))
+        elif isinstance(result, sqlite3.Row): db_rows.inc(name, 1)
+        return result
+    return wrapper
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines: List[str] = []
+    for family in _families: family.render(lines)
+    try: tasks = len(asyncio.all_tasks())
+    except RuntimeError: tasks = 0 # Вызов вне цикла событий
+    gauges = {"event_loop": {"lag_last_seconds": _last_loop_lag, "tasks": tasks}}
+    for name, collect in list(_collectors.items()):
+        try: gauges[name] = collect()
+        except Exception as e: logging.error(f"Metrics collector '{name}' failed: {e}")
+    for name, values in gauges.items():
+        for key, value in values.items():
+            if not isinstance(value, (int, float)): continue
+            metric = f"bot_{name}_{key}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {_number(value)}")
+    lines.append("")
+    return "\n".join(lines)
+
+def dump(path: Optional[str] = None) -> Optional[str]:
+    """Пишет снимок метрик в файл (по умолчанию config.METRICS_DUMP_FILE)."""
+    path = path or config.METRICS_DUMP_FILE
+    try:
+        with open(path, 'w', encoding='utf-8') as f: f.write(render())
+        logging.info(f"Metrics dumped to {path}")
+        return path
+    except Exception as e:
+        logging.error(f"Error dumping metrics to {path}: {e}")
+        return None
+
+async def _sample_loop_lag(interval: float):
+    global _last_loop_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        deadline = loop.time() + interval
+        await asyncio.sleep(interval)
+        # Насколько позже срока проснулся таймер: столько ждал любой апдейт, готовый к обработке
+        _last_loop_lag = max(0.0, loop.time() - deadline)
+        loop_lag_seconds.observe(_last_loop_lag)
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+async def start():
+    """Запускает замер задержки цикла, HTTP-эндпоинт и снимок по SIGUSR1."""
+    global _lag_task, _runner, _signal_installed
+    if not config.METRICS_ENABLED: return
+    if _lag_task is None and config.METRICS_LOOP_LAG_INTERVAL > 0:
+        _lag_task = asyncio.create_task(_sample_loop_lag(config.METRICS_LOOP_LAG_INTERVAL))
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dump)
+        _signal_installed = True
+    except (AttributeError, NotImplementedError, RuntimeError): pass # Windows / не главный поток
+    if config.METRICS_PORT and _runner is None:
+        app = web.Application()
+        app.router.add_get(config.METRICS_PATH, _handle_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, config.METRICS_HOST, config.METRICS_PORT).start()
+        except OSError as e:
+            # Занятый порт не должен мешать работе бота
+            logging.error(f"Metrics endpoint not started on {config.METRICS_HOST}:{config.METRICS_PORT}: {e}")
+            await runner.cleanup()
+            return
+        _runner = runner
+        logging.info(f"Metrics endpoint listening on http://{config.METRICS_HOST}:{config.METRICS_PORT}{config.METRICS_PATH}")
+
+async def stop():
+    global _lag_task, _runner, _signal_installed
+    if _signal_installed:
+        try: asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+        except (NotImplementedError, RuntimeError): pass
+        _signal_installed = False
+    if _lag_task:
+        _lag_task.cancel()
+        try: await _lag_task
+        except asyncio.CancelledError: pass
+        _lag_task = None
+    if _runner:
+        await _runner.cleanup()
+        _runner = None
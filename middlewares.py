@@ -0,0 +1,90 @@
+# middlewares.py
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+import config
+import metrics
+
+class _UserSlot:
+    __slots__ = ('lock', 'depth')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0 # Апдейты пользователя в обработке + ожидающие своей очереди
+
+class UserSerialMiddleware(BaseMiddleware):
+    """
+    Outer-middleware для dp.update: апдейты разных пользователей идут параллельно,
+    а апдейты одного пользователя - по одному в порядке поступления (asyncio.Lock честный).
+    Это исключает гонки внутри сценариев FSM, например двойную запись транзакции
+    при двух быстрых нажатиях на категорию.
+    Блокировка пользователя удаляется, как только его очередь опустела.
+    """
+
+    def __init__(self, warn_depth: int = config.USER_QUEUE_WARN_DEPTH):
+        self.warn_depth = warn_depth
+        self._slots: Dict[int, _UserSlot] = {}
+        self.max_depth_seen = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: User = data.get('event_from_user')
+        if user is None: return await handler(event, data)
+        slot = self._slots.get(user.id)
+        if slot is None: slot = self._slots[user.id] = _UserSlot()
+        slot.depth += 1
+        if slot.depth > self.max_depth_seen: self.max_depth_seen = slot.depth
+        if self.warn_depth and slot.depth == self.warn_depth:
+            logging.warning(f"User {user.id} has {slot.depth} updates queued")
+        try:
+            async with slot.lock:
+                return await handler(event, data)
+        finally:
+            slot.depth -= 1
+            if slot.depth == 0: self._slots.pop(user.id, None)
+
+    def queue_depths(self) -> Dict[int, int]:
+        """Глубина очереди по пользователям (только пользователи с апдейтами в работе)."""
+        return {user_id: slot.depth for user_id, slot in self._slots.items()}
+
+    def stats(self) -> Dict[str, int]:
+        depths = [slot.depth for slot in self._slots.values()]
+        return {
+            "active_users": len(depths),
+            "queued_updates": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "max_queue_depth_seen": self.max_depth_seen,
+        }
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner-middleware для dp.message и dp.callback_query: время выполнения и исключения
+    по каждому обработчику. Inner-middleware вызывается уже после выбора обработчика,
+    поэтому метка - имя его функции.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.handler_errors.inc(name)
+            raise
+        finally:
+            metrics.handler_seconds.labels(name).observe(time.perf_counter() - started)
@@ -0,0 +1,602 @@
+# migrations.py
+"""
+Версионированные миграции схемы SQLite.
+
+Номер последней полностью примененной миграции хранится в PRAGMA user_version,
+поэтому при актуальной схеме запуск стоит одного чтения этой прагмы.
+
+Каждая миграция состоит из схемной части (идемпотентной, выполняется при старте)
+и, при необходимости, фонового дозаполнения данных (backfill). Backfill идет
+порциями уже после старта бота, свой прогресс хранит в таблице migration_state
+и после перезапуска продолжается с места остановки. user_version поднимается
+только до миграции, перед которой нет незавершенных backfill.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiosqlite
+
+import config
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[aiosqlite.Connection], Awaitable[None]]
+    # Возвращает True, когда дозаполнение завершено; вызывается в фоне для каждого файла БД (номер шарда - третий аргумент)
+    backfill: Optional[Callable[[aiosqlite.Connection, asyncio.Event, int], Awaitable[bool]]] = None
+
+# amount хранится в целых копейках (см. money.py). Прежний вид таблицы - с именем категории; с миграции 9 см. TRANSACTIONS_V9_TABLE_SQL
+TRANSACTIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        transaction_type TEXT NOT NULL CHECK(transaction_type IN ('expense', 'income')),
+        amount INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+async def _get_state(conn: aiosqlite.Connection, name: str) -> Optional[str]:
+    # execute_fetchall - одним вызовом: фоновые миграции делят соединение с обработчиками, и
+    # незавершенный SELECT между execute и fetch сорвал бы их commit
+    rows = await conn.execute_fetchall("SELECT value FROM migration_state WHERE name = ?", (name,))
+    return rows[0][0] if rows else None
+
+async def _set_state(conn: aiosqlite.Connection, name: str, value: str):
+    await conn.execute(
+        "INSERT INTO migration_state (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+        (name, value),
+    )
+
+async def _column_type(conn: aiosqlite.Connection, table: str, column: str) -> Optional[str]:
+    async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+        return next((row[2].upper() for row in await cursor.fetchall() if row[1] == column), None)
+
+# --- 1: базовые таблицы ---
+
+async def _m001_base_schema(conn: aiosqlite.Connection):
+    await conn.execute(TRANSACTIONS_TABLE_SQL.format(table='transactions'))
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_month ON transactions (user_id, created_at)")
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        category_type TEXT NOT NULL CHECK(category_type IN ('expense', 'income')),
+        category_name TEXT NOT NULL,
+        -- Уникальность имени категории для пользователя и типа
+        UNIQUE(user_id, category_type, category_name)
+    )
+    """)
+    # Прогресс фоновых миграций данных
+    await conn.execute("CREATE TABLE IF NOT EXISTS migration_state (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+# --- 2: суммы в копейках ---
+
+async def _m002_amount_minor_units(conn: aiosqlite.Connection):
+    """
+    Переводит transactions.amount из REAL (рубли) в INTEGER (копейки).
+    Строки копируются в transactions_minor порциями по config.DB_MIGRATION_CHUNK_ROWS с commit
+    после каждой и продолжаются с места остановки после перезапуска. В конце одной короткой
+    транзакцией докопируются новые строки и таблицы меняются местами.
+    Миграция выполняется до старта бота: пока она не закончена, суммы в таблице в других единицах.
+    """
+    if await _column_type(conn, 'transactions', 'amount') != 'REAL': return
+
+    logging.info("Migrating transactions.amount from REAL to INTEGER minor units...")
+    await conn.execute(TRANSACTIONS_TABLE_SQL.format(table='transactions_minor'))
+    await conn.commit()
+    copy_sql = """
+    INSERT INTO transactions_minor (id, user_id, transaction_type, amount, category, created_at)
+    SELECT id, user_id, transaction_type, CAST(ROUND(amount * 100) AS INTEGER), category, created_at
+    FROM transactions WHERE id > ? ORDER BY id LIMIT ?
+    """
+    chunk = max(1, config.DB_MIGRATION_CHUNK_ROWS)
+    async with conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions_minor") as cursor:
+        last_id = (await cursor.fetchone())[0]
+    copied_total = 0
+    while True:
+        async with conn.execute(copy_sql, (last_id, chunk)) as cursor:
+            copied = cursor.rowcount
+        await conn.commit()
+        if copied <= 0: break
+        copied_total += copied
+        async with conn.execute("SELECT MAX(id) FROM transactions_minor") as cursor:
+            last_id = (await cursor.fetchone())[0]
+        logging.info(f"Amount migration: {copied_total} rows converted (last id {last_id})")
+        if copied < chunk: break
+
+    # Финальная замена: старые индексы и триггеры удаляются вместе с таблицей
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        await conn.execute(copy_sql, (last_id, -1))
+        # Переносим счетчик AUTOINCREMENT, чтобы id удаленных записей не выдавались повторно
+        await conn.execute("DELETE FROM sqlite_sequence WHERE name = 'transactions_minor'")
+        await conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'transactions_minor', seq FROM sqlite_sequence WHERE name = 'transactions'")
+        await conn.execute("DROP TABLE transactions")
+        await conn.execute("ALTER TABLE transactions_minor RENAME TO transactions")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_month ON transactions (user_id, created_at)")
+        # Суммы в rollup тоже были в рублях - таблица будет создана и заполнена заново
+        await conn.execute("DROP TABLE IF EXISTS monthly_rollup")
+        await conn.execute("DELETE FROM migration_state WHERE name LIKE 'rollup_backfill%'")
+        await conn.commit()
+    except Exception:
+        await conn.rollback()
+        raise
+    logging.info(f"Amount migration finished: {copied_total} rows now store INTEGER minor units.")
+
+# --- 3: покрывающий индекс для отчетов за период ---
+
+async def _m003_period_cover_index(conn: aiosqlite.Connection):
+    # Все колонки отчета есть в самом индексе, таблица при чтении не затрагивается
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_period_cover ON transactions (user_id, created_at, transaction_type, category, amount)")
+
+# --- 4: хранилище FSM ---
+
+async def _m004_fsm_storage(conn: aiosqlite.Connection):
+    # Состояния FSM (см. fsm_storage.SQLiteStorage); data - JSON
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_storage (
+        storage_key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_updated_at ON fsm_storage (updated_at)")
+
+# --- 5: помесячный rollup ---
+
+ROLLUP_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_insert AFTER INSERT ON transactions
+    BEGIN
+        INSERT INTO monthly_rollup (user_id, month, transaction_type, category, total_amount, tx_count)
+        VALUES (NEW.user_id, strftime('%Y-%m', NEW.created_at), NEW.transaction_type, NEW.category, NEW.amount, 1)
+        ON CONFLICT (user_id, month, transaction_type, category)
+        DO UPDATE SET total_amount = total_amount + excluded.total_amount, tx_count = tx_count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_delete AFTER DELETE ON transactions
+    BEGIN
+        UPDATE monthly_rollup SET total_amount = total_amount - OLD.amount, tx_count = tx_count - 1
+        WHERE user_id = OLD.user_id AND month = strftime('%Y-%m', OLD.created_at)
+          AND transaction_type = OLD.transaction_type AND category = OLD.category;
+        DELETE FROM monthly_rollup
+        WHERE user_id = OLD.user_id AND month = strftime('%Y-%m', OLD.created_at)
+          AND transaction_type = OLD.transaction_type AND category = OLD.category AND tx_count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_update AFTER UPDATE OF user_id, transaction_type, amount, category, created_at ON transactions
+    BEGIN
+        UPDATE monthly_rollup SET total_amount = total_amount - OLD.amount, tx_count = tx_count - 1
+        WHERE user_id = OLD.user_id AND month = strftime('%Y-%m', OLD.created_at)
+          AND transaction_type = OLD.transaction_type AND category = OLD.category;
+        DELETE FROM monthly_rollup
+        WHERE user_id = OLD.user_id AND month = strftime('%Y-%m', OLD.created_at)
+          AND transaction_type = OLD.transaction_type AND category = OLD.category AND tx_count <= 0;
+        INSERT INTO monthly_rollup (user_id, month, transaction_type, category, total_amount, tx_count)
+        VALUES (NEW.user_id, strftime('%Y-%m', NEW.created_at), NEW.transaction_type, NEW.category, NEW.amount, 1)
+        ON CONFLICT (user_id, month, transaction_type, category)
+        DO UPDATE SET total_amount = total_amount + excluded.total_amount, tx_count = tx_count + 1;
+    END
+    """,
+]
+
+# Шард -> блокировка записи его соединения (db._Shard.write_lock). Фоновые дозаполнения пишут на том же
+# соединении, что и обработчики: порция от первого изменения до commit идет под этой блокировкой
+_write_locks: Dict[int, asyncio.Lock] = {}
+
+# Шард -> пользователи с user_id <= значения уже дозаполнены в monthly_rollup этого шарда; нет ключа - rollup полный
+rollup_backfilled_upto: Dict[int, int] = {}
+
+def rollup_ready(user_id: int, shard: int = 0) -> bool:
+    """Можно ли читать monthly_rollup для пользователя (его история в его шарде уже перенесена)."""
+    upto = rollup_backfilled_upto.get(shard)
+    return upto is None or user_id <= upto
+
+async def _m005_monthly_rollup(conn: aiosqlite.Connection):
+    # Помесячные суммы по (пользователь, месяц, тип, категория) для отчетов за целые месяцы.
+    # Поддерживается триггерами в той же транзакции, что и INSERT/DELETE в transactions,
+    # поэтому пачки write-behind и любые другие вставки учитываются автоматически.
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS monthly_rollup (
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL, -- 'YYYY-MM' по created_at (UTC)
+        transaction_type TEXT NOT NULL,
+        category TEXT NOT NULL,
+        total_amount INTEGER NOT NULL DEFAULT 0, -- копейки
+        tx_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, month, transaction_type, category)
+    ) WITHOUT ROWID
+    """)
+    for trigger_sql in ROLLUP_TRIGGERS:
+        await conn.execute(trigger_sql)
+    async with conn.execute("SELECT EXISTS(SELECT 1 FROM transactions)") as cursor:
+        has_transactions = (await cursor.fetchone())[0]
+    if not has_transactions:
+        await _set_state(conn, 'rollup_backfill', 'done')
+
+async def _load_rollup_progress(conn: aiosqlite.Connection, shard: int):
+    progress = await _get_state(conn, 'rollup_backfill')
+    if progress != 'done':
+        # История еще не перенесена: до окончания backfill отчеты читают сырые строки
+        rollup_backfilled_upto[shard] = int(progress) if progress else 0
+
+async def _b005_monthly_rollup(conn: aiosqlite.Connection, stop: asyncio.Event, shard: int) -> bool:
+    """
+    Пересчитывает rollup из истории порциями пользователей, в порядке user_id.
+    Дозаполнения идут после всех схемных частей, поэтому пересчет - сразу в схеме миграции 9 (category_id).
+    """
+    if await _get_state(conn, 'rollup_backfill') == 'done':
+        rollup_backfilled_upto.pop(shard, None)
+        return True
+    chunk_users = max(1, config.DB_BACKFILL_USERS_PER_CHUNK)
+    while not stop.is_set():
+        last_user = rollup_backfilled_upto.get(shard, 0)
+        rows = await conn.execute_fetchall("SELECT DISTINCT user_id FROM transactions WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_user, chunk_users))
+        user_ids = [row[0] for row in rows]
+        if not user_ids:
+            async with _write_locks[shard]:
+                await _set_state(conn, 'rollup_backfill', 'done')
+                await conn.commit()
+            rollup_backfilled_upto.pop(shard, None)
+            logging.info(f"Background migration: monthly_rollup backfill finished (shard {shard}).")
+            return True
+        first, last = user_ids[0], user_ids[-1]
+        # Под блокировкой чужой commit не зафиксирует половину порции, а чужой rollback не отменит ее
+        # после того, как rollup_backfilled_upto уже сдвинут
+        async with _write_locks[shard]:
+            try:
+                await conn.execute("DELETE FROM monthly_rollup WHERE user_id BETWEEN ? AND ?", (first, last))
+                # OR REPLACE: вставки, прошедшие через триггер во время пересчета, уже учтены в сырых строках
+                await conn.execute("""
+                INSERT OR REPLACE INTO monthly_rollup (user_id, month, transaction_type, category_id, total_amount, tx_count)
+                SELECT user_id, strftime('%Y-%m', created_at), transaction_type, category_id, SUM(amount), COUNT(*)
+                FROM transactions WHERE user_id BETWEEN ? AND ?
+                GROUP BY user_id, strftime('%Y-%m', created_at), transaction_type, category_id
+                """, (first, last))
+                await _set_state(conn, 'rollup_backfill', str(last))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        rollup_backfilled_upto[shard] = last
+        logging.info(f"Background migration: monthly_rollup backfilled up to user {last} (shard {shard})")
+        # Пауза между порциями, чтобы не занимать соединение записи надолго
+        await asyncio.sleep(config.DB_BACKFILL_PAUSE_MS / 1000)
+    return False
+
+# --- 6: индекс для keyset-пагинации по id ---
+
+async def _m006_user_id_index(conn: aiosqlite.Connection):
+    # Запись индекса содержит rowid, поэтому (user_id) фактически индекс по (user_id, id):
+    # выборки "WHERE user_id = ? AND id > ? ORDER BY id" идут по нему без сортировки
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON transactions (user_id)")
+
+# --- 7: бюджеты по категориям ---
+
+async def _m007_budgets(conn: aiosqlite.Connection):
+    # Месячный лимит расходов по категории, в копейках (см. budgets.py)
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS budgets (
+        user_id INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        monthly_limit INTEGER NOT NULL CHECK(monthly_limit > 0),
+        PRIMARY KEY (user_id, category)
+    ) WITHOUT ROWID
+    """)
+
+async def _m008_recurring_rules(conn: aiosqlite.Connection):
+    # Правила регулярных записей (см. scheduler.py); next_run_at - следующий срок в UTC, как created_at
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS recurring_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        transaction_type TEXT NOT NULL CHECK(transaction_type IN ('income', 'expense')),
+        amount INTEGER NOT NULL CHECK(amount > 0),
+        category TEXT NOT NULL,
+        period TEXT NOT NULL CHECK(period IN ('daily', 'weekly', 'monthly')),
+        anchor_day INTEGER,
+        next_run_at TEXT NOT NULL
+    )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_recurring_user ON recurring_rules (user_id)")
+
+# --- 9: справочник категорий, строки ссылаются на него по id ---
+
+# Стандартные категории хранятся с user_id = 0 (id пользователей Telegram положительные), свои - с id владельца.
+# Категория, удаленная пользователем, только выключается (is_active = 0): на нее ссылается история.
+CATEGORIES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        category_type TEXT NOT NULL CHECK(category_type IN ('expense', 'income')),
+        name TEXT NOT NULL,
+        is_active INTEGER NOT NULL DEFAULT 1,
+        UNIQUE(user_id, category_type, name)
+    )
+"""
+
+TRANSACTIONS_V9_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        transaction_type TEXT NOT NULL CHECK(transaction_type IN ('expense', 'income')),
+        amount INTEGER NOT NULL,
+        category_id INTEGER NOT NULL REFERENCES categories (id),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+ROLLUP_V9_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_insert AFTER INSERT ON transactions
+    BEGIN
+        INSERT INTO monthly_rollup (user_id, month, transaction_type, category_id, total_amount, tx_count)
+        VALUES (NEW.user_id, strftime('%Y-%m', NEW.created_at), NEW.transaction_type, NEW.category_id, NEW.amount, 1)
+        ON CONFLICT (user_id, month, transaction_type, category_id)
+        DO UPDATE SET total_amount = total_amount + excluded.total_amount, tx_count = tx_count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_delete AFTER DELETE ON transactions
+    BEGIN
+        UPDATE monthly_rollup SET total_amount = total_amount - OLD.amount, tx_count = tx_count - 1
+        WHERE user_id = OLD.user_id AND month = strftime('%Y-%m', OLD.created_at)
+          AND transaction_type = OLD.transaction_type AND category_id = OLD.category_id;
+        DELETE FROM monthly_rollup
+        WHERE user_id = OLD.user_id AND month = strftime('%Y-%m', OLD.created_at)
+          AND transaction_type = OLD.transaction_type AND category_id = OLD.category_id AND tx_count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_update AFTER UPDATE OF user_id, transaction_type, amount, category_id, created_at ON transactions
+    BEGIN
+        UPDATE monthly_rollup SET total_amount = total_amount - OLD.amount, tx_count = tx_count - 1
+        WHERE user_id = OLD.user_id AND month = strftime('%Y-%m', OLD.created_at)
+          AND transaction_type = OLD.transaction_type AND category_id = OLD.category_id;
+        DELETE FROM monthly_rollup
+        WHERE user_id = OLD.user_id AND month = strftime('%Y-%m', OLD.created_at)
+          AND transaction_type = OLD.transaction_type AND category_id = OLD.category_id AND tx_count <= 0;
+        INSERT INTO monthly_rollup (user_id, month, transaction_type, category_id, total_amount, tx_count)
+        VALUES (NEW.user_id, strftime('%Y-%m', NEW.created_at), NEW.transaction_type, NEW.category_id, NEW.amount, 1)
+        ON CONFLICT (user_id, month, transaction_type, category_id)
+        DO UPDATE SET total_amount = total_amount + excluded.total_amount, tx_count = tx_count + 1;
+    END
+    """,
+]
+
+# Заводит выключенными категории из строк source (user_id, category_type, name), которых нет ни среди стандартных,
+# ни у пользователя: импортированные из CSV и удаленные из списка пользователем
+_REGISTER_CATEGORIES_SQL = """
+    INSERT OR IGNORE INTO categories (user_id, category_type, name, is_active)
+    SELECT DISTINCT src.user_id, src.category_type, src.name, 0 FROM ({source}) src
+    WHERE NOT EXISTS (SELECT 1 FROM categories s WHERE s.user_id = 0 AND s.category_type = src.category_type AND s.name = src.name)
+"""
+
+def _category_id_sql(user_id: str, category_type: str, name: str) -> str:
+    """Выражение id категории по имени из старой строки: стандартная категория, если есть такая, иначе категория пользователя."""
+    return (f"COALESCE((SELECT id FROM categories WHERE user_id = 0 AND category_type = {category_type} AND name = {name}), "
+            f"(SELECT id FROM categories WHERE user_id = {user_id} AND category_type = {category_type} AND name = {name}))")
+
+async def sync_standard_categories(conn: aiosqlite.Connection):
+    """
+    Сверяет стандартные категории (user_id = 0) со списками в config: новые заводятся, убранные из config
+    выключаются (история на них ссылается). Без изменений в config ничего не пишет. Commit - за вызывающим.
+    """
+    # Сверка в Python, а не upsert: INSERT ... ON CONFLICT на каждом старте расходовал бы значения AUTOINCREMENT
+    current = {(row[0], row[1]): row[2] for row in await conn.execute_fetchall(
+        "SELECT category_type, name, is_active FROM categories WHERE user_id = 0")}
+    # Список, а не множество: новые категории заводятся в порядке config
+    wanted = [('expense', name) for name in config.EXPENSE_CATEGORIES] + [('income', name) for name in config.INCOME_CATEGORIES]
+    new = [key for key in wanted if key not in current]
+    if new:
+        await conn.executemany("INSERT INTO categories (user_id, category_type, name) VALUES (0, ?, ?)", new)
+    changed = [(1, *key) for key, active in current.items() if key in wanted and not active]
+    changed += [(0, *key) for key, active in current.items() if key not in wanted and active]
+    if changed:
+        await conn.executemany("UPDATE categories SET is_active = ? WHERE user_id = 0 AND category_type = ? AND name = ?", changed)
+
+async def _m009_category_ids(conn: aiosqlite.Connection):
+    """
+    Переносит стандартные и пользовательские категории в таблицу categories, а transactions, monthly_rollup,
+    budgets и recurring_rules переводит с имени категории на category_id.
+    Как в миграции 2, transactions копируется в transactions_v9 порциями по config.DB_MIGRATION_CHUNK_ROWS
+    с commit после каждой и после перезапуска продолжается с места остановки; категории, встреченные
+    в порции впервые, заводятся перед ее копированием. В конце одной транзакцией докопируются новые
+    строки и таблицы меняются местами. monthly_rollup создается пустым и заполняется в фоне
+    (_b005_monthly_rollup), до тех пор отчеты читают сырые строки.
+    """
+    await conn.execute(CATEGORIES_TABLE_SQL)
+    if await _column_type(conn, 'transactions', 'category_id') is not None: return
+
+    logging.info("Migrating category names to the categories table...")
+    await sync_standard_categories(conn)
+    # Свои категории с именем стандартной не переносятся: кнопка с этим именем у пользователя уже есть
+    await conn.execute("""
+    INSERT OR IGNORE INTO categories (user_id, category_type, name)
+    SELECT u.user_id, u.category_type, u.category_name FROM user_categories u
+    WHERE NOT EXISTS (SELECT 1 FROM categories s WHERE s.user_id = 0 AND s.category_type = u.category_type AND s.name = u.category_name)
+    """)
+    await conn.execute(TRANSACTIONS_V9_TABLE_SQL.format(table='transactions_v9'))
+    await conn.commit()
+
+    register_sql = _REGISTER_CATEGORIES_SQL.format(source="SELECT user_id, transaction_type AS category_type, category AS name FROM transactions WHERE id > ? ORDER BY id LIMIT ?")
+    copy_sql = f"""
+    INSERT INTO transactions_v9 (id, user_id, transaction_type, amount, category_id, created_at)
+    SELECT id, user_id, transaction_type, amount, {_category_id_sql('t.user_id', 't.transaction_type', 't.category')}, created_at
+    FROM transactions t WHERE id > ? ORDER BY id LIMIT ?
+    """
+    chunk = max(1, config.DB_MIGRATION_CHUNK_ROWS)
+    async with conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions_v9") as cursor:
+        last_id = (await cursor.fetchone())[0]
+    copied_total = 0
+    while True:
+        await conn.execute(register_sql, (last_id, chunk))
+        async with conn.execute(copy_sql, (last_id, chunk)) as cursor:
+            copied = cursor.rowcount
+        await conn.commit()
+        if copied <= 0: break
+        copied_total += copied
+        async with conn.execute("SELECT MAX(id) FROM transactions_v9") as cursor:
+            last_id = (await cursor.fetchone())[0]
+        logging.info(f"Category migration: {copied_total} rows converted (last id {last_id})")
+        if copied < chunk: break
+
+    # Финальная замена; старые индексы и триггеры удаляются вместе с таблицами
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        await conn.execute(register_sql, (last_id, -1))
+        await conn.execute(copy_sql, (last_id, -1))
+        # Переносим счетчик AUTOINCREMENT, чтобы id удаленных записей не выдавались повторно
+        await conn.execute("DELETE FROM sqlite_sequence WHERE name = 'transactions_v9'")
+        await conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'transactions_v9', seq FROM sqlite_sequence WHERE name = 'transactions'")
+        await conn.execute("DROP TABLE transactions")
+        await conn.execute("ALTER TABLE transactions_v9 RENAME TO transactions")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_month ON transactions (user_id, created_at)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_period_cover ON transactions (user_id, created_at, transaction_type, category_id, amount)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON transactions (user_id)")
+
+        await conn.execute("DROP TABLE IF EXISTS monthly_rollup")
+        await conn.execute("""
+        CREATE TABLE monthly_rollup (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL, -- 'YYYY-MM' по created_at (UTC)
+            transaction_type TEXT NOT NULL,
+            category_id INTEGER NOT NULL,
+            total_amount INTEGER NOT NULL DEFAULT 0, -- копейки
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month, transaction_type, category_id)
+        ) WITHOUT ROWID
+        """)
+        for trigger_sql in ROLLUP_V9_TRIGGERS:
+            await conn.execute(trigger_sql)
+        await conn.execute("DELETE FROM migration_state WHERE name LIKE 'rollup_backfill%'")
+        async with conn.execute("SELECT EXISTS(SELECT 1 FROM transactions)") as cursor:
+            if not (await cursor.fetchone())[0]: await _set_state(conn, 'rollup_backfill', 'done')
+
+        await conn.execute(_REGISTER_CATEGORIES_SQL.format(source="SELECT user_id, 'expense' AS category_type, category AS name FROM budgets"))
+        await conn.execute("""
+        CREATE TABLE budgets_v9 (
+            user_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL REFERENCES categories (id),
+            monthly_limit INTEGER NOT NULL CHECK(monthly_limit > 0),
+            PRIMARY KEY (user_id, category_id)
+        ) WITHOUT ROWID
+        """)
+        await conn.execute(f"""
+        INSERT INTO budgets_v9 (user_id, category_id, monthly_limit)
+        SELECT user_id, {_category_id_sql('b.user_id', "'expense'", 'b.category')}, monthly_limit FROM budgets b
+        """)
+        await conn.execute("DROP TABLE budgets")
+        await conn.execute("ALTER TABLE budgets_v9 RENAME TO budgets")
+
+        await conn.execute(_REGISTER_CATEGORIES_SQL.format(source="SELECT user_id, transaction_type AS category_type, category AS name FROM recurring_rules"))
+        await conn.execute("""
+        CREATE TABLE recurring_rules_v9 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            transaction_type TEXT NOT NULL CHECK(transaction_type IN ('income', 'expense')),
+            amount INTEGER NOT NULL CHECK(amount > 0),
+            category_id INTEGER NOT NULL REFERENCES categories (id),
+            period TEXT NOT NULL CHECK(period IN ('daily', 'weekly', 'monthly')),
+            anchor_day INTEGER,
+            next_run_at TEXT NOT NULL
+        )
+        """)
+        await conn.execute(f"""
+        INSERT INTO recurring_rules_v9 (id, user_id, transaction_type, amount, category_id, period, anchor_day, next_run_at)
+        SELECT id, user_id, transaction_type, amount, {_category_id_sql('r.user_id', 'r.transaction_type', 'r.category')}, period, anchor_day, next_run_at
+        FROM recurring_rules r
+        """)
+        await conn.execute("DELETE FROM sqlite_sequence WHERE name = 'recurring_rules_v9'")
+        await conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'recurring_rules_v9', seq FROM sqlite_sequence WHERE name = 'recurring_rules'")
+        await conn.execute("DROP TABLE recurring_rules")
+        await conn.execute("ALTER TABLE recurring_rules_v9 RENAME TO recurring_rules")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_recurring_user ON recurring_rules (user_id)")
+
+        await conn.execute("DROP TABLE user_categories")
+        await conn.commit()
+    except Exception:
+        await conn.rollback()
+        raise
+    logging.info(f"Category migration finished: {copied_total} rows now reference categories by id.")
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "base schema", _m001_base_schema),
+    Migration(2, "amount in minor units", _m002_amount_minor_units),
+    Migration(3, "covering index for period reports", _m003_period_cover_index),
+    Migration(4, "FSM storage", _m004_fsm_storage),
+    Migration(5, "monthly rollup", _m005_monthly_rollup, backfill=_b005_monthly_rollup),
+    Migration(6, "user_id index for keyset pagination", _m006_user_id_index),
+    Migration(7, "category budgets", _m007_budgets),
+    Migration(8, "recurring rules", _m008_recurring_rules),
+    # Rollup пересобран с category_id: заполняется тем же пересчетом, что и в миграции 5
+    Migration(9, "categories table and category ids", _m009_category_ids, backfill=_b005_monthly_rollup),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+# Шард -> (фоновая задача дозаполнений, событие остановки)
+_backfills: Dict[int, Tuple[asyncio.Task, asyncio.Event]] = {}
+
+async def _set_user_version(conn: aiosqlite.Connection, version: int):
+    await conn.execute(f"PRAGMA user_version = {int(version)}")
+    await conn.commit()
+
+async def migrate(conn: aiosqlite.Connection, shard: int = 0, write_lock: Optional[asyncio.Lock] = None):
+    """
+    Применяет недостающие миграции к файлу БД шарда shard; фоновые дозаполнения запускает
+    отдельной задачей этого шарда. write_lock - блокировка записи, которой остальной код
+    делит conn с дозаполнениями (без нее соединение считается только их).
+    """
+    async with conn.execute("PRAGMA user_version") as cursor:
+        current = (await cursor.fetchone())[0]
+    rollup_backfilled_upto.pop(shard, None)
+    if current >= LATEST_VERSION: return
+
+    pending: List[Migration] = []
+    for migration in MIGRATIONS:
+        if migration.version <= current: continue
+        await migration.apply(conn)
+        await conn.commit()
+        logging.info(f"Migration {migration.version} ({migration.name}) applied (shard {shard}).")
+        if migration.backfill: pending.append(migration)
+        elif not pending: await _set_user_version(conn, migration.version)
+    if not pending:
+        logging.info(f"Database schema is at version {LATEST_VERSION} (shard {shard}).")
+        return
+    await _load_rollup_progress(conn, shard)
+    _write_locks[shard] = write_lock or asyncio.Lock()
+    stop = asyncio.Event()
+    _backfills[shard] = (asyncio.create_task(_run_backfills(conn, pending, stop, shard)), stop)
+
+async def _run_backfills(conn: aiosqlite.Connection, pending: List[Migration], stop: asyncio.Event, shard: int):
+    for index, migration in enumerate(pending):
+        logging.info(f"Background migration {migration.version} ({migration.name}) started (shard {shard}).")
+        try:
+            if not await migration.backfill(conn, stop, shard): return
+        except Exception as e:
+            logging.error(f"Background migration {migration.version} ({migration.name}) failed (shard {shard}): {e}")
+            return
+        # Все миграции до следующего незавершенного backfill теперь полностью применены
+        upto = pending[index + 1].version - 1 if index + 1 < len(pending) else LATEST_VERSION
+        async with _write_locks[shard]: await _set_user_version(conn, upto)
+        logging.info(f"Database schema is at version {upto} (shard {shard}).")
+
+def backfills_running() -> bool:
+    return any(not task.done() for task, _ in _backfills.values())
+
+async def stop_backfills():
+    """Останавливает фоновые миграции всех шардов после текущей порции (прогресс сохранен)."""
+    backfills = list(_backfills.values())
+    _backfills.clear()
+    for _, stop in backfills: stop.set()
+    for task, _ in backfills:
+        try: await task
+        except Exception as e: logging.error(f"Error stopping background migrations: {e}")
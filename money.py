@@ -0,0 +1,31 @@
+# money.py
+"""
+Денежные суммы хранятся и считаются в целых копейках (minor units).
+Ввод пользователя разбирается как точная десятичная дробь, без float.
+"""
+from decimal import Decimal, InvalidOperation
+
+MINOR_UNITS = 100 # Копеек в рубле
+MAX_AMOUNT_MINOR = 10 ** 15 # Верхняя граница одной суммы, защищает от переполнения INTEGER при суммировании
+
+def parse_amount(text: str) -> int:
+    """
+    Разбирает сумму вида '150', '99,90', '1 200.5' в копейки.
+    Бросает ValueError для нечисловых, неположительных значений и более чем двух знаков после запятой.
+    """
+    cleaned = (text or "").strip().replace(' ', '').replace(' ', '').replace(',', '.')
+    try: value = Decimal(cleaned)
+    except InvalidOperation: raise ValueError(f"Not a number: {text!r}")
+    if not value.is_finite() or value <= 0: raise ValueError(f"Amount must be positive: {text!r}")
+    minor = value * MINOR_UNITS
+    if minor != minor.to_integral_value(): raise ValueError(f"Too many decimal places: {text!r}")
+    minor = int(minor)
+    if minor > MAX_AMOUNT_MINOR: raise ValueError(f"Amount is too large: {text!r}")
+    return minor
+
+def format_amount(minor: int) -> str:
+    """Форматирует копейки как '1234.56' (как прежний формат :.2f)."""
+    minor = int(minor or 0)
+    sign = "-" if minor < 0 else ""
+    rubles, kopecks = divmod(abs(minor), MINOR_UNITS)
+    return f"{sign}{rubles}.{kopecks:02d}"
@@ -0,0 +1,267 @@
+# outbox.py
+"""
+Очередь исходящих запросов к Bot API с учетом лимитов Telegram.
+
+Обработчик кладет привязанный к боту метод (message.answer(...), message.edit_reply_markup(...)
+без await) через send() и сразу продолжает работу. Запросы, которые обработчик ждет напрямую
+(await message.answer(...)), ставит в ту же очередь OutboxRequestMiddleware сессии бота (см. install):
+результат или ошибка Telegram возвращаются ему как при прямом вызове. Для каждого чата работает
+своя задача: запросы одного чата уходят строго по порядку, разные чаты - параллельно.
+Перед отправкой берется токен из ведра чата и из общего ведра бота. На TelegramRetryAfter
+запрос повторяется через указанное Telegram время, на сетевые ошибки - с экспоненциальной паузой.
+
+Правки клавиатуры одного сообщения схлопываются: пока правка ждет в очереди, новая правка
+того же сообщения ее заменяет, а повторное снятие уже снятой клавиатуры не отправляется.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Hashable, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import EditMessageReplyMarkup, TelegramMethod
+
+import config
+from cache import LRUCache
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не больше capacity. reserve() списывает токен сразу
+    (баланс может уйти в минус) и возвращает, сколько ждать, - так очередь ожидающих честная без блокировок.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        if self.rate <= 0: return 0.0 # Без лимита
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def time_to_full(self) -> float:
+        if self.rate <= 0: return 0.0
+        self._refill(time.monotonic())
+        return (self.capacity - self.tokens) / self.rate
+
+class _Item:
+    __slots__ = ('method', 'future', 'edit_key', 'superseded', 'reraise')
+
+    def __init__(self, method: TelegramMethod, future: asyncio.Future, edit_key: Optional[Tuple[Any, int]], reraise: bool = False):
+        self.method = method
+        self.future = future
+        self.edit_key = edit_key # (chat_id, message_id) для правок клавиатуры
+        self.superseded = False
+        self.reraise = reraise # Ошибку отправки получает ждущий future (запрос из OutboxRequestMiddleware)
+
+class _ChatSlot:
+    __slots__ = ('queue', 'current', 'bucket', 'wakeup', 'task')
+
+    def __init__(self):
+        self.queue: Deque[_Item] = deque()
+        self.current: Optional[_Item] = None # Запрос, который задача чата отправляет сейчас (его уже нет в queue)
+        self.bucket = TokenBucket(config.OUTBOX_CHAT_RATE, config.OUTBOX_CHAT_BURST)
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+# Чаты с запросами в очереди или с еще не наполнившимся ведром
+_slots: Dict[Hashable, _ChatSlot] = {}
+_global_bucket: Optional[TokenBucket] = None
+# Правки клавиатуры, ожидающие отправки: (chat_id, message_id) -> запрос
+_pending_edits: Dict[Tuple[Any, int], _Item] = {}
+# Сообщения, с которых клавиатура уже снята
+_cleared_markups = LRUCache(config.OUTBOX_CLEARED_CACHE_SIZE, name="outbox_cleared_markups")
+_closing = False
+# Выставлен в задачах, которые сами отправляют запросы очереди: их OutboxRequestMiddleware пропускает к Telegram
+_delivering: ContextVar[bool] = ContextVar("outbox_delivering", default=False)
+outbox_stats: Dict[str, int] = {
+    "queued": 0,
+    "sent": 0,
+    "superseded": 0,
+    "retry_after": 0,
+    "retries": 0,
+    "failed": 0,
+}
+
+def send(method: TelegramMethod) -> asyncio.Future:
+    """
+    Ставит привязанный к боту метод в очередь его чата и сразу возвращает future с результатом
+    (None, если запрос не отправлен). Ждать future не обязательно: ошибки логируются здесь.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    chat_id = getattr(method, 'chat_id', None)
+    if _closing:
+        # После остановки очереди отправляем напрямую, чтобы ответ не потерялся
+        loop.create_task(_deliver_now(method, future))
+        return future
+    edit_key = None
+    if isinstance(method, EditMessageReplyMarkup) and chat_id is not None:
+        edit_key = (chat_id, method.message_id)
+        if method.reply_markup is None and edit_key in _cleared_markups:
+            # Клавиатура уже снята (повторное нажатие кнопки) - повторная правка ничего не изменит
+            outbox_stats["superseded"] += 1
+            future.set_result(None)
+            return future
+        older = _pending_edits.get(edit_key)
+        if older is not None:
+            older.superseded = True
+            outbox_stats["superseded"] += 1
+            if not older.future.done(): older.future.set_result(None)
+    item = _Item(method, future, edit_key)
+    if edit_key is not None: _pending_edits[edit_key] = item
+    _enqueue(chat_id, item)
+    return future
+
+def _enqueue(chat_id: Hashable, item: _Item):
+    global _global_bucket
+    if _global_bucket is None: _global_bucket = TokenBucket(config.OUTBOX_GLOBAL_RATE, config.OUTBOX_GLOBAL_BURST)
+    slot = _slots.get(chat_id)
+    if slot is None: slot = _slots[chat_id] = _ChatSlot()
+    slot.queue.append(item)
+    outbox_stats["queued"] += 1
+    if slot.task is None: slot.task = asyncio.get_running_loop().create_task(_chat_worker(chat_id, slot))
+    else: slot.wakeup.set()
+
+class OutboxRequestMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: запрос в чат, который обработчик ждет напрямую, ставится в очередь
+    его чата и берет токены из тех же ведер, что и send(), поэтому не обгоняет уже поставленные
+    ответы и не обходит лимиты. Запросы без chat_id (answerCallbackQuery, getFile, setMyCommands)
+    и запросы самой очереди идут к Telegram сразу.
+    """
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None or _closing or _delivering.get():
+            return await make_request(bot, method)
+        future = asyncio.get_running_loop().create_future()
+        # Без схлопывания правок: ждущему нужен результат именно его запроса
+        _enqueue(chat_id, _Item(method.as_(bot), future, None, reraise=True)) # bot(method) мог прийти без привязки
+        return await future
+
+def install(bot: Bot):
+    """Подключает OutboxRequestMiddleware к сессии бота: все запросы в чаты проходят через очередь."""
+    bot.session.middleware(OutboxRequestMiddleware())
+
+async def _chat_worker(chat_id: Hashable, slot: _ChatSlot):
+    while True:
+        while slot.queue:
+            slot.current = slot.queue.popleft()
+            await _process(slot, slot.current)
+            slot.current = None
+        # Очередь пуста: слот живет, пока ведро не наполнится, иначе новый слот дал бы лишний всплеск
+        slot.wakeup.clear()
+        idle = slot.bucket.time_to_full()
+        if idle > 0 and not _closing:
+            try:
+                await asyncio.wait_for(slot.wakeup.wait(), idle)
+                continue
+            except asyncio.TimeoutError:
+                pass
+        if not slot.queue:
+            _slots.pop(chat_id, None)
+            return
+
+async def _process(slot: _ChatSlot, item: _Item):
+    if item.superseded: return
+    delay = slot.bucket.reserve()
+    if delay > 0: await asyncio.sleep(delay)
+    delay = _global_bucket.reserve()
+    if delay > 0: await asyncio.sleep(delay)
+    # Пока ждали токен, правку могла заменить более новая
+    if item.superseded: return
+    if item.edit_key is not None and _pending_edits.get(item.edit_key) is item: del _pending_edits[item.edit_key]
+    try: result = await _deliver(item.method, item.reraise)
+    except Exception as e:
+        if not item.future.done(): item.future.set_exception(e)
+        return
+    if result is not None and item.edit_key is not None and item.method.reply_markup is None:
+        _cleared_markups.put(item.edit_key, True)
+    if not item.future.done(): item.future.set_result(result)
+
+async def _deliver(method: TelegramMethod, reraise: bool = False) -> Any:
+    """
+    Отправляет запрос с повторами; возвращает результат или None, если отправить не удалось
+    (с reraise - бросает последнюю ошибку, ее обрабатывает ждущий запрос обработчик).
+    """
+    _delivering.set(True) # Только в задачах очереди: await method не должен снова попасть в очередь
+    name = type(method).__name__
+    error: Optional[Exception] = None
+    for attempt in range(config.OUTBOX_MAX_RETRIES + 1):
+        try:
+            result = await method
+            outbox_stats["sent"] += 1
+            return result
+        except TelegramRetryAfter as e:
+            error = e
+            outbox_stats["retry_after"] += 1
+            logging.warning(f"Flood limit on {name} to chat {getattr(method, 'chat_id', None)}, retry in {e.retry_after}s")
+            delay = e.retry_after
+        except (TelegramNetworkError, TelegramServerError) as e:
+            error = e
+            delay = min(config.OUTBOX_BACKOFF_MAX, config.OUTBOX_BACKOFF_BASE * 2 ** attempt)
+            logging.warning(f"Error sending {name} (attempt {attempt + 1}), retry in {delay:.1f}s: {e}")
+        except TelegramBadRequest as e:
+            # Клавиатура уже в нужном состоянии - запрос считаем выполненным (ждущий обработчик разбирает это сам)
+            if "message is not modified" in str(e) and not reraise: return True
+            outbox_stats["failed"] += 1
+            if reraise: raise
+            logging.error(f"Telegram rejected {name}: {e}")
+            return None
+        except Exception as e:
+            outbox_stats["failed"] += 1
+            if reraise: raise
+            logging.error(f"Error sending {name}: {e}")
+            return None
+        if attempt < config.OUTBOX_MAX_RETRIES:
+            outbox_stats["retries"] += 1
+            await asyncio.sleep(delay)
+    outbox_stats["failed"] += 1
+    logging.error(f"Giving up on {name} after {config.OUTBOX_MAX_RETRIES + 1} attempts")
+    if reraise and error is not None: raise error
+    return None
+
+async def _deliver_now(method: TelegramMethod, future: asyncio.Future):
+    result = await _deliver(method)
+    if not future.done(): future.set_result(result)
+
+async def drain(timeout: float = config.OUTBOX_DRAIN_TIMEOUT):
+    """Отправляет все, что стоит в очереди (не дольше timeout сек), и останавливает задачи чатов."""
+    global _closing
+    _closing = True
+    for slot in _slots.values(): slot.wakeup.set() # Не ждать наполнения ведер
+    tasks = [slot.task for slot in _slots.values() if slot.task]
+    if tasks:
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logging.warning(f"Outbox: {len(pending)} chats still had messages after {timeout}s, cancelling.")
+            for task in pending: task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+    for slot in _slots.values():
+        # Включая запрос, на котором задачу отменили: его ждущий иначе не дождался бы ответа
+        for item in (slot.current, *slot.queue):
+            if item is None or item.future.done(): continue
+            if item.reraise: item.future.cancel() # Ждущий обработчик не должен получить None вместо Message
+            else: item.future.set_result(None)
+    _slots.clear()
+    _pending_edits.clear()
+    logging.info(f"Outbox drained: {get_stats()}")
+
+def get_stats() -> Dict[str, int]:
+    stats = dict(outbox_stats)
+    stats["chats"] = len(_slots)
+    stats["queue_depth"] = sum(len(slot.queue) for slot in _slots.values())
+    return stats
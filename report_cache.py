@@ -0,0 +1,127 @@
+# report_cache.py
+"""
+Кэш готовых отчетов за период: (user_id, начало, конец) -> суммы и отрисованные тексты.
+
+Запись сбрасывается только когда добавление или удаление транзакции попадает во время
+внутри ее периода: запись в текущем месяце не трогает отчет за прошлый месяц.
+Текущий месяц после смены месяца дает новый ключ, старая запись просто вытесняется.
+Вычисление, во время которого у пользователя менялись данные, не кэшируется (версия пользователя).
+"""
+import sys
+from datetime import datetime
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+import config
+from cache import LRUCache, VersionMap
+
+Summary = Tuple[int, int, Dict[str, int]]
+_Key = Tuple[int, str, str]
+
+_TS_FORMAT = '%Y-%m-%d %H:%M:%S' # Как created_at в БД: строки сравниваются в хронологическом порядке
+
+class _Entry:
+    __slots__ = ('summary', 'texts', 'size')
+
+    def __init__(self, summary: Summary):
+        self.summary = summary
+        self.texts: Dict[str, str] = {}
+        self.size = 0
+
+def _estimate_size(key: _Key, entry: _Entry) -> int:
+    """Примерный объем записи в байтах: ключ, суммы, словарь категорий и тексты."""
+    income, expense, details = entry.summary
+    size = sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key)
+    size += sys.getsizeof(entry.summary) + sys.getsizeof(income) + sys.getsizeof(expense)
+    size += sys.getsizeof(details) + sum(sys.getsizeof(cat) + sys.getsizeof(amount) for cat, amount in details.items())
+    size += sys.getsizeof(entry.texts) + sum(sys.getsizeof(name) + sys.getsizeof(text) for name, text in entry.texts.items())
+    return size
+
+def _forget(key: Hashable, entry: Any):
+    global _bytes
+    _bytes -= entry.size
+    user_keys = _keys_by_user.get(key[0])
+    if user_keys is not None:
+        user_keys.discard(key)
+        if not user_keys: del _keys_by_user[key[0]]
+
+_cache = LRUCache(config.REPORT_CACHE_SIZE, name="period_reports", on_evict=_forget)
+# Ключи кэша по пользователям: сброс не перебирает чужие записи
+_keys_by_user: Dict[int, Set[_Key]] = {}
+# Меняется при каждом изменении данных пользователя; помнит только недавно менявшихся (см. cache.VersionMap)
+_versions = VersionMap(config.REPORT_CACHE_SIZE, name="report_versions")
+_bytes = 0
+invalidations = 0
+
+def _key(user_id: int, start_date: datetime, end_date: datetime) -> _Key:
+    return (user_id, start_date.strftime(_TS_FORMAT), end_date.strftime(_TS_FORMAT))
+
+def _store(key: _Key, entry: _Entry):
+    global _bytes
+    if _cache.maxsize == 0: return
+    old = _cache.pop(key)
+    if old is not None: _forget(key, old)
+    entry.size = _estimate_size(key, entry)
+    _bytes += entry.size
+    _keys_by_user.setdefault(key[0], set()).add(key)
+    _cache.put(key, entry)
+
+def version(user_id: int) -> int:
+    """Версия данных пользователя; запоминается до вычисления отчета и передается в put_*."""
+    return _versions.get(user_id)
+
+def get_summary(user_id: int, start_date: datetime, end_date: datetime) -> Optional[Summary]:
+    entry = _cache.get(_key(user_id, start_date, end_date))
+    return entry.summary if entry is not None else None
+
+def put_summary(user_id: int, start_date: datetime, end_date: datetime, summary: Summary, data_version: int):
+    if version(user_id) != data_version: return
+    key = _key(user_id, start_date, end_date)
+    if key not in _cache: _store(key, _Entry(summary))
+
+def get_text(user_id: int, start_date: datetime, end_date: datetime, period_name: str) -> Optional[str]:
+    # Промах по тексту не считаем: за ним следует get_summary, и запрос отчета учитывается один раз
+    key = _key(user_id, start_date, end_date)
+    entry = _cache.peek(key)
+    if entry is None or period_name not in entry.texts: return None
+    return _cache.get(key).texts[period_name]
+
+def put_text(user_id: int, start_date: datetime, end_date: datetime, period_name: str, text: str, summary: Summary, data_version: int):
+    """Запоминает отрисованный отчет рядом с суммами (один период может называться по-разному)."""
+    if version(user_id) != data_version: return
+    key = _key(user_id, start_date, end_date)
+    old = _cache.pop(key)
+    entry = _Entry(summary)
+    if old is not None:
+        _forget(key, old)
+        entry.texts.update(old.texts)
+    entry.texts[period_name] = text
+    _store(key, entry)
+
+def invalidate(user_id: int, created_at: Optional[str] = None):
+    """
+    Сбрасывает отчеты пользователя, в период которых входит created_at ('YYYY-MM-DD HH:MM:SS').
+    Без created_at (массовый импорт) сбрасываются все отчеты пользователя.
+    """
+    global invalidations
+    _versions.bump(user_id)
+    user_keys = _keys_by_user.get(user_id)
+    if not user_keys: return
+    for key in [k for k in user_keys if created_at is None or k[1] <= created_at < k[2]]:
+        entry = _cache.pop(key)
+        if entry is not None: _forget(key, entry)
+        invalidations += 1
+
+def clear():
+    """Очищает кэш (версии пользователей сохраняются)."""
+    global _bytes
+    _cache.clear()
+    _keys_by_user.clear()
+    _bytes = 0
+
+def stats() -> Dict[str, Any]:
+    """Счетчики кэша отчетов и примерный занимаемый объем."""
+    result = _cache.stats()
+    result["memory_bytes"] = _bytes
+    result["invalidations"] = invalidations
+    result["users"] = len(_keys_by_user)
+    return result
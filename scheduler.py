@@ -0,0 +1,188 @@
+# scheduler.py
+"""
+Регулярные записи (аренда, зарплата, подписки): одна фоновая задача создает транзакции по правилам.
+
+Правила загружаются из recurring_rules один раз при старте и дальше живут в памяти: куча (heapq)
+упорядочена по времени следующего срабатывания, задача спит до ближайшего срока и таблицу не опрашивает.
+Все наступившие сроки записываются пачками: вставка транзакций и сдвиг next_run_at правил - одним commit
+(db.apply_recurring). Сроки, пропущенные за время остановки бота, досоздаются при первом проходе
+с теми датами, в которые должны были появиться; после долгого простоя - только последние
+RECURRING_MAX_CATCHUP, более старые пропускаются.
+
+Правило определяется парой (user_id, id): id уникален только внутри файла шарда (см. db.shard_index).
+Запись кучи - (срок, ключ правила, next_run_at). Удаленное или сдвинутое правило не ищется в куче:
+его устаревшая запись просто пропускается при извлечении, а куча пересобирается, когда таких
+записей становится больше, чем живых.
+"""
+import asyncio
+import calendar
+import heapq
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+import config
+import db
+
+PERIODS = ('daily', 'weekly', 'monthly')
+RuleKey = Tuple[int, int] # (user_id, id правила)
+TS_FORMAT = '%Y-%m-%d %H:%M:%S' # Как created_at в transactions, UTC
+
+class Rule:
+    __slots__ = ('id', 'user_id', 'transaction_type', 'amount', 'category_id', 'category', 'period', 'anchor_day', 'next_run_at')
+
+    def __init__(self, row: Any):
+        self.id: int = row['id']
+        self.user_id: int = row['user_id']
+        self.transaction_type: str = row['transaction_type']
+        self.amount: int = row['amount']
+        self.category_id: int = row['category_id']
+        self.category: str = row['category'] # Имя (см. db.SQL_SELECT_RECURRING) - для учета трат в budgets
+        self.period: str = row['period']
+        self.anchor_day: Optional[int] = row['anchor_day'] # День месяца для monthly
+        self.next_run_at: str = row['next_run_at']
+
+    @property
+    def key(self) -> RuleKey:
+        return (self.user_id, self.id)
+
+_rules: Dict[RuleKey, Rule] = {}
+_heap: List[Tuple[float, RuleKey, str]] = []
+_wakeup: Optional[asyncio.Event] = None
+_task: Optional[asyncio.Task] = None
+_stopping = False
+scheduler_stats: Dict[str, int] = {
+    "batches": 0,
+    "created": 0, # Созданных транзакций
+    "caught_up": 0, # Из них - пропущенных за время простоя
+    "skipped": 0, # Пропущенных сверх RECURRING_MAX_CATCHUP
+    "errors": 0,
+}
+
+def parse_ts(value: str) -> datetime:
+    return datetime.strptime(value, TS_FORMAT).replace(tzinfo=timezone.utc)
+
+def next_occurrence(period: str, anchor_day: Optional[int], current: datetime) -> datetime:
+    """Следующий срок после current. Ежемесячное правило держит день месяца (31-е в коротком месяце - последний день)."""
+    if period == 'daily': return current + timedelta(days=1)
+    if period == 'weekly': return current + timedelta(weeks=1)
+    year, month = (current.year + 1, 1) if current.month == 12 else (current.year, current.month + 1)
+    day = min(anchor_day or current.day, calendar.monthrange(year, month)[1])
+    return current.replace(year=year, month=month, day=day)
+
+def _push(rule: Rule):
+    heapq.heappush(_heap, (parse_ts(rule.next_run_at).timestamp(), rule.key, rule.next_run_at))
+
+def _is_current(entry: Tuple[float, RuleKey, str]) -> bool:
+    rule = _rules.get(entry[1])
+    return rule is not None and rule.next_run_at == entry[2]
+
+def schedule(row: Any):
+    """Ставит новое правило (строку recurring_rules) в расписание."""
+    rule = Rule(row)
+    _rules[rule.key] = rule
+    _push(rule)
+    if _wakeup is not None: _wakeup.set()
+
+def unschedule(user_id: int, rule_id: int):
+    """Убирает правило; его запись в куче станет устаревшей и будет пропущена."""
+    if _rules.pop((user_id, rule_id), None) is None: return
+    # Устаревших записей больше, чем живых - пересобираем кучу, чтобы она не росла
+    if len(_heap) > 2 * len(_rules) + 64:
+        _heap[:] = [entry for entry in _heap if _is_current(entry)]
+        heapq.heapify(_heap)
+
+def _collect_due(now: datetime) -> Tuple[List[Tuple[int, str, int, int, str, str]], List[Tuple[int, str, int]], List[Rule]]:
+    """
+    Снимает с кучи наступившие сроки (не больше RECURRING_BATCH_SIZE транзакций) и возвращает
+    (строки транзакций, (user_id, новый next_run_at, id) для правил, сами правила).
+    """
+    rows: List[Tuple[int, str, int, int, str, str]] = []
+    advances: List[Tuple[int, str, int]] = []
+    rules: List[Rule] = []
+    now_ts = now.timestamp()
+    while _heap and _heap[0][0] <= now_ts and len(rows) < config.RECURRING_BATCH_SIZE:
+        entry = heapq.heappop(_heap)
+        if not _is_current(entry): continue
+        rule = _rules[entry[1]]
+        run_at = parse_ts(rule.next_run_at)
+        # Остаются последние RECURRING_MAX_CATCHUP сроков: после долгого простоя нужнее текущие записи, чем самые старые
+        due: Deque[datetime] = deque(maxlen=max(0, config.RECURRING_MAX_CATCHUP))
+        while run_at <= now:
+            if len(due) == due.maxlen: scheduler_stats["skipped"] += 1 # Самый старый срок вытесняется
+            due.append(run_at)
+            run_at = next_occurrence(rule.period, rule.anchor_day, run_at)
+        rows.extend((rule.user_id, rule.transaction_type, rule.amount, rule.category_id, occurrence.strftime(TS_FORMAT), rule.category) for occurrence in due)
+        if len(due) > 1: scheduler_stats["caught_up"] += len(due) - 1
+        advances.append((rule.user_id, run_at.strftime(TS_FORMAT), rule.id))
+        rules.append(rule)
+    return rows, advances, rules
+
+async def _run_due(now: datetime):
+    rows, advances, rules = _collect_due(now)
+    if not advances: return
+    failed: Set[int] = await db.apply_recurring(rows, advances)
+    scheduler_stats["batches"] += 1
+    created = sum(1 for row in rows if row[0] not in failed)
+    scheduler_stats["created"] += created
+    if failed: scheduler_stats["errors"] += 1
+    retry_at = now.timestamp() + config.RECURRING_RETRY_SECONDS
+    for rule, (_, next_run_at, _) in zip(rules, advances):
+        # Правило могли удалить, пока шла запись
+        if _rules.get(rule.key) is not rule: continue
+        if rule.user_id in failed:
+            # Шард не записал пачку, next_run_at в БД не сдвинут: повторяем те же сроки позже
+            heapq.heappush(_heap, (retry_at, rule.key, rule.next_run_at))
+            continue
+        rule.next_run_at = next_run_at
+        _push(rule)
+    logging.info(f"Recurring: {created} transactions created for {len(rules)} rules")
+
+async def _worker():
+    while not _stopping:
+        _wakeup.clear()
+        now = time.time()
+        while _heap and not _is_current(_heap[0]): heapq.heappop(_heap)
+        if _heap and _heap[0][0] <= now:
+            await _run_due(datetime.fromtimestamp(now, timezone.utc))
+            continue
+        # Спим до ближайшего срока; новое правило будит раньше. Сон ограничен на случай перевода часов
+        timeout = min(_heap[0][0] - now, config.RECURRING_MAX_SLEEP) if _heap else config.RECURRING_MAX_SLEEP
+        try: await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError: pass
+
+async def start():
+    """Загружает правила и запускает задачу (после db.connect_db)."""
+    global _task, _wakeup, _stopping
+    if _task is not None: return
+    rows = await db.load_recurring_rules()
+    _rules.clear()
+    for row in rows:
+        rule = Rule(row)
+        _rules[rule.key] = rule
+    _heap[:] = [(parse_ts(rule.next_run_at).timestamp(), rule.key, rule.next_run_at) for rule in _rules.values()]
+    heapq.heapify(_heap)
+    _wakeup = asyncio.Event()
+    _stopping = False
+    _task = asyncio.create_task(_worker())
+    logging.info(f"Recurring scheduler started with {len(_rules)} rules.")
+
+async def stop():
+    """Останавливает задачу (до db.close_db); начатая пачка дописывается."""
+    global _task, _wakeup, _stopping
+    if _task is None: return
+    _stopping = True
+    _wakeup.set()
+    try: await _task
+    except Exception as e: logging.error(f"Error stopping recurring scheduler: {e}")
+    _task = _wakeup = None
+    logging.info(f"Recurring scheduler stopped: {get_stats()}")
+
+def get_stats() -> Dict[str, float]:
+    stats: Dict[str, float] = dict(scheduler_stats)
+    stats["rules"] = len(_rules)
+    stats["heap_size"] = len(_heap)
+    stats["next_due_in_seconds"] = max(0.0, _heap[0][0] - time.time()) if _heap else 0.0
+    return stats
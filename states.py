@@ -18,4 +18,24 @@ class CategoryManagementStates(StatesGroup):
 class CustomReportStates(StatesGroup):
     """Состояния для запроса дат для отчета"""
     waiting_for_start_date = State()
-    waiting_for_end_date = State()
\ No newline at end of file
+    waiting_for_end_date = State()
+
+class ImportStates(StatesGroup):
+    """Состояние ожидания CSV-файла для импорта"""
+    waiting_for_file = State()
+
+class BudgetStates(StatesGroup):
+    """Состояния для установки/удаления лимитов по категориям"""
+    choosing_action = State()
+    choosing_category_to_set = State()
+    waiting_for_limit = State()
+    choosing_category_to_delete = State()
+
+class RecurringStates(StatesGroup):
+    """Состояния для создания/удаления регулярных записей"""
+    choosing_action = State()
+    choosing_type = State()
+    choosing_category = State()
+    waiting_for_amount = State()
+    choosing_period = State()
+    choosing_rule_to_delete = State()
@@ -0,0 +1,37 @@
+# tests/conftest.py
+# Модули бота лежат в корне проекта: тесты импортируют их так же, как main.py
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import budgets
+import config
+import db
+import report_cache
+
+@pytest.fixture
+def run_db(tmp_path, monkeypatch):
+    """
+    Запускает async-функцию на новой БД во временном каталоге: connect_db -> fn() -> close_db.
+    Настройки config (шарды, write-behind) тест меняет через monkeypatch до вызова.
+    """
+    monkeypatch.setattr(config, 'SQLITE_DB_FILE', str(tmp_path / 'bot.db'))
+    monkeypatch.setattr(config, 'SQLITE_SHARDS', 1)
+    monkeypatch.setattr(config, 'DB_WRITE_BEHIND', False)
+    monkeypatch.setattr(config, 'SQLITE_WAL_MODE', False)
+    # Кэши процесса живут дольше одной БД: записи прошлого теста относятся к другому файлу
+    db._category_cache.clear()
+    report_cache.clear()
+    budgets._cache.clear()
+
+    def run(fn):
+        async def scenario():
+            assert await db.connect_db()
+            try: return await fn()
+            finally: await db.close_db()
+        return asyncio.run(scenario())
+    return run
@@ -0,0 +1,65 @@
+# tests/test_cache.py
+from cache import LRUCache, VersionMap
+
+def test_lru_evicts_least_recently_used():
+    evicted = []
+    cache = LRUCache(2, name="test", on_evict=lambda key, value: evicted.append((key, value)))
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1 # 'a' теперь свежее 'b'
+    cache.put('c', 3)
+    assert evicted == [('b', 2)]
+    assert 'b' not in cache and cache.get('a') == 1 and cache.get('c') == 3
+    # peek не меняет порядок вытеснения и не считается в статистике
+    assert cache.peek('a') == 1
+    cache.put('d', 4)
+    assert evicted[-1] == ('a', 1)
+    stats = cache.stats()
+    assert (stats["size"], stats["hits"], stats["misses"], stats["evictions"]) == (2, 3, 0, 2)
+
+def test_lru_put_existing_key_and_pop():
+    evicted = []
+    cache = LRUCache(2, on_evict=lambda key, value: evicted.append(key))
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.put('a', 10) # Перезапись - не вытеснение, 'a' становится свежей
+    cache.put('c', 3)
+    assert evicted == ['b'] and cache.get('a') == 10
+    assert cache.pop('a') == 10 and cache.pop('a', 'none') == 'none'
+    assert cache.get('missing') is None and cache.stats()["misses"] == 1
+    assert evicted == ['b'] # pop не вызывает on_evict
+
+def test_lru_zero_size_stores_nothing():
+    cache = LRUCache(0)
+    cache.put('a', 1)
+    assert len(cache) == 0 and cache.get('a') is None
+
+def test_version_map_detects_change():
+    versions = VersionMap(10)
+    before = versions.get('a')
+    assert versions.get('a') == before # Без изменений версия стабильна
+    versions.bump('a')
+    assert versions.get('a') != before
+    other = versions.get('b')
+    versions.bump('a')
+    assert versions.get('b') == other # Изменение одного ключа не трогает остальные
+
+def test_version_map_is_bounded_and_safe_after_eviction():
+    versions = VersionMap(3)
+    seen = {}
+    for key in range(100):
+        seen[key] = versions.get(key)
+        versions.bump(key)
+        assert len(versions) <= 3
+    # Версия каждого ключа, даже вытесненного, отличается от запомненной до его изменения
+    assert all(versions.get(key) != before for key, before in seen.items())
+    # И вытеснение не откатывает версию назад: повторное чтение ее не меняет
+    current = {key: versions.get(key) for key in range(100)}
+    assert {key: versions.get(key) for key in range(100)} == current
+
+def test_version_map_change_during_computation_survives_eviction():
+    versions = VersionMap(2)
+    started = versions.get('report') # Вычисление началось
+    versions.bump('report') # Данные изменились
+    for key in ('x', 'y', 'z'): versions.bump(key) # Запись 'report' вытеснена
+    assert versions.get('report') != started # Результат вычисления не попадет в кэш
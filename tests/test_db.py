@@ -0,0 +1,139 @@
+# tests/test_db.py
+import asyncio
+import logging
+
+import config
+import db
+
+def _expense(user_id: int) -> db.Category:
+    return db.get_standard_categories(user_id, 'expense')[0]
+
+async def _count_transactions(user_id: int) -> int:
+    rows = await db._shard_for(user_id).conn.execute_fetchall("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (user_id,))
+    return rows[0][0]
+
+def test_write_behind_close_right_after_connect(run_db, monkeypatch, caplog):
+    monkeypatch.setattr(config, 'DB_WRITE_BEHIND', True)
+    tasks = []
+
+    async def scenario():
+        # Задачи write-behind еще не запускались, когда close_db останавливает очередь
+        tasks.extend(shard.write_task for shard in db._shards)
+
+    with caplog.at_level(logging.ERROR):
+        run_db(scenario)
+    assert tasks and all(task.done() and task.exception() is None for task in tasks)
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+def test_write_behind_batch(run_db, monkeypatch):
+    monkeypatch.setattr(config, 'DB_WRITE_BEHIND', True)
+
+    async def scenario():
+        results = await asyncio.gather(*(db.add_transaction(user_id, 'expense', 100 * user_id, _expense(user_id)) for user_id in range(1, 21)))
+        assert results == [True] * 20
+        assert [await _count_transactions(user_id) for user_id in range(1, 21)] == [1] * 20
+
+    run_db(scenario)
+
+def test_write_behind_bad_row_does_not_fail_batch(run_db, monkeypatch):
+    monkeypatch.setattr(config, 'DB_WRITE_BEHIND', True)
+    missing = db.Category(999999, 'expense', 'Нет такой') # Нарушает внешний ключ category_id
+
+    async def scenario():
+        results = await asyncio.gather(
+            db.add_transaction(1, 'expense', 100, _expense(1)),
+            db.add_transaction(2, 'expense', 200, missing),
+            db.add_transaction(3, 'expense', 300, _expense(3)),
+        )
+        assert results == [True, False, True]
+        assert [await _count_transactions(user_id) for user_id in (1, 2, 3)] == [1, 0, 1]
+
+    run_db(scenario)
+
+def test_delete_missing_transaction_leaves_no_open_transaction(run_db):
+    async def scenario():
+        assert await db.add_transaction(1, 'expense', 100, _expense(1))
+        assert not await db.delete_transaction_by_id(12345, 1)
+        assert not db._shards[0].conn.in_transaction
+        row = await db.get_last_transaction_id_details(1)
+        assert not await db.delete_transaction_by_id(row['id'], 2) # Чужая запись
+        assert not db._shards[0].conn.in_transaction
+        assert await db.delete_transaction_by_id(row['id'], 1)
+        assert await _count_transactions(1) == 0
+
+    run_db(scenario)
+
+def test_deleted_category_is_not_selectable(run_db):
+    async def scenario():
+        assert await db.add_user_category(1, 'expense', 'Хобби')
+        category = next(cat for cat in await db.get_user_categories(1, 'expense') if cat.name == 'Хобби')
+        assert await db.delete_user_category(1, 'expense', category.id)
+        assert category not in await db.get_user_categories(1, 'expense')
+        # Имя удаленной категории остается доступным (записи на нее ссылаются), выбрать ее кнопкой нельзя
+        assert await db.get_category(1, category.id) == category
+        assert await db.get_category(1, category.id, active_only=True) is None
+        assert await db.get_category(2, category.id) is None # Чужая категория
+        assert not await db.delete_user_category(1, 'expense', category.id)
+        assert not db._shards[0].conn.in_transaction
+        # Повторное добавление включает ту же строку
+        assert await db.add_user_category(1, 'expense', 'Хобби')
+        assert await db.get_category(1, category.id, active_only=True) == category
+
+    run_db(scenario)
+
+def test_iter_transaction_pages_resolves_category_names(run_db):
+    async def scenario():
+        food = _expense(1)
+        assert await db.add_user_category(1, 'expense', 'Старое')
+        old = next(cat for cat in await db.get_user_categories(1, 'expense') if cat.name == 'Старое')
+        rows = [(1, 'expense', 100 + i, (food if i % 2 else old).id, f'2026-01-{i + 1:02d} 10:00:00') for i in range(5)]
+        assert await db.import_transactions(rows)
+        assert await db.delete_user_category(1, 'expense', old.id)
+        pages = db.iter_transaction_pages(1, page_size=2)
+        exported = await pages.__anext__()
+        # Категория, заведенная во время выгрузки
+        assert await db.add_user_category(1, 'expense', 'Новое')
+        new = next(cat for cat in await db.get_user_categories(1, 'expense') if cat.name == 'Новое')
+        rows.append((1, 'expense', 999, new.id, '2026-02-01 10:00:00'))
+        assert await db.import_transactions(rows[-1:])
+        async for page in pages: exported += page
+        names = {food.id: food.name, old.id: 'Старое', new.id: 'Новое'}
+        assert exported == [(created_at, 'expense', amount, names[category_id]) for _, _, amount, category_id, created_at in rows]
+
+    run_db(scenario)
+
+def test_user_categories_cache(run_db):
+    async def scenario():
+        assert await db.add_user_category(1, 'expense', 'Хобби')
+        first = await db.get_user_categories(1, 'expense')
+        hits = db.get_category_cache_stats()["hits"]
+        assert await db.get_user_categories(1, 'expense') == first
+        assert db.get_category_cache_stats()["hits"] == hits + 1
+        # Добавление и удаление сбрасывают только список своего пользователя и типа
+        await db.get_user_categories(2, 'expense')
+        assert await db.add_user_category(1, 'expense', 'Авто')
+        assert [cat.name for cat in await db.get_user_categories(1, 'expense')] == ['Авто', 'Хобби']
+        assert (2, 'expense') in db._category_cache and (1, 'income') not in db._category_cache
+        hobby = next(cat for cat in first if cat.name == 'Хобби')
+        assert await db.delete_user_category(1, 'expense', hobby.id)
+        assert [cat.name for cat in await db.get_user_categories(1, 'expense')] == ['Авто']
+
+    run_db(scenario)
+
+def test_user_categories_changed_during_read_not_cached(run_db, monkeypatch):
+    reader = db._reader
+
+    def changing_reader(shard):
+        # Список меняется, пока идет чтение: прочитанный результат может быть уже устаревшим
+        db._invalidate_user_categories(1, 'expense')
+        return reader(shard)
+
+    async def scenario():
+        with monkeypatch.context() as patch:
+            patch.setattr(db, '_reader', changing_reader)
+            await db.get_user_categories(1, 'expense')
+        assert (1, 'expense') not in db._category_cache
+        await db.get_user_categories(1, 'expense')
+        assert (1, 'expense') in db._category_cache
+
+    run_db(scenario)
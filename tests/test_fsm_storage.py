@@ -0,0 +1,115 @@
+# tests/test_fsm_storage.py
+import asyncio
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+import db
+from fsm_storage import SQLiteStorage, dump_data, load_data
+
+class _States(StatesGroup):
+    amount = State()
+
+def _key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=42, chat_id=user_id, user_id=user_id)
+
+def _storage(**kwargs) -> SQLiteStorage:
+    # Без фоновой очистки: sweep() тесты вызывают сами
+    return SQLiteStorage(**{"flush_ms": 5, "sweep_interval": 0, **kwargs})
+
+async def _stored_rows():
+    return await db._shards[0].conn.execute_fetchall("SELECT storage_key, state FROM fsm_storage ORDER BY storage_key")
+
+def test_data_serialization_round_trip():
+    data = {"start": datetime(2026, 1, 31, 12, 0, tzinfo=timezone.utc), "day": date(2026, 2, 1),
+            "amount": Decimal("12.50"), "nested": {"items": [1, "два", None]}, "name": "Кафе"}
+    raw = dump_data(data)
+    assert "Кафе" in raw # ensure_ascii=False: кириллица хранится как есть
+    assert load_data(raw) == data and load_data(None) == {} and load_data("") == {}
+
+def test_state_survives_restart(run_db):
+    async def scenario():
+        storage = _storage()
+        await storage.set_state(_key(1), _States.amount)
+        await storage.set_data(_key(1), {"amount": 15000, "start": date(2026, 3, 1)})
+        await storage.close() # Дописывает очередь
+        restarted = _storage()
+        assert await restarted.get_state(_key(1)) == _States.amount.state
+        assert await restarted.get_data(_key(1)) == {"amount": 15000, "start": date(2026, 3, 1)}
+        assert await restarted.get_state(_key(2)) is None and await restarted.get_data(_key(2)) == {}
+        await restarted.close()
+
+    run_db(scenario)
+
+def test_changes_in_window_coalesce(run_db):
+    async def scenario():
+        storage = _storage(flush_ms=50)
+        for user_id in (1, 2):
+            await storage.set_state(_key(user_id), _States.amount)
+            await storage.set_data(_key(user_id), {"step": 1})
+            await storage.set_data(_key(user_id), {"step": 2})
+        await asyncio.sleep(0.2)
+        # Шесть изменений двух ключей - одна транзакция из двух строк
+        assert (storage.flushes, storage.rows_flushed) == (1, 2)
+        assert len(await _stored_rows()) == 2
+        await storage.close()
+
+    run_db(scenario)
+
+def test_cleared_state_is_deleted(run_db):
+    async def scenario():
+        storage = _storage()
+        await storage.set_state(_key(1), _States.amount)
+        await storage.set_data(_key(1), {"amount": 1})
+        await storage.flush()
+        assert len(await _stored_rows()) == 1
+        await storage.set_state(_key(1), None)
+        await storage.set_data(_key(1), {})
+        await storage.flush()
+        assert await _stored_rows() == []
+        await storage.close()
+
+    run_db(scenario)
+
+def test_evicted_pending_record_is_not_lost(run_db):
+    async def scenario():
+        storage = _storage(cache_size=1, flush_ms=1000)
+        await storage.set_state(_key(1), _States.amount)
+        await storage.set_state(_key(2), _States.amount) # Вытесняет ключ 1 из кэша до записи в БД
+        assert await storage.get_state(_key(1)) == _States.amount.state
+        await storage.close()
+        assert [row['state'] for row in await _stored_rows()] == [_States.amount.state] * 2
+
+    run_db(scenario)
+
+def test_failed_flush_is_retried(run_db, monkeypatch):
+    async def scenario():
+        storage = _storage(flush_ms=1000)
+        await storage.set_state(_key(1), _States.amount)
+        with monkeypatch.context() as patch:
+            async def failing_save(upserts, deletes): return False
+            patch.setattr(db, 'save_fsm_records', failing_save)
+            await storage.flush()
+        assert storage.stats()["pending"] == 1 and await _stored_rows() == []
+        await storage.flush()
+        assert storage.stats()["pending"] == 0 and len(await _stored_rows()) == 1
+        await storage.close()
+
+    run_db(scenario)
+
+def test_sweep_unloads_idle_and_expires_old(run_db):
+    async def scenario():
+        storage = _storage(cache_ttl=0.01, state_ttl=0.05)
+        await storage.set_state(_key(1), _States.amount)
+        await storage.flush()
+        await asyncio.sleep(0.1)
+        await storage.sweep()
+        assert storage.stats()["cached"] == 0
+        # Брошенный сценарий удален из БД: следующее сообщение начинается без состояния
+        assert await _stored_rows() == []
+        assert await storage.get_state(_key(1)) is None
+        await storage.close()
+
+    run_db(scenario)
@@ -0,0 +1,101 @@
+# tests/test_migrations.py
+import asyncio
+import sqlite3
+
+import aiosqlite
+import pytest
+
+import config
+import db
+import migrations
+
+# Строки файла версии 1: суммы в рублях (REAL), категория - именем
+LEGACY_ROWS = [
+    (1, 'expense', 12.5, "Еда", '2026-01-05 10:00:00'),
+    (1, 'expense', 0.1, "Транспорт", '2026-01-06 11:00:00'),
+    (1, 'expense', 1999.99, "Хобби", '2026-01-31 23:59:59'), # Своя категория
+    (1, 'expense', 0.29, "Старая", '2026-02-01 00:00:00'), # Из импорта CSV, в списке категорий ее нет
+    (1, 'income', 50000.0, "Зарплата", '2026-02-05 09:00:00'),
+    (2, 'expense', 7.77, "Еда", '2026-02-10 12:00:00'),
+    (2, 'expense', 100.0, "Хобби", '2026-02-11 12:00:00'), # У пользователя 2 такой категории нет
+    (1, 'expense', 3.33, "Хобби", '2026-03-01 08:00:00'),
+    (2, 'income', 10.01, "Другое", '2026-03-02 08:00:00'),
+    (1, 'expense', 45.6, "Еда", '2026-03-03 08:00:00'),
+    (2, 'expense', 1.0, "Еда", '2026-03-04 08:00:00'), # Удаляется: id 11 не должен выдаваться повторно
+]
+CHUNK = 3
+
+@pytest.fixture
+def legacy_db(run_db, monkeypatch):
+    """Файл схемы версии 1 с историей; порции миграций - по CHUNK строк."""
+    monkeypatch.setattr(config, 'DB_MIGRATION_CHUNK_ROWS', CHUNK)
+
+    async def create():
+        async with aiosqlite.connect(config.SQLITE_DB_FILE) as conn:
+            await conn.execute("""
+            CREATE TABLE transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                transaction_type TEXT NOT NULL CHECK(transaction_type IN ('expense', 'income')),
+                amount REAL NOT NULL,
+                category TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+            await migrations._m001_base_schema(conn)
+            await conn.execute("INSERT INTO user_categories (user_id, category_type, category_name) VALUES (1, 'expense', 'Хобби')")
+            await conn.executemany("INSERT INTO transactions (user_id, transaction_type, amount, category, created_at) VALUES (?, ?, ?, ?, ?)", LEGACY_ROWS)
+            await conn.execute("DELETE FROM transactions WHERE id = 11")
+            await conn.execute("PRAGMA user_version = 1")
+            await conn.commit()
+
+    asyncio.run(create())
+    return run_db
+
+def _interrupt(conn: aiosqlite.Connection, marker: str, after: int):
+    """Запрос с marker в тексте падает после after удачных - как остановка процесса посреди миграции."""
+    execute, calls = conn.execute, 0
+    def failing_execute(sql, *args):
+        nonlocal calls
+        if marker in sql:
+            calls += 1
+            if calls > after: raise sqlite3.OperationalError("disk I/O error")
+        return execute(sql, *args)
+    conn.execute = failing_execute
+
+async def _migrate_interrupted(marker: str, after: int):
+    """Запускает миграции с обрывом; возвращает user_version и число строк в промежуточной таблице."""
+    async with aiosqlite.connect(config.SQLITE_DB_FILE) as conn:
+        _interrupt(conn, f"INSERT INTO {marker}", after)
+        with pytest.raises(sqlite3.OperationalError):
+            await migrations.migrate(conn)
+    async with aiosqlite.connect(config.SQLITE_DB_FILE) as conn:
+        version = (await conn.execute_fetchall("PRAGMA user_version"))[0][0]
+        copied = (await conn.execute_fetchall(f"SELECT COUNT(*) FROM {marker}"))[0][0]
+    return version, copied
+
+async def _check_migrated():
+    while migrations.backfills_running(): await asyncio.sleep(0.01)
+    rows = await db._shards[0].conn.execute_fetchall("PRAGMA user_version")
+    assert rows[0][0] == migrations.LATEST_VERSION
+    for user_id in (1, 2):
+        expected = [(created_at, kind, round(amount * 100), category) for uid, kind, amount, category, created_at in LEGACY_ROWS[:-1] if uid == user_id]
+        assert [row async for page in db.iter_transaction_pages(user_id, page_size=2) for row in page] == expected
+    # Своя категория осталась в списке; категория только из истории заведена выключенной
+    assert [category.name for category in await db.get_user_categories(1, 'expense')] == ["Хобби"]
+    assert await db.get_user_categories(2, 'expense') == []
+    assert await db.verify_monthly_rollup() == []
+    assert await db.add_transaction(1, 'expense', 100, db.get_standard_categories(1, 'expense')[0])
+    assert (await db.get_last_transaction_id_details(1))['id'] == len(LEGACY_ROWS) + 1
+
+def test_legacy_file_is_migrated(legacy_db):
+    legacy_db(_check_migrated)
+
+def test_amount_migration_resumes(legacy_db):
+    assert asyncio.run(_migrate_interrupted('transactions_minor', after=2)) == (1, 2 * CHUNK)
+    legacy_db(_check_migrated)
+
+def test_category_migration_resumes(legacy_db):
+    # Миграции 2-8 применены (user_version - 4: за миграцией 5 еще не заполненный rollup); миграция 9 оборвалась после двух порций
+    assert asyncio.run(_migrate_interrupted('transactions_v9', after=2)) == (4, 2 * CHUNK)
+    legacy_db(_check_migrated)
@@ -0,0 +1,41 @@
+# tests/test_money.py
+import pytest
+
+from money import MAX_AMOUNT_MINOR, format_amount, parse_amount
+
+@pytest.mark.parametrize("text, minor", [
+    ("150", 15000),
+    ("99,90", 9990),
+    ("99.90", 9990),
+    ("1 200.5", 120050),
+    ("1\u00a0200,5", 120050), # неразрывный пробел
+    (" 0.01 ", 1),
+    ("7.000", 700), # нули после второго знака не меняют сумму
+])
+def test_parse_amount(text, minor):
+    assert parse_amount(text) == minor
+
+@pytest.mark.parametrize("text", [
+    "1.005", "0,001", # больше двух знаков после запятой
+    "0", "0.00", "-5", # неположительные
+    "", "   ", "abc", "1,234.5", "NaN", "Infinity", None,
+])
+def test_parse_amount_rejects(text):
+    with pytest.raises(ValueError):
+        parse_amount(text)
+
+def test_parse_amount_cap():
+    rubles = MAX_AMOUNT_MINOR // 100
+    assert parse_amount(str(rubles)) == MAX_AMOUNT_MINOR
+    with pytest.raises(ValueError):
+        parse_amount(f"{rubles}.01")
+
+@pytest.mark.parametrize("minor, text", [
+    (0, "0.00"), (None, "0.00"), (5, "0.05"), (150, "1.50"), (123456, "1234.56"), (-150, "-1.50"), (-5, "-0.05"),
+])
+def test_format_amount(minor, text):
+    assert format_amount(minor) == text
+
+@pytest.mark.parametrize("text", ["0.01", "1", "12,5", "1 000 000.99"])
+def test_format_parse_round_trip(text):
+    assert parse_amount(format_amount(parse_amount(text))) == parse_amount(text)
@@ -0,0 +1,151 @@
+# tests/test_outbox.py
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+import pytest
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import AnswerCallbackQuery, EditMessageReplyMarkup, SendMessage, TelegramMethod
+from aiogram.types import Chat, InlineKeyboardButton, InlineKeyboardMarkup, Message
+
+import config
+import outbox
+from cache import LRUCache
+
+class RecordingSession(BaseSession):
+    """Сессия без сети: запоминает отправленные запросы. Текст из errors - ошибка Telegram, из hang - ответ не приходит."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent: List[TelegramMethod] = []
+        self.errors: Dict[str, str] = {}
+        self.hang: set = set()
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        text = getattr(method, 'text', None)
+        if text in self.hang: await asyncio.Event().wait()
+        if text in self.errors: raise TelegramBadRequest(method=method, message=self.errors[text])
+        self.sent.append(method)
+        if method.__returning__ is bool or getattr(method, 'chat_id', None) is None: return True
+        return Message(message_id=len(self.sent), date=datetime.now(timezone.utc), chat=Chat(id=method.chat_id, type='private'), text=text).as_(bot)
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30, chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+@pytest.fixture
+def bot(monkeypatch):
+    # Состояние очереди - модульное: каждый тест начинает с пустой
+    monkeypatch.setattr(outbox, '_slots', {})
+    monkeypatch.setattr(outbox, '_pending_edits', {})
+    monkeypatch.setattr(outbox, '_cleared_markups', LRUCache(100, name="test_cleared"))
+    monkeypatch.setattr(outbox, '_global_bucket', None)
+    monkeypatch.setattr(outbox, '_closing', False)
+    monkeypatch.setattr(outbox, 'outbox_stats', dict.fromkeys(outbox.outbox_stats, 0))
+    monkeypatch.setattr(config, 'OUTBOX_GLOBAL_RATE', 0)
+    monkeypatch.setattr(config, 'OUTBOX_CHAT_RATE', 0)
+    bot = Bot(token="42:TEST", session=RecordingSession())
+    outbox.install(bot)
+    return bot
+
+def _texts(bot: Bot) -> List[Optional[str]]:
+    return [getattr(method, 'text', None) for method in bot.session.sent]
+
+def _markup(label: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=label, callback_data=label)]])
+
+def test_direct_send_keeps_order_with_queued(bot):
+    async def scenario():
+        queued = [outbox.send(SendMessage(chat_id=1, text=f"queued-{i}").as_(bot)) for i in range(3)]
+        message = await bot(SendMessage(chat_id=1, text="direct"))
+        assert isinstance(message, Message) and message.text == "direct"
+        assert all(isinstance(future.result(), Message) for future in queued)
+        assert await bot(AnswerCallbackQuery(callback_query_id="1")) is True # Без чата - мимо очереди
+
+    asyncio.run(scenario())
+    assert _texts(bot) == ["queued-0", "queued-1", "queued-2", "direct", None]
+    assert outbox.get_stats()["queued"] == 4
+
+def test_chat_rate_limit_applies_to_direct_sends(bot, monkeypatch):
+    monkeypatch.setattr(config, 'OUTBOX_CHAT_RATE', 20)
+    monkeypatch.setattr(config, 'OUTBOX_CHAT_BURST', 1)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for i in range(3): await bot(SendMessage(chat_id=1, text=str(i)))
+        return loop.time() - started
+
+    assert asyncio.run(scenario()) >= 0.09 # Первый - из запаса, еще два - по 1/20 с
+
+def test_pending_markup_edits_coalesce(bot):
+    async def scenario():
+        first = outbox.send(EditMessageReplyMarkup(chat_id=1, message_id=7, reply_markup=_markup("a")).as_(bot))
+        second = outbox.send(EditMessageReplyMarkup(chat_id=1, message_id=7, reply_markup=_markup("b")).as_(bot))
+        other = outbox.send(EditMessageReplyMarkup(chat_id=1, message_id=8, reply_markup=_markup("c")).as_(bot))
+        assert await first is None
+        assert await second and await other
+
+    asyncio.run(scenario())
+    assert [(method.message_id, method.reply_markup.inline_keyboard[0][0].text) for method in bot.session.sent] == [(7, "b"), (8, "c")]
+    assert outbox.get_stats()["superseded"] == 1
+
+def test_cleared_markup_is_not_cleared_again(bot):
+    async def scenario():
+        assert await outbox.send(EditMessageReplyMarkup(chat_id=1, message_id=7).as_(bot))
+        assert await outbox.send(EditMessageReplyMarkup(chat_id=1, message_id=7).as_(bot)) is None
+
+    asyncio.run(scenario())
+    assert len(bot.session.sent) == 1
+
+def test_errors_reach_direct_caller_only(bot):
+    bot.session.errors = {"bad": "Bad Request: chat not found", "same": "Bad Request: message is not modified"}
+
+    async def scenario():
+        assert await outbox.send(SendMessage(chat_id=1, text="bad").as_(bot)) is None
+        assert await outbox.send(SendMessage(chat_id=1, text="same").as_(bot)) is True
+        with pytest.raises(TelegramBadRequest, match="chat not found"):
+            await bot(SendMessage(chat_id=1, text="bad"))
+        # Обработчик сам разбирает "not modified" (см. handlers/reports.py), как при прямом вызове
+        with pytest.raises(TelegramBadRequest, match="not modified"):
+            await bot(SendMessage(chat_id=1, text="same"))
+        assert (await bot(SendMessage(chat_id=1, text="ok"))).text == "ok"
+
+    asyncio.run(scenario())
+    assert _texts(bot) == ["ok"]
+
+def test_drain_sends_queue_and_stops(bot):
+    async def scenario():
+        futures = [outbox.send(SendMessage(chat_id=chat_id, text=str(chat_id)).as_(bot)) for chat_id in (1, 2, 3)]
+        await outbox.drain(timeout=1)
+        assert all(future.done() for future in futures)
+        # После остановки запросы уходят напрямую
+        assert (await bot(SendMessage(chat_id=1, text="late"))).text == "late"
+        assert isinstance(await outbox.send(SendMessage(chat_id=1, text="late-queued").as_(bot)), Message)
+
+    asyncio.run(scenario())
+    assert sorted(_texts(bot)[:3]) == ["1", "2", "3"] and _texts(bot)[3:] == ["late", "late-queued"]
+    assert outbox.get_stats()["chats"] == 0
+
+def test_drain_timeout_releases_waiting_handlers(bot):
+    bot.session.hang = {"stuck"}
+
+    async def scenario():
+        stuck = asyncio.create_task(bot(SendMessage(chat_id=1, text="stuck")))
+        waiting = asyncio.create_task(bot(SendMessage(chat_id=1, text="waiting")))
+        await asyncio.sleep(0)
+        queued = outbox.send(SendMessage(chat_id=1, text="queued").as_(bot))
+        for _ in range(5): await asyncio.sleep(0) # Задача чата взяла "stuck" и ждет ответа
+        await outbox.drain(timeout=0.05)
+        # Отправляемый запрос и ждущие в очереди не зависают: ждущие обработчики отменяются, send() получает None
+        for task in (stuck, waiting):
+            with pytest.raises(asyncio.CancelledError):
+                await asyncio.wait_for(task, 1)
+        assert queued.result() is None
+
+    asyncio.run(scenario())
+    assert bot.session.sent == []
@@ -0,0 +1,87 @@
+# tests/test_report_cache.py
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import db
+import report_cache
+from cache import LRUCache, VersionMap
+
+JAN = (datetime(2026, 1, 1, tzinfo=timezone.utc), datetime(2026, 2, 1, tzinfo=timezone.utc))
+FEB = (datetime(2026, 2, 1, tzinfo=timezone.utc), datetime(2026, 3, 1, tzinfo=timezone.utc))
+Q1 = (datetime(2026, 1, 1, tzinfo=timezone.utc), datetime(2026, 4, 1, tzinfo=timezone.utc))
+
+@pytest.fixture
+def cache(monkeypatch):
+    """Пустой кэш отчетов на 4 записи."""
+    monkeypatch.setattr(report_cache, '_cache', LRUCache(4, name="test_reports", on_evict=report_cache._forget))
+    monkeypatch.setattr(report_cache, '_keys_by_user', {})
+    monkeypatch.setattr(report_cache, '_versions', VersionMap(100))
+    monkeypatch.setattr(report_cache, '_bytes', 0)
+    return report_cache
+
+def _put(cache, user_id, period, summary=(100, 50, {"Еда": 50})):
+    cache.put_summary(user_id, *period, summary, cache.version(user_id))
+
+def test_invalidate_only_periods_containing_time(cache):
+    for period in (JAN, FEB, Q1): _put(cache, 1, period)
+    _put(cache, 2, FEB)
+    cache.invalidate(1, '2026-02-10 12:00:00')
+    assert cache.get_summary(1, *JAN) is not None
+    assert cache.get_summary(1, *FEB) is None and cache.get_summary(1, *Q1) is None
+    assert cache.get_summary(2, *FEB) is not None # Чужие отчеты не трогаются
+
+def test_invalidate_period_bounds(cache):
+    _put(cache, 1, FEB)
+    cache.invalidate(1, '2026-03-01 00:00:00') # Конец периода не входит в него
+    assert cache.get_summary(1, *FEB) is not None
+    cache.invalidate(1, '2026-02-01 00:00:00') # Начало входит
+    assert cache.get_summary(1, *FEB) is None
+
+def test_invalidate_without_time_drops_all_user_reports(cache):
+    for period in (JAN, FEB): _put(cache, 1, period)
+    _put(cache, 2, JAN)
+    cache.invalidate(1)
+    assert cache.get_summary(1, *JAN) is None and cache.get_summary(1, *FEB) is None
+    assert cache.get_summary(2, *JAN) is not None
+    assert 1 not in cache._keys_by_user
+
+def test_stale_computation_is_not_cached(cache):
+    version = cache.version(1)
+    # Запись пришла, пока отчет считался, - даже в другой период: версия пользователя уже другая
+    cache.invalidate(1, '2025-06-01 00:00:00')
+    cache.put_summary(1, *JAN, (1, 1, {}), version)
+    cache.put_text(1, *JAN, "январь", "текст", (1, 1, {}), version)
+    assert cache.get_summary(1, *JAN) is None and cache.get_text(1, *JAN, "январь") is None
+
+def test_texts_are_kept_per_period_name(cache):
+    summary = (100, 50, {"Еда": 50})
+    cache.put_text(1, *JAN, "тек. месяц", "отчет 1", summary, cache.version(1))
+    cache.put_text(1, *JAN, "январь", "отчет 2", summary, cache.version(1))
+    assert cache.get_text(1, *JAN, "тек. месяц") == "отчет 1" and cache.get_text(1, *JAN, "январь") == "отчет 2"
+    assert cache.get_summary(1, *JAN) == summary
+    assert cache.get_text(1, *JAN, "другое") is None
+
+def test_eviction_keeps_bookkeeping(cache):
+    periods = [(JAN[0] + timedelta(days=i), JAN[1]) for i in range(6)]
+    for period in periods: _put(cache, 1, period)
+    assert len(cache._cache) == 4 and len(cache._keys_by_user[1]) == 4
+    assert cache.stats()["memory_bytes"] == sum(entry.size for entry in cache._cache._data.values())
+    cache.invalidate(1)
+    assert cache.stats()["memory_bytes"] == 0 and cache._keys_by_user == {}
+
+def test_new_transaction_invalidates_its_month_only(run_db):
+    now = datetime.now(timezone.utc)
+    this_month = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
+    last_month = (this_month - timedelta(days=1)).replace(day=1)
+    next_month = (this_month + timedelta(days=32)).replace(day=1)
+
+    async def scenario():
+        await db.get_period_summary_with_details(1, last_month, this_month)
+        await db.get_period_summary_with_details(1, this_month, next_month)
+        assert await db.add_transaction(1, 'expense', 500, db.get_standard_categories(1, 'expense')[0])
+        assert report_cache.get_summary(1, last_month, this_month) == (0, 0, {})
+        assert report_cache.get_summary(1, this_month, next_month) is None
+        assert (await db.get_period_summary_with_details(1, this_month, next_month))[1] == 500
+
+    run_db(scenario)
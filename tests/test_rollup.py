@@ -0,0 +1,133 @@
+# tests/test_rollup.py
+import asyncio
+from datetime import datetime, timezone
+
+import config
+import db
+import migrations
+import report_cache
+
+def _utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+async def _import_history(users=(1, 2, 3)):
+    """По несколько записей на пользователя в трех месяцах, включая записи на границах месяцев."""
+    rows = []
+    for user_id in users:
+        expense = db.get_standard_categories(user_id, 'expense')
+        income = db.get_standard_categories(user_id, 'income')[0]
+        for i, created_at in enumerate(('2026-01-10 12:00:00', '2026-01-31 23:59:59', '2026-02-01 00:00:00',
+                                        '2026-02-15 08:30:00', '2026-03-09 23:00:00', '2026-03-20 10:00:00')):
+            rows.append((user_id, 'expense', 1000 * user_id + i, expense[i % 3].id, created_at))
+        rows.append((user_id, 'income', 50000, income.id, '2026-02-05 09:00:00'))
+    assert await db.import_transactions(rows)
+
+async def _history_without_rollup(users):
+    """Файл как до заполнения rollup: таблица пуста, прогресса нет, последняя миграция не отмечена."""
+    await _import_history(users)
+    async with db._writer(db._shards[0]) as conn:
+        await conn.execute("DELETE FROM monthly_rollup")
+        await conn.execute("DELETE FROM migration_state WHERE name = 'rollup_backfill'")
+        await conn.execute(f"PRAGMA user_version = {migrations.LATEST_VERSION - 1}")
+        await conn.commit()
+
+async def _raw_reports(user_id: int, monkeypatch):
+    """Те же отчеты, посчитанные только по сырым строкам transactions."""
+    report_cache.clear()
+    with monkeypatch.context() as patch:
+        patch.setattr(migrations, 'rollup_ready', lambda user_id, shard=0: False)
+        return await _reports(user_id)
+
+async def _reports(user_id: int):
+    report_cache.clear()
+    summary = await db.get_period_summary_with_details(user_id, _utc(2026, 1, 15), _utc(2026, 3, 10))
+    trend = await db.get_monthly_trend(user_id, _utc(2026, 1, 1), _utc(2026, 4, 1))
+    return summary, trend
+
+def test_triggers_keep_rollup_in_sync(run_db):
+    async def scenario():
+        await _import_history()
+        assert await db.add_transaction(1, 'expense', 777, db.get_standard_categories(1, 'expense')[4])
+        last = await db.get_last_transaction_id_details(2)
+        assert await db.delete_transaction_by_id(last['id'], 2)
+        # UPDATE не делает ни один обработчик, но триггер есть: правка строки переносит сумму в другой месяц
+        async with db._writer(db._shards[0]) as conn:
+            await conn.execute("UPDATE transactions SET created_at = '2026-03-01 00:00:00', amount = amount + 1 WHERE user_id = 3 AND created_at = '2026-02-15 08:30:00'")
+            await conn.commit()
+        assert await db.verify_monthly_rollup() == []
+        # Вся история одного пользователя удалена - его строк в rollup не остается
+        while (row := await db.get_last_transaction_id_details(1)) is not None:
+            assert await db.delete_transaction_by_id(row['id'], 1)
+        rows = await db._shards[0].conn.execute_fetchall("SELECT COUNT(*) FROM monthly_rollup WHERE user_id = 1")
+        assert rows[0][0] == 0
+        assert await db.verify_monthly_rollup() == []
+
+    run_db(scenario)
+
+def test_rollup_reports_match_raw(run_db, monkeypatch):
+    async def scenario():
+        await _import_history()
+        for user_id in (1, 2, 3):
+            summary, trend = await _reports(user_id)
+            assert summary[1] > 0 and set(trend) == {'2026-01', '2026-02', '2026-03'}
+            assert (summary, trend) == await _raw_reports(user_id, monkeypatch)
+
+    run_db(scenario)
+
+def test_rebuild_restores_damaged_rollup(run_db):
+    async def scenario():
+        await _import_history()
+        async with db._writer(db._shards[0]) as conn:
+            await conn.execute("UPDATE monthly_rollup SET total_amount = total_amount + 1 WHERE user_id = 2")
+            await conn.execute("DELETE FROM monthly_rollup WHERE user_id = 3")
+            await conn.commit()
+        mismatches = await db.verify_monthly_rollup()
+        assert {row['user_id'] for row in mismatches} == {2, 3}
+        assert await db.rebuild_monthly_rollup()
+        assert await db.verify_monthly_rollup() == []
+
+    run_db(scenario)
+
+def test_background_backfill(run_db, monkeypatch):
+    monkeypatch.setattr(config, 'DB_BACKFILL_USERS_PER_CHUNK', 2)
+    monkeypatch.setattr(config, 'DB_BACKFILL_PAUSE_MS', 5)
+    users = tuple(range(1, 8))
+
+    async def check():
+        assert migrations.backfills_running()
+        assert not migrations.rollup_ready(users[-1])
+        # Пока история не перенесена, отчеты читают сырые строки и не теряют сумм
+        expected = {user_id: await _raw_reports(user_id, monkeypatch) for user_id in users}
+        assert {user_id: await _reports(user_id) for user_id in users} == expected
+        # Запись во время пересчета: триггер и порция пересчета не должны учесть ее дважды или потерять
+        assert await db.add_transaction(users[-1], 'expense', 999, db.get_standard_categories(users[-1], 'expense')[0])
+        assert await db.add_transaction(users[0], 'expense', 111, db.get_standard_categories(users[0], 'expense')[0])
+        while migrations.backfills_running(): await asyncio.sleep(0.01)
+        assert all(migrations.rollup_ready(user_id) for user_id in users)
+        assert await db.verify_monthly_rollup() == []
+        rows = await db._shards[0].conn.execute_fetchall("PRAGMA user_version")
+        assert rows[0][0] == migrations.LATEST_VERSION
+        for user_id in users:
+            assert await _reports(user_id) == await _raw_reports(user_id, monkeypatch)
+
+    run_db(lambda: _history_without_rollup(users))
+    run_db(check)
+
+def test_stopped_backfill_resumes(run_db, monkeypatch):
+    monkeypatch.setattr(config, 'DB_BACKFILL_USERS_PER_CHUNK', 1)
+    monkeypatch.setattr(config, 'DB_BACKFILL_PAUSE_MS', 20)
+    users = tuple(range(1, 6))
+
+    async def interrupt():
+        # close_db останавливает пересчет после текущей порции; прогресс остается в migration_state
+        while migrations.rollup_backfilled_upto.get(0, 0) < 2: await asyncio.sleep(0.005)
+
+    async def resume():
+        # Пересчет продолжается с сохраненного пользователя, а не с начала
+        assert migrations.rollup_backfilled_upto.get(0, 0) >= 2
+        while migrations.backfills_running(): await asyncio.sleep(0.01)
+        assert await db.verify_monthly_rollup() == []
+
+    run_db(lambda: _history_without_rollup(users))
+    run_db(interrupt)
+    run_db(resume)
@@ -0,0 +1,111 @@
+# tests/test_scheduler.py
+from datetime import datetime, timezone
+
+import pytest
+
+import config
+import scheduler
+
+def _dt(value: str) -> datetime:
+    return scheduler.parse_ts(value)
+
+@pytest.mark.parametrize("period, anchor_day, current, expected", [
+    ('daily', None, '2026-02-28 09:00:00', '2026-03-01 09:00:00'),
+    ('weekly', None, '2026-12-29 09:00:00', '2027-01-05 09:00:00'),
+    ('monthly', 15, '2026-12-15 09:00:00', '2027-01-15 09:00:00'), # переход через год
+    ('monthly', 31, '2026-01-31 09:00:00', '2026-02-28 09:00:00'), # 31-е в феврале - последний день
+    ('monthly', 31, '2026-02-28 09:00:00', '2026-03-31 09:00:00'), # после короткого месяца день возвращается
+    ('monthly', 31, '2028-01-31 09:00:00', '2028-02-29 09:00:00'), # високосный год
+    ('monthly', 30, '2026-03-30 09:00:00', '2026-04-30 09:00:00'),
+    ('monthly', None, '2026-05-10 09:00:00', '2026-06-10 09:00:00'), # без anchor_day - день текущего срока
+])
+def test_next_occurrence(period, anchor_day, current, expected):
+    assert scheduler.next_occurrence(period, anchor_day, _dt(current)) == _dt(expected)
+
+def test_monthly_anchor_keeps_day_through_year():
+    run_at = _dt('2026-01-31 09:00:00')
+    days = []
+    for _ in range(12):
+        run_at = scheduler.next_occurrence('monthly', 31, run_at)
+        days.append(run_at.day)
+    assert days == [28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31, 31]
+    assert run_at == _dt('2027-01-31 09:00:00')
+
+@pytest.fixture
+def clean_scheduler(monkeypatch):
+    """Пустое расписание без фоновой задачи; счетчики сброшены."""
+    monkeypatch.setattr(scheduler, '_rules', {})
+    monkeypatch.setattr(scheduler, '_heap', [])
+    monkeypatch.setattr(scheduler, '_wakeup', None)
+    monkeypatch.setattr(scheduler, 'scheduler_stats', {key: 0 for key in scheduler.scheduler_stats})
+    return scheduler
+
+def _rule(rule_id: int, next_run_at: str, period: str = 'daily', anchor_day=None, user_id: int = 1) -> dict:
+    return {'id': rule_id, 'user_id': user_id, 'transaction_type': 'expense', 'amount': 100, 'category_id': 1,
+            'category': 'Еда', 'period': period, 'anchor_day': anchor_day, 'next_run_at': next_run_at}
+
+def test_collect_due_catch_up_limit(clean_scheduler, monkeypatch):
+    monkeypatch.setattr(config, 'RECURRING_MAX_CATCHUP', 3)
+    monkeypatch.setattr(config, 'RECURRING_BATCH_SIZE', 1000)
+    scheduler.schedule(_rule(1, '2026-10-01 09:00:00'))
+    rows, advances, rules = scheduler._collect_due(_dt('2026-10-11 09:00:00'))
+    # 11 сроков с 01.10 по 11.10 включительно: создаются последние три, более старые пропускаются
+    assert [row[4] for row in rows] == ['2026-10-09 09:00:00', '2026-10-10 09:00:00', '2026-10-11 09:00:00']
+    assert advances == [(1, '2026-10-12 09:00:00', 1)]
+    assert [rule.id for rule in rules] == [1]
+    assert scheduler.scheduler_stats['skipped'] == 8
+    assert scheduler.scheduler_stats['caught_up'] == 2
+
+def test_collect_due_catch_up_keeps_latest_monthly(clean_scheduler, monkeypatch):
+    monkeypatch.setattr(config, 'RECURRING_MAX_CATCHUP', 2)
+    scheduler.schedule(_rule(1, '2025-01-31 09:00:00', period='monthly', anchor_day=31))
+    rows, advances, _ = scheduler._collect_due(_dt('2026-03-01 00:00:00'))
+    assert [row[4] for row in rows] == ['2026-01-31 09:00:00', '2026-02-28 09:00:00']
+    assert advances == [(1, '2026-03-31 09:00:00', 1)]
+    assert scheduler.scheduler_stats['skipped'] == 12
+
+def test_collect_due_without_catch_up(clean_scheduler, monkeypatch):
+    # 0 - пропущенные сроки не досоздаются, правило только сдвигается в будущее
+    monkeypatch.setattr(config, 'RECURRING_MAX_CATCHUP', 0)
+    scheduler.schedule(_rule(1, '2026-10-01 09:00:00'))
+    rows, advances, _ = scheduler._collect_due(_dt('2026-10-03 10:00:00'))
+    assert rows == [] and advances == [(1, '2026-10-04 09:00:00', 1)]
+    assert scheduler.scheduler_stats['skipped'] == 3
+
+def test_collect_due_monthly_catch_up_keeps_anchor(clean_scheduler, monkeypatch):
+    monkeypatch.setattr(config, 'RECURRING_MAX_CATCHUP', 400)
+    scheduler.schedule(_rule(1, '2026-01-31 09:00:00', period='monthly', anchor_day=31))
+    rows, advances, _ = scheduler._collect_due(_dt('2026-04-15 00:00:00'))
+    assert [row[4] for row in rows] == ['2026-01-31 09:00:00', '2026-02-28 09:00:00', '2026-03-31 09:00:00']
+    assert advances == [(1, '2026-04-30 09:00:00', 1)]
+
+def test_collect_due_batch_size(clean_scheduler, monkeypatch):
+    monkeypatch.setattr(config, 'RECURRING_BATCH_SIZE', 2)
+    for rule_id in (1, 2, 3):
+        scheduler.schedule(_rule(rule_id, '2026-10-03 09:00:00', user_id=rule_id))
+    now = _dt('2026-10-03 12:00:00')
+    rows, advances, _ = scheduler._collect_due(now)
+    # Пачка набрана - третье правило остается в куче до следующего прохода
+    assert [advance[2] for advance in advances] == [1, 2]
+    assert len(rows) == 2
+    rows, advances, _ = scheduler._collect_due(now)
+    assert [advance[2] for advance in advances] == [3]
+
+def test_collect_due_batch_keeps_rule_catch_up_whole(clean_scheduler, monkeypatch):
+    # Лимит пачки проверяется между правилами: сроки одного правила не делятся между пачками
+    monkeypatch.setattr(config, 'RECURRING_BATCH_SIZE', 2)
+    scheduler.schedule(_rule(1, '2026-10-01 09:00:00', user_id=1))
+    scheduler.schedule(_rule(2, '2026-10-03 09:00:00', user_id=2))
+    rows, advances, _ = scheduler._collect_due(_dt('2026-10-03 12:00:00'))
+    assert len(rows) == 3
+    assert advances == [(1, '2026-10-04 09:00:00', 1)]
+
+def test_collect_due_skips_unscheduled_and_future(clean_scheduler):
+    scheduler.schedule(_rule(1, '2026-10-01 09:00:00', user_id=1))
+    scheduler.schedule(_rule(2, '2026-10-01 09:00:00', user_id=2))
+    scheduler.schedule(_rule(3, '2026-10-20 09:00:00', user_id=3))
+    scheduler.unschedule(2, 2)
+    rows, advances, _ = scheduler._collect_due(datetime(2026, 10, 1, 10, tzinfo=timezone.utc))
+    assert rows == [(1, 'expense', 100, 1, '2026-10-01 09:00:00', 'Еда')]
+    assert advances == [(1, '2026-10-02 09:00:00', 1)]
+    assert len(scheduler._heap) == 1 # срок правила 3 еще не наступил
@@ -0,0 +1,101 @@
+# tests/test_sharding.py
+import asyncio
+from datetime import datetime, timezone
+
+import aiosqlite
+
+import config
+import db
+import report_cache
+from tools import reshard
+
+SHARDS = 3
+# По два пользователя на каждый шард
+USERS = tuple(user_id for index in range(SHARDS) for user_id in [u for u in range(1, 100) if db.shard_index(u, SHARDS) == index][:2])
+JAN, APR = datetime(2026, 1, 1, tzinfo=timezone.utc), datetime(2026, 4, 1, tzinfo=timezone.utc)
+
+def _history():
+    rows = []
+    for user_id in USERS:
+        expense = db.get_standard_categories(user_id, 'expense')
+        for i, created_at in enumerate(('2026-01-10 12:00:00', '2026-02-01 00:00:00', '2026-03-20 10:00:00')):
+            rows.append((user_id, 'expense', 100 * user_id + i, expense[i].id, created_at))
+    return rows
+
+async def _file_users(path: str):
+    """user_id, чьи транзакции лежат в файле."""
+    async with aiosqlite.connect(path) as conn:
+        return {row[0] for row in await conn.execute_fetchall("SELECT DISTINCT user_id FROM transactions")}
+
+async def _reports():
+    report_cache.clear(); db._category_cache.clear()
+    return {user_id: (await db.get_period_summary_with_details(user_id, JAN, APR), await db.get_user_categories(user_id, 'expense'))
+            for user_id in USERS}
+
+def test_shard_index_is_stable_and_in_range():
+    assert all(db.shard_index(user_id, 1) == 0 for user_id in (1, 10**12))
+    indexes = [db.shard_index(user_id, 4) for user_id in range(1000)]
+    assert set(indexes) == {0, 1, 2, 3} and min(indexes.count(i) for i in range(4)) > 200
+    # crc32 не зависит от процесса: номера не меняются между запусками
+    assert [db.shard_index(user_id, 4) for user_id in (1, 2, 123456789)] == [3, 1, 2]
+
+def test_shard_path_names():
+    assert db.shard_path(2, 4, '/data/finance_bot.db') == '/data/finance_bot.shard2of4.db'
+    assert db.shard_path(0, 1, '/data/finance_bot.db') == '/data/finance_bot.db'
+    assert db.shard_path(1, 4, ':memory:') == ':memory:'
+
+def test_writes_are_routed_to_user_shard(run_db, monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'SQLITE_SHARDS', SHARDS)
+
+    async def scenario():
+        assert await db.import_transactions(_history())
+        for user_id in USERS:
+            assert await db.add_transaction(user_id, 'income', 5000, db.get_standard_categories(user_id, 'income')[0])
+        assert await db.verify_monthly_rollup() == []
+        for user_id in USERS:
+            income, expense, _ = await db.get_period_summary_with_details(user_id, JAN, datetime(2100, 1, 1, tzinfo=timezone.utc))
+            assert income == 5000 and expense > 0
+
+    run_db(scenario)
+    for index in range(SHARDS):
+        assert asyncio.run(_file_users(db.shard_path(index, SHARDS, str(tmp_path / 'bot.db')))) == {u for u in USERS if db.shard_index(u, SHARDS) == index}
+
+def test_ids_are_per_shard(run_db, monkeypatch):
+    monkeypatch.setattr(config, 'SQLITE_SHARDS', SHARDS)
+    first, second = USERS[0], USERS[2] # Разные шарды
+
+    async def scenario():
+        # В каждом файле свои id: у правил двух пользователей один и тот же id
+        rules = [await db.add_recurring_rule(user_id, 'expense', 100, db.get_standard_categories(user_id, 'expense')[0].id, 'monthly', 1, '2026-01-01 09:00:00')
+                 for user_id in (first, second)]
+        assert rules[0]['id'] == rules[1]['id']
+        # Сдвиг срока одного правила не трогает правило с тем же id в другом шарде
+        failed = await db.apply_recurring([(first, 'expense', 100, rules[0]['category_id'], '2026-01-01 09:00:00', rules[0]['category'])],
+                                          [(first, '2026-02-01 09:00:00', rules[0]['id'])])
+        assert failed == set()
+        assert {rule['user_id']: rule['next_run_at'] for rule in await db.load_recurring_rules()} == {first: '2026-02-01 09:00:00', second: '2026-01-01 09:00:00'}
+        # Категории тоже: каждый пользователь по одному id получает свою
+        assert await db.add_user_category(first, 'expense', "Кофе") and await db.add_user_category(second, 'expense', "Такси")
+        coffee, taxi = [(await db.get_user_categories(user_id, 'expense'))[-1] for user_id in (first, second)]
+        assert coffee.id == taxi.id and (coffee.name, taxi.name) == ("Кофе", "Такси")
+        assert (await db.get_category(second, coffee.id)).name == "Такси"
+
+    run_db(scenario)
+
+def test_reshard_keeps_reports(run_db, monkeypatch, tmp_path):
+    async def fill():
+        assert await db.import_transactions(_history())
+        for user_id in USERS: assert await db.add_user_category(user_id, 'expense', f"Своя {user_id}")
+        return await _reports()
+
+    before = run_db(fill)
+    assert asyncio.run(reshard.run(str(tmp_path / 'bot.db'), SHARDS)) == 0
+    monkeypatch.setattr(config, 'SQLITE_SHARDS', SHARDS)
+
+    async def check():
+        assert await db.verify_monthly_rollup() == []
+        assert await _reports() == before
+
+    run_db(check)
+    # Повторный запуск не перезаписывает готовые шарды
+    assert asyncio.run(reshard.run(str(tmp_path / 'bot.db'), SHARDS)) == 2
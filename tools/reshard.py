@@ -0,0 +1,125 @@
+# tools/reshard.py
+"""
+Раскладывает однофайловую БД по шардам (config.SQLITE_SHARDS > 1). Выполняется при остановленном боте.
+
+Запуск из корня проекта:
+    python -m tools.reshard --shards 4                       # config.SQLITE_DB_FILE -> finance_bot.shard{0..3}of4.db
+    python -m tools.reshard --shards 4 --source backup.db    # другой исходный файл
+
+Файлы шардов создаются с нуля теми же миграциями, что и у бота. Строки пользователя переносятся
+в шард db.shard_index(user_id) одним INSERT ... SELECT из присоединенного исходного файла, с прежними id;
+monthly_rollup заполняют триггеры при вставке. Стандартные категории (user_id = 0) копируются в каждый шард
+с теми же id, поэтому category_id в строках остаются верными. Состояния FSM переносятся в шард 0.
+Исходный файл не изменяется; после проверки его можно убрать и запустить бота с SQLITE_SHARDS.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from typing import Dict, List
+
+import aiosqlite
+
+import config
+import db
+import migrations
+
+# Таблицы с данными пользователей, categories - первой: на нее ссылаются остальные.
+# monthly_rollup строится триггерами, migration_state у каждого файла своя
+USER_TABLES = ('categories', 'transactions', 'budgets', 'recurring_rules')
+
+async def _columns(conn: aiosqlite.Connection, table: str) -> List[str]:
+    return [row[1] for row in await conn.execute_fetchall(f"PRAGMA main.table_info({table})")]
+
+async def _counts(conn: aiosqlite.Connection, schema: str) -> Dict[str, int]:
+    counts = {}
+    for table in (*USER_TABLES, 'fsm_storage'):
+        # Стандартные категории есть в каждом шарде - в сверке только категории пользователей
+        where = " WHERE user_id != 0" if table == 'categories' else ""
+        counts[table] = (await conn.execute_fetchall(f"SELECT COUNT(*) FROM {schema}.{table}{where}"))[0][0]
+    return counts
+
+async def _upgrade_source(source: str):
+    """Приводит схему исходного файла к актуальной: копирование идет по колонкам последней версии."""
+    conn = await aiosqlite.connect(source)
+    try:
+        await migrations.migrate(conn)
+        # Фоновое дозаполнение rollup не нужно: в шардах rollup заполняют триггеры
+        await migrations.stop_backfills()
+    finally:
+        await conn.close()
+
+async def _fill_shard(source: str, path: str, index: int, shards: int) -> Dict[str, int]:
+    conn = await aiosqlite.connect(path)
+    try:
+        await migrations.migrate(conn, index)
+        await conn.create_function("shard_of", 1, lambda user_id: db.shard_index(user_id, shards), deterministic=True)
+        await conn.execute("ATTACH DATABASE ? AS src", (source,))
+        # Стандартные категории, заведенные миграцией, заменяются исходными: id должны совпасть с исходным файлом
+        await conn.execute("DELETE FROM main.categories")
+        for table in USER_TABLES:
+            columns = ", ".join(await _columns(conn, table))
+            where = "user_id = 0 OR shard_of(user_id) = ?" if table == 'categories' else "shard_of(user_id) = ?"
+            order = " ORDER BY id" if table in ('categories', 'transactions', 'recurring_rules') else ""
+            await conn.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table} WHERE {where}{order}", (index,))
+        if index == 0:
+            columns = ", ".join(await _columns(conn, 'fsm_storage'))
+            await conn.execute(f"INSERT INTO main.fsm_storage ({columns}) SELECT {columns} FROM src.fsm_storage")
+        await conn.commit()
+        counts = await _counts(conn, 'main')
+        await conn.execute("DETACH DATABASE src")
+        return counts
+    finally:
+        await conn.close()
+
+async def run(source: str, shards: int) -> int:
+    if shards < 2:
+        print("Use --shards 2 or more.")
+        return 2
+    if not os.path.exists(source):
+        print(f"Source database {source} not found.")
+        return 2
+    paths = [db.shard_path(index, shards, source) for index in range(shards)]
+    existing = [path for path in paths if os.path.exists(path)]
+    if existing:
+        print(f"Shard files already exist, remove them first: {', '.join(existing)}")
+        return 2
+
+    await _upgrade_source(source)
+    conn = await aiosqlite.connect(source)
+    try: expected = await _counts(conn, 'main')
+    finally: await conn.close()
+
+    totals = {table: 0 for table in expected}
+    try:
+        for index, path in enumerate(paths):
+            started = time.perf_counter()
+            counts = await _fill_shard(source, path, index, shards)
+            for table, count in counts.items(): totals[table] += count
+            print(f"{path}: {counts['transactions']} transactions, {counts['recurring_rules']} recurring rules ({time.perf_counter() - started:.1f} s)")
+    except Exception:
+        # Недоделанные шарды не должны остаться похожими на готовые
+        for path in paths:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix): os.remove(path + suffix)
+        raise
+
+    mismatched = {table: (expected[table], totals[table]) for table in expected if expected[table] != totals[table]}
+    if mismatched:
+        print(f"Row counts differ (source, shards): {mismatched}")
+        return 1
+    print(f"OK: {expected['transactions']} transactions split into {shards} shards. Set SQLITE_SHARDS={shards} and move {source} away before starting the bot.")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a single-file database into SQLITE_SHARDS shard files.")
+    parser.add_argument('--shards', type=int, default=config.SQLITE_SHARDS, help="Number of shard files")
+    parser.add_argument('--source', default=config.SQLITE_DB_FILE, help="Single-file database to split")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(asyncio.run(run(args.source, args.shards)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# tools/rollup.py
+"""
+Проверка и пересборка таблицы monthly_rollup.
+
+Запуск из корня проекта:
+    python -m tools.rollup verify   # сверить rollup с transactions, код выхода 1 при расхождениях
+    python -m tools.rollup rebuild  # пересчитать rollup и сразу сверить
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+import db
+
+async def run(command: str, show: int) -> int:
+    if not await db.connect_db():
+        logging.critical("Failed to connect to SQLite database.")
+        return 2
+    try:
+        if command == 'rebuild' and not await db.rebuild_monthly_rollup():
+            return 2
+        mismatches = await db.verify_monthly_rollup()
+        if not mismatches:
+            print("monthly_rollup OK: matches transactions.")
+            return 0
+        print(f"monthly_rollup MISMATCH: {len(mismatches)} row(s) differ from transactions.")
+        for row in mismatches[:show]:
+            print(f"  user={row['user_id']} month={row['month']} type={row['transaction_type']} category_id={row['category_id']}: "
+                  f"expected {row['expected_amount']} ({row['expected_count']} tx), rollup {row['rollup_amount']} ({row['rollup_count']} tx)")
+        print("Run 'python -m tools.rollup rebuild' to recompute it.")
+        return 1
+    finally:
+        await db.close_db()
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify or rebuild the monthly_rollup table.")
+    parser.add_argument('command', choices=['verify', 'rebuild'])
+    parser.add_argument('--show', type=int, default=20, help="How many mismatching rows to print")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(asyncio.run(run(args.command, args.show)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# webhook.py
+"""
+Режим вебхука: aiohttp-сервер принимает апдейты от Telegram и передает их в Dispatcher.
+
+Для локальной проверки достаточно BOT_MODE=webhook без WEBHOOK_URL и POST с JSON апдейта:
+    curl -X POST localhost:8080/webhook -H 'Content-Type: application/json' \\
+         -d '{"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"},
+              "from": {"id": 1, "is_bot": false, "first_name": "Test"}, "text": "/help"}}'
+"""
+import asyncio
+import logging
+import signal
+from typing import Any, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+import config
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука с ограничением числа одновременно обрабатываемых апдейтов.
+    Апдейты обрабатываются в фоне, но при достижении лимита ответ Telegram задерживается,
+    пока не освободится слот, - так Telegram сам притормаживает отправку.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_in_flight: int, drain_timeout: float, **kwargs: Any) -> None:
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **kwargs)
+        self._slots = asyncio.Semaphore(max(1, max_in_flight))
+        self.drain_timeout = drain_timeout
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self._slots.acquire()
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except Exception:
+            self._slots.release()
+            raise
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        """Дожидается обработки принятых апдейтов. Сессию бота закрывает main."""
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks: return
+        logging.info(f"Draining {len(tasks)} in-flight webhook updates...")
+        done, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+        if pending:
+            logging.warning(f"{len(pending)} webhook updates did not finish in {self.drain_timeout}s, cancelling.")
+            for task in pending: task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+async def run_webhook(dp: Dispatcher, bot: Bot, stop_event: Optional[asyncio.Event] = None):
+    """Запускает сервер вебхука и работает до SIGINT/SIGTERM (или stop_event), затем дообрабатывает апдейты."""
+    app = web.Application()
+    handler = BoundedRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        max_in_flight=config.WEBHOOK_MAX_IN_FLIGHT,
+        drain_timeout=config.WEBHOOK_DRAIN_TIMEOUT,
+        secret_token=config.WEBHOOK_SECRET or None,
+    )
+    handler.register(app, path=config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError): pass # Windows / не главный поток
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Webhook server listening on {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH} (max in-flight {config.WEBHOOK_MAX_IN_FLIGHT})")
+    try:
+        if config.WEBHOOK_URL:
+            await bot.set_webhook(
+                url=config.WEBHOOK_URL,
+                secret_token=config.WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(100, max(1, config.WEBHOOK_MAX_IN_FLIGHT)),
+            )
+            logging.info(f"Webhook set to {config.WEBHOOK_URL}")
+        else:
+            logging.warning("WEBHOOK_URL is empty: set_webhook skipped, accepting local POSTs only.")
+        await stop_event.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try: loop.remove_signal_handler(sig)
+            except (NotImplementedError, RuntimeError): pass
+        logging.info("Stopping webhook server...")
+        # cleanup() перестает принимать соединения, затем вызывает on_shutdown: дообработку апдейтов и emit_shutdown
+        await runner.cleanup()
+        logging.info("Webhook server stopped.")